@@ -3,7 +3,13 @@
 if __name__ != "__main__":
     raise ImportError
 
+import os
 import sys
+
+if os.environ.get('SKY_IMPORT_TIMES'):
+    from . import import_profile
+    import_profile.install()
+
 from . import cmd
 
 sys.exit(cmd.main())
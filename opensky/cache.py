@@ -5,7 +5,6 @@ Engine that actually executes the operation.
 '''
 import os
 import os.path
-import sys
 import datetime
 import shutil
 
@@ -15,6 +14,9 @@ import seashore
 from boltons import fileutils
 from boltons.strutils import bytes2human
 
+from . import log
+from .shell import ShellSubprocessError
+
 
 # ANACONDA_URL = 'https://repo.continuum.io/archive/Anaconda2-4.2.0-Linux-x86_64.sh'
 ANACONDA_URL = 'https://repo.continuum.io/miniconda/Miniconda2-latest-Linux-x86_64.sh'
@@ -32,24 +34,18 @@ class HTTPClient(object):
 
     def urlretrieve(self, url, dest, print_progress=True):
         resp = self._session.get(url, stream=True)
-        total_size, total_chunks = 0, 0
+        total_size = 0
+        progress = log.get_progress_renderer()
         with fileutils.atomic_save(dest) as f:
-            content_iter = resp.iter_content(1024)
-            while 1:
-                size_str = bytes2human(total_size, 1).rjust(7)
-                msg = ('%s downloaded from %s\r' % (size_str, url))
-                if print_progress and (total_chunks % 20) == 0:
-                    sys.stdout.write(msg)
-                    sys.stdout.flush()
-                try:
-                    chunk = next(content_iter)
-                except StopIteration:
-                    if print_progress:
-                        sys.stdout.write('\n')
-                    break
+            for chunk in resp.iter_content(1024):
                 total_size += len(chunk)
-                total_chunks += 1
                 f.write(chunk)
+                if print_progress:  # rate limited by the renderer
+                    progress.update(url, '%s downloaded from %s' % (
+                        bytes2human(total_size, 1).rjust(7), url))
+        if print_progress:
+            progress.finish(url, '%s downloaded from %s' % (
+                bytes2human(total_size, 1).rjust(7), url))
         return
 
 
@@ -115,6 +111,73 @@ class DependencyCache(object):
             # that has local changes?
         return dest
 
+    def get_remote_sha(self, remote, checkout_id='master'):
+        '''
+        The commit branch or tag *checkout_id* currently points to on
+        *remote*, without fetching (a branch wins over a tag of the
+        same name, as with git clone --branch); *checkout_id* itself if
+        it is neither (e.g., a commit id), None if the remote can't be
+        reached.
+        '''
+        checkout_id = checkout_id or 'master'
+        # ls-remote patterns match any ref ending in them, e.g.
+        # refs/heads/foo/master for master, so pick the exact refs
+        refs = ['refs/heads/' + checkout_id, 'refs/tags/' + checkout_id + '^{}',
+                'refs/tags/' + checkout_id]
+        try:
+            out = self.executor.command(
+                ['git', 'ls-remote', remote] + refs).batch()[0]
+        except ShellSubprocessError:
+            return None
+        shas = dict([(ref, sha) for sha, ref in
+                     [line.split() for line in out.splitlines() if line.strip()]])
+        for ref in refs:  # an annotated tag's commit is under "tag^{}"
+            if ref in shas:
+                return shas[ref]
+        return checkout_id
+
+    def pull_sparse_git(self, name, remote, sparse_paths, checkout_id='master'):
+        '''
+        Shallow (depth 1) checkout of *remote* that only materializes
+        files matching *sparse_paths* (sparse-checkout patterns). Where
+        git and the server support partial clone, no blobs outside the
+        sparse paths are downloaded until they are read with
+        SparseGitRepo.materialize(). The checkout lives in the global
+        cache and is updated in place. It is keyed by *name* as well as
+        the remote, since updating rewrites the work tree to match
+        *sparse_paths*: each set of sparse paths needs its own name.
+        '''
+        checkout_id = checkout_id or 'master'
+        dest = '%s/git-sparse/%s-%s' % (self.cache_dir, name, escape_remote(remote))
+        git_cmd = self.executor.chdir(dest).command
+        with self.logger.info('git_sparse_{name}', name=name):
+            if os.path.isdir(dest + '/.git'):
+                git_cmd(['git', 'fetch', '--depth', '1',
+                         'origin', checkout_id]).redirect()
+                checkout_args = ['--detach', 'FETCH_HEAD']
+            else:
+                if os.path.exists(dest):  # left by an interrupted clone
+                    shutil.rmtree(dest)
+                fileutils.mkdir_p(os.path.dirname(dest))
+                clone_args = ['git', 'clone', '--depth', '1', '--no-checkout',
+                              '--branch', checkout_id, remote, dest]
+                try:
+                    self.executor.command(
+                        clone_args[:2] + ['--filter=blob:none'] + clone_args[2:]
+                    ).redirect()
+                except ShellSubprocessError:
+                    # older git or server without partial clone support;
+                    # still shallow, but has all the blobs at the tip;
+                    # the failed clone may or may not have removed dest
+                    shutil.rmtree(dest, ignore_errors=True)
+                    self.executor.command(clone_args).redirect()
+                git_cmd(['git', 'config', 'core.sparseCheckout', 'true']).redirect()
+                checkout_args = []
+            with fileutils.atomic_save(dest + '/.git/info/sparse-checkout') as f:
+                f.write('\n'.join(sparse_paths) + '\n')
+            git_cmd(['git', 'checkout', '-f'] + checkout_args).redirect()
+        return SparseGitRepo(dest, self.executor)
+
     def pull_git(self, name, remote):
         '''
         pull or clone the passed git repo
@@ -145,14 +208,7 @@ class DependencyCache(object):
 
     def commit2build_tag(self):
         'return current commit as a docker tag'
-        git_ref = self.executor.git.rev_parse('HEAD').batch()[0]
-        git_ref = git_ref.strip()[:8]
-        # git log --max-count=1 --format=%ct
-        unix_ts = int(
-            self.executor.git.log(
-                max_count=seashore.Eq('1'), format=seashore.Eq('%ct')).batch()[0])
-        date = datetime.datetime.utcfromtimestamp(unix_ts).strftime('%y.%m.%d')
-        return '_'.join((date, str(unix_ts), git_ref))
+        return get_build_identity(self.executor).build_tag
 
 
 @attr.s
@@ -179,6 +235,99 @@ class GitRepo(object):
         git.push(*opts).redirect()
 
 
+@attr.s
+class BuildIdentity(object):
+    '''
+    Identifies the commit a build is made from: full sha, commit
+    unix timestamp (and its ISO form), and the checked-out branch
+    ("HEAD" when detached). Whether the work tree has uncommitted
+    changes is looked up lazily, since most callers only need the tag.
+    '''
+    path, sha, timestamp, iso_timestamp, branch = [attr.ib() for i in range(5)]
+    _executor = attr.ib(repr=False, cmp=False)
+    _dirty = attr.ib(default=None, repr=False, cmp=False)
+
+    @property
+    def build_tag(self):
+        'the docker tag for this commit: yy.mm.dd_unixts_shortsha'
+        date = datetime.datetime.utcfromtimestamp(
+            self.timestamp).strftime('%y.%m.%d')
+        return '_'.join((date, str(self.timestamp), self.sha[:8]))
+
+    @property
+    def dirty(self):
+        if self._dirty is None:
+            status = self._executor.chdir(self.path).git.status(
+                porcelain=None).batch()[0]
+            self._dirty = bool(status.strip())
+        return self._dirty
+
+
+_BUILD_IDENTITIES = {}
+
+
+def get_build_identity(executor, path=None):
+    '''
+    Get the BuildIdentity of the git checkout at *path* (defaults to
+    the current directory). All of the commit info comes from a single
+    git invocation, and the result is cached for the rest of the
+    process.
+    '''
+    path = os.path.realpath(path or os.getcwd())
+    try:
+        return _BUILD_IDENTITIES[path]
+    except KeyError:
+        pass
+    output = executor.chdir(path).git.log(
+        'HEAD', max_count=seashore.Eq('1'),
+        format=seashore.Eq(_BUILD_IDENTITY_FORMAT)).batch()[0]
+    ret = _BUILD_IDENTITIES[path] = parse_build_identity(
+        output, path, executor)
+    return ret
+
+
+# sha, committer unix timestamp, committer ISO date, ref names
+_BUILD_IDENTITY_FORMAT = '%H%n%ct%n%ci%n%D'
+
+
+def parse_build_identity(log_output, path, executor=None):
+    'parse the output of git log with _BUILD_IDENTITY_FORMAT'
+    lines = log_output.strip('\n').split('\n')
+    sha, unix_ts, iso_ts = [line.strip() for line in lines[:3]]
+    ref_names = lines[3] if len(lines) > 3 else ''
+    branch = 'HEAD'  # matches git rev-parse --abbrev-ref on a detached HEAD
+    for ref_name in ref_names.split(','):
+        ref_name = ref_name.strip()
+        if ref_name.startswith('HEAD -> '):
+            branch = ref_name[len('HEAD -> '):]
+            break
+    return BuildIdentity(path=path, sha=sha, timestamp=int(unix_ts),
+                         iso_timestamp=iso_ts, branch=branch,
+                         executor=executor)
+
+
+@attr.s
+class SparseGitRepo(object):
+    'a checkout created by DependencyCache.pull_sparse_git()'
+    path, executor = attr.ib(), attr.ib()
+
+    def materialize(self, rel_path):
+        '''
+        Ensure the file at *rel_path* (relative to the repo root) exists
+        on disk, reading it out of git (and so fetching it from the
+        remote, in a partial clone) if it was outside the sparse
+        paths. Returns the local path.
+        '''
+        local_path = os.path.join(self.path, rel_path)
+        if not os.path.exists(local_path):
+            fileutils.mkdir_p(os.path.dirname(local_path))
+            with fileutils.atomic_save(local_path) as f:
+                self.executor.chdir(self.path).command(
+                    ['git', 'cat-file', 'blob', 'HEAD:' + rel_path]
+                ).redirect(stdout=f)
+        return local_path
+
+
 def create_or_update_mirror(remote, base_path, executor, logger):
     escaped_remote = escape_remote(remote)
     dest = os.path.join(base_path, escaped_remote)
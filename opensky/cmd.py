@@ -15,7 +15,6 @@ from os.path import join as pjoin
 import re
 import json
 import time
-import glob
 import shutil
 import argparse
 
@@ -28,6 +27,7 @@ import hyperlink
 
 from . import shell
 from . import docker
+from . import docker_api
 from . import service_manager
 from . import config
 from . import typesnap
@@ -35,6 +35,7 @@ from . import log
 from . import cache
 from . import plugins
 from . import tb_format
+from . import workspace
 from . import self_plugin
 from . import site_config
 from . import services_plugin
@@ -81,8 +82,12 @@ USE_DOCKER_MACHINE = _env_flag(  # docker-machine everywhere but linux
 
 @plugins.register_command(requires=('service',),
                           help='setup project based on sky.yaml')
-def setup(args, reqs):
-    reqs.service.setup()
+def setup(argv, reqs):
+    prs = argparse.ArgumentParser(prog='setup')
+    prs.add_argument('--force', action="store_true",
+                     help='re-run every stage, even if its inputs are unchanged')
+    args = prs.parse_args(argv[1:])
+    reqs.service.setup(force=args.force)
 
 
 @plugins.register_command(requires=('sky_metadata',),
@@ -157,6 +162,12 @@ def start(argv, reqs):
                      help="start python repl in place of app")
     prs.add_argument('--debug', action="store_true",
                      help="start app with debug hook enabled")
+    prs.add_argument('--profile', action="store_true",
+                     help="start app under a sampling profiler,"
+                     " see 'sky profile report'")
+    prs.add_argument('--memprofile', action="store_true",
+                     help="start app taking periodic memory allocation"
+                     " snapshots, see 'sky profile mem-report'")
     args = prs.parse_args(argv[1:])
 
     if args.bash:
@@ -167,6 +178,10 @@ def start(argv, reqs):
         reqs.service.repl_start()
     elif args.debug:
         reqs.service.start_debug()
+    elif args.profile:
+        reqs.service.start_profile()
+    elif args.memprofile:
+        reqs.service.start_profile(mode='mem')
     else:
         reqs.service.start()
     return
@@ -174,11 +189,33 @@ def start(argv, reqs):
 
 @plugins.register_command(requires=('service',), help='run unit tests')
 def test(argv, reqs):
+    try:
+        index = argv.index('--')
+    except ValueError:
+        cmd_args, sub_args = argv[1:], []
+    else:
+        cmd_args, sub_args = argv[1:index], argv[index + 1:]
     prs = argparse.ArgumentParser(prog='test')
     prs.add_argument('--pdb', action="store_true",
                      help='pdb prompt on failures and exceptions')
-    args = prs.parse_args(argv[1:])
-    reqs.service.test(pdb_on_error=args.pdb)
+    prs.add_argument('-n', '--workers',
+                     help="number of test processes, or 'auto' for one per CPU")
+    prs.add_argument('--lf', '--last-failed', action="store_true",
+                     help='only run the tests that failed last time')
+    prs.add_argument('--ff', '--failed-first', action="store_true",
+                     help='run the tests that failed last time first')
+    prs.add_argument('--changed', action="store_true",
+                     help='only run tests for files modified since the last setup')
+    args = prs.parse_args(cmd_args)
+    pytest_args = []
+    if args.workers and not args.pdb:  # pdb needs a single process
+        pytest_args += ['-n', args.workers]
+    if args.lf:
+        pytest_args.append('--lf')
+    if args.ff:
+        pytest_args.append('--ff')
+    reqs.service.test(pdb_on_error=args.pdb, changed=args.changed,
+                      pytest_args=pytest_args + sub_args)
 
 
 @plugins.register_command(help='run integration tests', requires=('service',))
@@ -189,30 +226,27 @@ def int_test(args, reqs):
         cmd_args, sub_args = args, []
     else:
         cmd_args, sub_args = args[:index], args[index + 1:]
-    reqs.service.integration_test(sub_args)
+    prs = argparse.ArgumentParser(prog='int_test')
+    prs.add_argument('--shards', type=int, default=1,
+                     help='split the tests across this many concurrent compositions')
+    parsed_args = prs.parse_args(cmd_args[1:])
+    reqs.service.integration_test(sub_args, shards=parsed_args.shards)
 
 
 @plugins.register_command(requires=('global_sky_path', 'executor'),
                           help='start a bash prompt on the last step of crashed docker build')
 def bash_broken_build(argv, reqs):
     # TODO: nest under better top-level command (e.g., "sky util" or "sky contrib")
-    image_id = None
-    last_run = None
-    pattern = reqs.global_sky_path + '/workspace/*/log.txt'
-    paths = glob.glob(pattern)
-    for path in sorted(paths, reverse=True):  # search from newest to oldest
-        with open(path) as f:
-            for line in f:
-                match = re.match('^ ---> ([a-z0-9]{12})$', line)
-                if match:
-                    image_id = match.groups()[0]
-                if re.match('^Step [0-9]+/[0-9]+ : .*$', line):
-                    last_run = line
-    if not image_id:
-        print 'could not find any image ids in files matching pattern %r' % pattern
+    workdir = reqs.global_sky_path + '/workspace'
+    docker_paths = [workdir + '/' + fn + '/docker' for _, fn
+                    in reversed(workspace.list_workspaces(workdir))]
+    build = docker.find_last_build(docker_paths)
+    if not build:
+        print 'could not find any recorded docker builds in %r' % workdir
         return
-    if last_run:
-        print last_run
+    image_id = build['last_image_id']
+    if build['last_step']:
+        print build['last_step']
         print '\n'
     reqs.executor.docker.run(
         image_id, interactive=None, tty=None,
@@ -375,21 +409,11 @@ def get_injectables():
 
     def setup_sky_path(global_sky_path):
         'set up the working directory for the current command'
-        workdir = global_sky_path + '/workspace'
-        ensure_path(workdir)
-        num_to_keep = 50
-        index_dirs = {}
-        for fn in os.listdir(workdir):
-            if not os.path.isdir(workdir):
-                continue
-            try:
-                index_dirs[int(fn[:4].lstrip('0'))] = fn
-            except (ValueError, TypeError):
-                continue
-        last = max(index_dirs.keys() + [0])
-        for index in index_dirs:  # delete excess
-            if index < last - num_to_keep:
-                shutil.rmtree(workdir + '/' + index_dirs[index])
+        workdir = ensure_path(global_sky_path + '/workspace')
+        trash_dir = ensure_path(global_sky_path + '/trash')
+        last = workspace.rotate(workdir, trash_dir)
+        if workspace.needs_reaping(trash_dir, last):
+            workspace.spawn_reaper(workdir, trash_dir)
         cmd_info = []
         for seg in sys.argv[1:]:
             if seg.startswith('--'):
@@ -434,12 +458,14 @@ def get_injectables():
         service=service_manager.Service,
         docker_runner=docker.Runner,
         docker_daemon_fixer=docker.DaemonFixer,
+        docker_api=docker_api.DockerAPIClient.from_env,
         cache=cache.DependencyCache,
         build_tag=lambda cache: cache.commit2build_tag(),
         gitlab_ci=GitlabCI.from_env,
         logger=log.build_file_enabled_logger,
         # NOTE: this path interacts with cache.rotate_logs
-        log_file=lambda sky_path: open(sky_path + '/log.txt', 'ab'),
+        log_file=lambda sky_path: workspace.open_log(sky_path),
+        events_file=lambda sky_path: open(sky_path + '/' + log.EVENTS_FILE, 'ab'),
         config=config.parse,
         config_path=find_config_path,
         schema_map=config.build_schema_map,
@@ -605,10 +631,11 @@ def main(argv=None):
                 log_path = reqs.logger.log_file_path
                 if DUMP_LOG:
                     print '\nlog.txt contents...\n'
-                    print open(log_path).read()
+                    with open(log_path) as log_file:
+                        shutil.copyfileobj(log_file, sys.stdout)
                 elif had_error:
                     print "last 20 lines of logs:"
-                    print ''.join(map(_clip, open(log_path).readlines()[-20:]))
+                    print ''.join(map(_clip, log.tail_lines(log_path, 20)))
                     print 'for more details, right-click + open --> ',
                     print 'file://' + log_path
     except tuple(EXC_EXIT_MAP.keys()) as e:
@@ -3,13 +3,18 @@
 '''
 Classes and functions for operating docker.
 '''
+import re
 import sys
+import glob
 import shutil
 import os.path
 import os
 import json
 import time
+import hashlib
 import argparse
+import tempfile
+import threading
 
 from boltons import fileutils, iterutils
 import yaml
@@ -18,6 +23,8 @@ import schema
 import seashore
 from schema_builder import schema_attrib, as_tuple, list_or_tuple_of
 import plugins
+import docker_api
+from shell import ShellSubprocessError
 
 CENTOS = 'centos:7.3.1611'
 
@@ -47,6 +54,89 @@ def docker_cmd_plugin(args, reqs):
 
 DOCKER_FOR_MAC_HOST_BRIDGE_IP = '192.168.65.1'
 
+_NO_API = object()  # the Docker API can't be used, fall back to the CLI
+
+# per-workspace record of docker builds, relative to the docker_path
+BUILD_STEPS_FILE = 'build_steps.json'
+
+
+@attr.s
+class BuildStepRecorder(object):
+    '''
+    Follows docker build output to record the last intermediate image
+    built and the last step started, which is the failed step if the
+    build fails. save() appends the record to a JSON index so the
+    newest build can be found without parsing logs.
+    '''
+    name, tag = attr.ib(), attr.ib()
+    last_image_id = attr.ib(default=None)
+    last_step = attr.ib(default=None)
+    failed = attr.ib(default=False)
+
+    def feed(self, line):
+        line = line.rstrip('\n')
+        match = re.match('^ ---> ([a-z0-9]{12})$', line)
+        if match:
+            self.last_image_id = match.groups()[0]
+        elif re.match('^Step [0-9]+/[0-9]+ : .*$', line):
+            self.last_step = line
+
+    def save(self, path):
+        try:
+            with open(path) as f:
+                builds = json.load(f)
+        except IOError:
+            builds = []
+        entry = attr.asdict(self)
+        entry['timestamp'] = time.time()
+        builds.append(entry)
+        with fileutils.atomic_save(path) as f:
+            json.dump(builds, f, indent=2, sort_keys=True)
+
+
+_PORT_MAPPING_RE = re.compile(r'^(?:.*:)?(\d+)(?:-(\d+))?->\d+(?:-\d+)?/\w+$')
+
+
+def parse_ps_ports(ps_output):
+    '''
+    Parse the output of "docker ps --format '{{.ID}}\\t{{.Ports}}'"
+    into a map of published host port to container id, expanding
+    port ranges. Exposed but unpublished ports are skipped.
+    '''
+    ret = {}
+    for line in ps_output.splitlines():
+        container_id, _, ports = line.strip().partition('\t')
+        for mapping in ports.split(','):
+            match = _PORT_MAPPING_RE.match(mapping.strip())
+            if not match:
+                continue
+            start, end = match.groups()
+            for port in range(int(start), int(end or start) + 1):
+                ret[port] = container_id
+    return ret
+
+
+def find_last_build(docker_paths):
+    '''
+    Given workspace docker paths, newest first, return the newest
+    failed build's record, or the newest build with an intermediate
+    image if none failed. Returns None if there is no record.
+    '''
+    fallback = None
+    for docker_path in docker_paths:
+        try:
+            with open(docker_path + '/' + BUILD_STEPS_FILE) as f:
+                builds = json.load(f)
+        except IOError:
+            continue
+        for build in reversed(builds):
+            if not build['last_image_id']:
+                continue
+            if build['failed']:
+                return build
+            fallback = fallback or build
+    return fallback
+
 
 @attr.s
 class Runner(object):
@@ -57,11 +147,20 @@ class Runner(object):
     executor, shell, logger, docker_path = (attr.ib() for i in range(4))
     use_docker_machine = attr.ib(default=True)
     sudo = attr.ib(default=None)
+    log_file = attr.ib(default=None)
+    docker_api = attr.ib(default=None)
+    global_sky_path = attr.ib(default=None)
 
     def __attrs_post_init__(self):
         if not os.path.exists(self.docker_path):
             os.mkdir(self.docker_path)  # create one level of directory
-        self.compose_path = self.docker_path + '/compositions/'
+        if self.global_sky_path:
+            # shared across commands, so unchanged compositions
+            # aren't rewritten and the compose helper can be reused
+            self.compose_path = self.global_sky_path + '/compose/'
+            fileutils.mkdir_p(self.compose_path)
+        else:
+            self.compose_path = self.docker_path + '/compositions/'
         self.image_path = self.docker_path + '/images/'
         if not os.path.exists(self.compose_path):
             os.mkdir(self.compose_path)
@@ -77,36 +176,125 @@ class Runner(object):
         *project* - the docker-compose namespace in which to run
            (e.g. networks, volumes "see" each other within a namespace)
         '''
+        # docker-compose only recreates the containers whose config or
+        # image changed, the rest (e.g., databases) keep their state;
+        # no --remove-orphans, smaller compositions (e.g., for TEST)
+        # must leave the database containers of the project alone
         self._docker_compose_cmd(composition, project,
                                  ['up', '--abort-on-container-exit'])
         return
 
+    def get_service_fingerprints(self, composition):
+        '''
+        Map of service name to a hash of the service's compose config
+        and the id of its image, which changes when either one does,
+        i.e., when docker-compose would recreate the service's container.
+        '''
+        services = composition.to_data()['services']
+        fingerprints = {}
+        for service in composition.services:
+            key = json.dumps([services[service.name], self.get_image_id(service.image)],
+                             sort_keys=True)
+            fingerprints[service.name] = hashlib.sha1(key).hexdigest()
+        return fingerprints
+
     def _docker_compose_cmd(self, composition, project, args):
         work_dir = self.compose_path + composition.namespace
-        if os.path.exists(work_dir):
-            self._clean_dir(work_dir)
-        else:
-            fileutils.mkdir_p(work_dir)
-        compose_path = work_dir + '/docker-compose.yml'
-        with open(compose_path, 'w') as compose_file:
-            yaml.dump(composition.to_data(), compose_file)
+        fileutils.mkdir_p(work_dir)
+        compose_bytes = yaml.dump(composition.to_data())
+        # named by content and never modified, so concurrent commands
+        # with different compositions in this namespace don't read each
+        # other's half-written or replaced file
+        digest = hashlib.sha1(compose_bytes).hexdigest()[:12]
+        compose_path = work_dir + '/docker-compose-' + digest + '.yml'
+        if not os.path.exists(compose_path):
+            with fileutils.atomic_save(compose_path) as compose_file:
+                compose_file.write(compose_bytes)
+            self._prune_compose_files(work_dir, keep=compose_path)
         self.shell.log_file(compose_path)
 
         if not self.use_docker_machine:
-            cmd_args = ['docker-compose'] + list(args)
+            cmd_args = ['docker-compose', '--file', compose_path] + list(args)
             return self.executor.chdir(work_dir).command(cmd_args).redirect()
 
-        # docker-compose in docker
-        def _fmt_vols(paths):
-            return sum(
-                [['--volume', '{0}:{0}'.format(p)] for p in paths], [])
+        # docker-compose in a long-lived helper container; docker exec
+        # doesn't forward signals, so docker-compose writes its pid for
+        # _stop_compose_exec to TERM it if this process is interrupted
+        helper = self._ensure_compose_helper()
+        pid_fd, pid_path = tempfile.mkstemp(dir=work_dir, prefix='.compose-', suffix='.pid')
+        os.close(pid_fd)
+        dcd_args = (['docker', 'exec', '--env', 'COMPOSE_PROJECT_NAME=' + project,
+                     helper, 'sh', '-c', 'echo $$ > "$0" && exec docker-compose "$@"',
+                     pid_path, '--file', compose_path] + list(args))
+        try:
+            return self.executor.command(dcd_args).redirect()
+        except BaseException:
+            self._stop_compose_exec(helper, pid_path)
+            raise
+        finally:
+            os.remove(pid_path)
+
+    def _prune_compose_files(self, work_dir, keep):
+        '''
+        Remove the compose files of other compositions from *work_dir*.
+        docker-compose reads its file when it starts, so only files older
+        than COMPOSE_FILE_MIN_AGE, which no command can be about to
+        read, are removed; a later command that needs one rewrites it.
+        '''
+        min_mtime = time.time() - COMPOSE_FILE_MIN_AGE
+        for path in glob.glob(work_dir + '/docker-compose*.yml'):
+            if path == keep:
+                continue
+            try:
+                if os.path.getmtime(path) < min_mtime:
+                    os.remove(path)
+            except OSError:
+                pass  # removed by a concurrent command
 
-        dcd_args = (['docker', 'run']
-                    + _fmt_vols((work_dir, '/var/run/docker.sock'))
-                    + ['--env', 'COMPOSE_PROJECT_NAME=' + project,
-                       '--workdir', work_dir, '--interactive', '--rm']
-                    + [DOCKER_COMPOSE_IMAGE] + list(args))
-        return self.executor.command(dcd_args)
+    def _stop_compose_exec(self, helper, pid_path):
+        '''
+        Send TERM to the docker-compose started in *helper* by
+        _docker_compose_cmd, if it is still running, so that e.g. "up"
+        stops its containers the way it does on Ctrl-C outside docker.
+        '''
+        with self.logger.info('stop_compose_exec', helper=helper):
+            try:
+                self.executor.command(
+                    ['docker', 'exec', helper, 'sh', '-c',
+                     'pid=$(cat "$0") && kill -0 "$pid" 2>/dev/null'
+                     ' && kill -TERM "$pid" || true', pid_path]).batch()
+            except ShellSubprocessError:
+                pass  # the helper is gone, and docker-compose with it
+
+    def _ensure_compose_helper(self):
+        '''
+        Start, if it isn't running yet, a container with docker-compose
+        that has the compose work dirs and the docker socket mounted,
+        for running docker-compose with docker exec. The name is
+        unique per compose path and image, so a change in either gets
+        a new helper.
+        '''
+        key = hashlib.sha1(self.compose_path + DOCKER_COMPOSE_IMAGE).hexdigest()[:8]
+        name = COMPOSE_HELPER_PREFIX + key
+        try:
+            running = self.executor.docker.inspect(
+                name, format='{{.State.Running}}').batch()[0].strip()
+        except ShellSubprocessError:
+            running = None  # no such container
+        if running == 'true':
+            return name
+        with self.logger.info('start_compose_helper', name=name):
+            if running is None:
+                self.executor.command(
+                    ['docker', 'run', '--detach', '--name', name,
+                     '--volume', '{0}:{0}'.format(self.compose_path.rstrip('/')),
+                     '--volume', '/var/run/docker.sock:/var/run/docker.sock',
+                     '--entrypoint', 'sh', DOCKER_COMPOSE_IMAGE,
+                     '-c', 'trap "exit 0" TERM; while true; do sleep 3600 & wait; done']
+                ).redirect()
+            else:
+                self.executor.docker.start(name).redirect()
+        return name
 
     def build_imagespec(self, image_spec, tag='latest', user='app'):
         small_files = dict(image_spec.small_files)
@@ -178,7 +366,43 @@ class Runner(object):
         '''
         work_dir = self.setup_docker_context(
             name, dockerfile, context_paths, small_files, ignore_patterns)
-        self.executor.docker.build(work_dir, tag=tag).redirect()
+        build_cmd = self.executor.docker.build(work_dir, tag=tag)
+        if self.log_file is None:
+            build_cmd.redirect()
+            return
+        recorder = BuildStepRecorder(name=name, tag=tag)
+        try:
+            self._stream_output(build_cmd, recorder.feed)
+        except Exception:
+            recorder.failed = True
+            raise
+        finally:
+            recorder.save(self.docker_path + '/' + BUILD_STEPS_FILE)
+
+    def _stream_output(self, command, on_line):
+        '''
+        Run *command* with output going to the log file, like
+        redirect(), but also pass each line to *on_line* as it is
+        written.
+        '''
+        read_fd, write_fd = os.pipe()
+        reader, writer = os.fdopen(read_fd, 'rb'), os.fdopen(write_fd, 'wb')
+
+        def _pump():
+            with reader:
+                for line in iter(reader.readline, ''):
+                    self.log_file.write(line)
+                    on_line(line)
+            self.log_file.flush()
+
+        pump_thread = threading.Thread(target=_pump, name='docker_output')
+        pump_thread.daemon = True
+        pump_thread.start()
+        try:
+            command.redirect(stdout=writer, stderr=writer)
+        finally:
+            writer.close()
+            pump_thread.join()
 
     def setup_docker_context(self, name, dockerfile, context_paths,
                              small_files, ignore_patterns=('.git', '*.pyc')):
@@ -231,45 +455,93 @@ class Runner(object):
         walk_paths(small_files, handle_small_file)
         return work_dir
 
-    def interact(self, container, cmd, root=False, batch=False):
+    def interact(self, container, cmd, root=False, batch=False, output=None):
         '''
         run *cmd* in *container*; *root* controls whether to run as
         containers default user or root; *batch* controls whether to
         interact with terminal input (batch=True means there is
-        no human involved, so don't expect interaction just dump output)
+        no human involved, so don't expect interaction just dump output);
+        with an *output* file, it is batch and output goes to the file
         '''
         args = {}
         if root:
             args['user'] = 'root'
-        if not batch and sys.stdin.isatty() and not sys.stdin.closed:
+        if output is None and not batch and sys.stdin.isatty() and not sys.stdin.closed:
             args['interactive'] = args['tty'] = None
         if isinstance(cmd, list):
             cmd = ' '.join(cmd)
-        self.executor.docker.exec_(
-            container, '/bin/bash', '-c', cmd, **args).interactive()
+        exec_cmd = self.executor.docker.exec_(
+            container, '/bin/bash', '-c', cmd, **args)
+        if output is None:
+            exec_cmd.interactive()
+        else:
+            exec_cmd.redirect(stdout=output, stderr=output)
 
-    def get_container_id(self, name):
-        'get the container id of a running instance, or None if no instance is running'
-        return self.executor.docker.ps(
-            quiet=None, filter="name=" + name).batch()[0].strip() or None
+    def _try_api(self, method_name, *args):
+        '''
+        Call *method_name* on the Docker API client, returning _NO_API
+        if there is no client or the call failed, in which case the
+        CLI should be used.
+        '''
+        if self.docker_api is None:
+            return _NO_API
+        try:
+            with self.logger.debug('docker_api_' + method_name, args=args):
+                return getattr(self.docker_api, method_name)(*args)
+        except docker_api.FALLBACK_ERRORS:
+            return _NO_API
+
+    def get_container_id(self, name, all=False):
+        '''
+        get the container id of a running instance, or None if no instance
+        is running; with *all*, stopped instances are included
+        '''
+        ids = self._try_api('get_container_ids', {'name': [name]}, all)
+        if ids is not _NO_API:
+            return '\n'.join(ids) or None
+        kwargs = {'quiet': None, 'filter': 'name=' + name}
+        if all:
+            kwargs['all'] = None
+        return self.executor.docker.ps(**kwargs).batch()[0].strip() or None
 
     def get_port_container_id(self, port):
+        ids = self._try_api('get_container_ids', {'publish': [str(port)]})
+        if ids is not _NO_API:
+            return '\n'.join(ids) or None
         filter_str = "publish=%s" % port
         _cmd = self.executor.docker.ps(quiet=None, filter=filter_str)
         res = _cmd.batch()  # NOTE: docker version 17.06+ ok
         return res[0].strip() or None
 
+    def get_published_ports(self):
+        '''
+        Map of host port to the id of the running container publishing
+        it, from a single "docker ps".
+        '''
+        ret = self._try_api('get_published_ports')
+        if ret is not _NO_API:
+            return ret
+        output = self.executor.docker.ps(
+            format='{{.ID}}\t{{.Ports}}').batch()[0]
+        return parse_ps_ports(output)
+
     def get_image_id(self, tag):
         'get the image id if one exists with the given tag'
+        ids = self._try_api('get_image_ids', {'reference': [tag]})
+        if ids is not _NO_API:
+            return '\n'.join(ids) or None
         return self.executor.docker.images(tag, quiet=None).batch()[0].strip() or None
 
 
     def kill(self, container):
-        self.executor.docker.kill(container).redirect()
-        self.executor.docker.rm(container).redirect()
+        if self._try_api('kill', container) is _NO_API:
+            self.executor.docker.kill(container).redirect()
+        if self._try_api('remove_container', container) is _NO_API:
+            self.executor.docker.rm(container).redirect()
 
     def stop(self, container):
-        self.executor.docker.stop(container).redirect()
+        if self._try_api('stop', container) is _NO_API:
+            self.executor.docker.stop(container).redirect()
 
     def _clean_dir(self, path):
         with self.logger.info('clean_dir', path=path):
@@ -290,8 +562,14 @@ class DaemonFixer(object):
     manual intervention but less copy-pasta at the command line.)
     '''
     executor, logger = attr.ib(), attr.ib()
+    docker_api = attr.ib(default=None)
 
     def clean(self):
+        if self.docker_api is not None:
+            try:
+                return self._clean_api()
+            except docker_api.FALLBACK_ERRORS:
+                pass  # whatever is left is cleaned up by the CLI
         containers = self.executor.docker.ps(
             quiet=None, filter="status=exited").batch()[0].split()
         self.executor.docker.rm(*containers).redirect()
@@ -301,6 +579,19 @@ class DaemonFixer(object):
         self.executor.docker.rmi(*images).redirect()
         print('removed images: ' + ','.join(images))
 
+    def _clean_api(self):
+        with self.logger.info('clean_api'):
+            containers = self.docker_api.get_container_ids(
+                {'status': ['exited']}, all=True)
+            for container in containers:
+                self.docker_api.remove_container(container)
+            print('removed containers: ' + ','.join(containers))
+            images = [image['Id'] for image in
+                      self.docker_api.list_images({'dangling': ['true']})]
+            for image in images:
+                self.docker_api.remove_image(image)
+            print('removed images: ' + ','.join(images))
+
     def clock_sync(self):
         '''
         Sync the docker daemon clock up to current clock.
@@ -445,6 +736,9 @@ def in_ensured_docker_machine(executor, name):
 DIR = os.path.dirname(os.path.abspath(__file__))
 
 
+COMPOSE_HELPER_PREFIX = 'sky-compose-helper-'
+COMPOSE_FILE_MIN_AGE = 10 * 60  # seconds
+
 DOCKER_COMPOSE_IMAGE = (
     'GITLAB_HOSTNAME:PORT'
     'open-source/docker-compose-in-docker:'
@@ -0,0 +1,167 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+'''
+A minimal Docker Engine API client, speaking HTTP over the daemon's
+unix socket with a single persistent connection.
+
+Queries like "is this container running" are made often (e.g., while
+waiting for a container), and each "docker" CLI call costs a fork and
+exec plus the CLI's own startup. docker.Runner uses this client where
+it can, and falls back to the CLI if the request fails.
+'''
+import os
+import json
+import socket
+import urllib
+import httplib
+import threading
+
+import attr
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+API_VERSION = 'v1.25'  # docker 1.13+, for the images "reference" filter
+
+_CONNECTION_ERRORS = (socket.error, httplib.HTTPException)
+
+
+class DockerAPIError(Exception):
+    def __init__(self, status, message):
+        super(DockerAPIError, self).__init__(status, message)
+        self.status = status
+        self.message = message
+
+    def __str__(self):
+        return 'docker API error %s: %s' % (self.status, self.message)
+
+
+# the errors after which docker.Runner falls back to the CLI
+FALLBACK_ERRORS = _CONNECTION_ERRORS + (ValueError, DockerAPIError)
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+    def __init__(self, socket_path, timeout):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+@attr.s
+class DockerAPIClient(object):
+    socket_path = attr.ib(default=DEFAULT_SOCKET)
+    timeout = attr.ib(default=60)
+
+    def __attrs_post_init__(self):
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls, use_docker_machine, env=None):
+        '''
+        Returns a client for the local docker daemon, or None if docker
+        is configured to talk to something other than a local unix
+        socket (docker-machine, a TCP DOCKER_HOST).
+        '''
+        env = os.environ if env is None else env
+        if use_docker_machine:
+            return None
+        docker_host = env.get('DOCKER_HOST')
+        if not docker_host:
+            socket_path = DEFAULT_SOCKET
+        elif docker_host.startswith('unix://'):
+            socket_path = docker_host[len('unix://'):]
+        else:
+            return None
+        if not os.access(socket_path, os.R_OK | os.W_OK):
+            return None
+        return cls(socket_path)
+
+    def request(self, method, path, query=None):
+        '''
+        Make a request, returning the decoded JSON response (None for
+        empty responses). Raises DockerAPIError for error statuses.
+        '''
+        url = '/' + API_VERSION + path
+        if query:
+            url += '?' + urllib.urlencode(query)
+        with self._lock:
+            # the daemon may have closed an idle connection, so a
+            # failure on a reused connection gets one retry
+            for retry in (True, False):
+                reused = self._conn is not None
+                if not reused:
+                    self._conn = UnixHTTPConnection(self.socket_path, self.timeout)
+                try:
+                    self._conn.request(method, url)
+                    resp = self._conn.getresponse()
+                    body = resp.read()
+                    break
+                except _CONNECTION_ERRORS:
+                    self._conn.close()
+                    self._conn = None
+                    if not (retry and reused):
+                        raise
+        if resp.status >= 400:
+            try:
+                message = json.loads(body)['message']
+            except (ValueError, KeyError, TypeError):
+                message = body
+            raise DockerAPIError(resp.status, message)
+        return json.loads(body) if body.strip() else None
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def list_containers(self, filters=None, all=False):
+        query = {'all': int(all)}
+        if filters:
+            query['filters'] = json.dumps(filters)
+        return self.request('GET', '/containers/json', query)
+
+    def list_images(self, filters=None):
+        query = {'filters': json.dumps(filters)} if filters else None
+        return self.request('GET', '/images/json', query)
+
+    # The following return the same values as the CLI commands
+    # docker.Runner used before, so the two are interchangeable.
+
+    def get_container_ids(self, filters, all=False):
+        'like "docker ps --quiet --filter ..."'
+        containers = self.list_containers(filters, all=all)
+        return [_short_id(c['Id']) for c in containers]
+
+    def get_published_ports(self):
+        ret = {}
+        for container in self.list_containers():
+            for port in container.get('Ports') or []:
+                if port.get('PublicPort'):
+                    ret[port['PublicPort']] = _short_id(container['Id'])
+        return ret
+
+    def get_image_ids(self, filters):
+        'like "docker images --quiet --filter ..."'
+        return [_short_id(image['Id']) for image in self.list_images(filters)]
+
+    def stop(self, container):
+        # 304 means it was already stopped
+        self.request('POST', '/containers/%s/stop' % urllib.quote(container))
+
+    def kill(self, container):
+        self.request('POST', '/containers/%s/kill' % urllib.quote(container))
+
+    def remove_container(self, container):
+        self.request('DELETE', '/containers/%s' % urllib.quote(container))
+
+    def remove_image(self, image):
+        self.request('DELETE', '/images/%s' % urllib.quote(image))
+
+
+def _short_id(docker_id):
+    return docker_id.split(':')[-1][:12]
@@ -0,0 +1,32 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+'''
+Fingerprints of directory trees, e.g. the migrations of a project.
+
+setup compares them on the host to skip the migrations stage, and
+main.py in the image to skip applying migrations a database already
+has, so both have to use the same algorithm: this module is also
+shipped into the image as /home/app/sky_fingerprint.py, which means
+it may only use the standard library.
+'''
+import os
+import hashlib
+
+
+def fingerprint_tree(path, exclude=()):
+    '''
+    Hash of the relative paths and contents of the files under *path*,
+    skipping .pyc files and the directories at the paths in *exclude*.
+    '''
+    digest = hashlib.sha1()
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames[:] = sorted([dirname for dirname in dirnames
+                              if os.path.join(dirpath, dirname) not in exclude])
+        for filename in sorted(filenames):
+            if filename.endswith('.pyc'):
+                continue
+            file_path = os.path.join(dirpath, filename)
+            digest.update(os.path.relpath(file_path, path) + '\0')
+            with open(file_path, 'rb') as f:
+                digest.update(hashlib.sha1(f.read()).digest())
+    return digest.hexdigest()
@@ -8,12 +8,16 @@ import socket
 import subprocess
 import atexit
 import json
+import threading
 
+from sky_fingerprint import fingerprint_tree  # opensky/fingerprint.py
 
 CONFIG = json.load(open(
     os.path.dirname(os.path.abspath(__file__)) + '/config.json'))
 NAME = CONFIG['project_name']
 DEPENDS_ON = CONFIG['start_depends_on']
+PYTEST_CACHE_DIR = '/home/app/.pytest_cache'
+PROFILE_DATA_DIR = '/home/app/profile-data'  # mounted from build/profile
 
 
 class SubprocessError(SystemExit, Exception):
@@ -120,6 +124,143 @@ def run_cmd(*argv):
         raise spe
 
 
+def run_in_threads(*funcs):
+    'run each of *funcs* in its own thread, re-raising the first error'
+    errors = []
+    def run(func):
+        try:
+            func()
+        except BaseException:  # SubprocessError is a SystemExit
+            errors.append(sys.exc_info())
+    threads = [threading.Thread(target=run, args=(func,)) for func in funcs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+
+
+def seed_zookeeper(zk, paths):
+    '''
+    Create the nodes at *paths* that don't exist yet, along with their
+    missing parents, in a few round trips: the existence checks of
+    every node are pipelined, then all missing nodes are created in one
+    transaction. Returns (# of paths created, # already present).
+    '''
+    paths = set(paths)
+    nodes = set()
+    for path in paths:
+        while path not in nodes and path.count('/') > 1:
+            nodes.add(path)
+            path = path.rsplit('/', 1)[0]
+        nodes.add(path)
+    checks = [(node, zk.exists_async(node)) for node in nodes]
+    missing = [node for node, check in checks if check.get() is None]
+    if missing:
+        transaction = zk.transaction()
+        for node in sorted(missing, key=lambda node: node.count('/')):
+            transaction.create(node)  # parents before children
+        results = transaction.commit()
+        if any([isinstance(res, Exception) for res in results]):
+            # something else created some of the nodes in the
+            # meantime; the transaction was rolled back
+            for path in sorted(paths):
+                zk.ensure_path(path)
+    created = len(paths.intersection(missing))
+    return created, len(paths) - created
+
+
+# the fingerprint of the last applied migrations is kept in the
+# database itself, so it goes away along with the data
+MIGRATIONS_PATH = '/home/app/{}/migrations'.format(NAME)
+
+
+def get_migrate_version_table():
+    'name of the table sqlalchemy-migrate keeps the db version in'
+    import ConfigParser
+    migrate_cfg = ConfigParser.RawConfigParser()
+    migrate_cfg.read(MIGRATIONS_PATH + '/migrate.cfg')
+    try:
+        return migrate_cfg.get('db_settings', 'version_table')
+    except ConfigParser.Error:
+        return 'migrate_version'
+
+
+def migrate_mysql():
+    import sqlalchemy as sa
+    DBNAME = CONFIG['db_name']
+    print "connecting to mysql with user root"
+    wait_for('mysql', 3306, 30)
+    engine = sa.create_engine('mysql://root@mysql')
+    conn = engine.connect()
+    conn.execute('SELECT 1')
+    print "SELECT 1 works"
+    conn.execute('commit')
+    print "creating database", DBNAME
+    conn.execute('CREATE DATABASE IF NOT EXISTS ' + DBNAME)
+    conn.execute('CREATE DATABASE IF NOT EXISTS sky_setup')
+    conn.execute('CREATE TABLE IF NOT EXISTS sky_setup.migrations'
+                 ' (db_name VARCHAR(64) PRIMARY KEY, fingerprint CHAR(40))')
+    fingerprint = fingerprint_tree(
+        MIGRATIONS_PATH, exclude=[MIGRATIONS_PATH + '/cassandra'])
+    applied = conn.execute(
+        'SELECT fingerprint FROM sky_setup.migrations WHERE db_name = %s',
+        DBNAME).scalar()
+    if applied == fingerprint:
+        print "mysql migrations unchanged, skipping"
+        conn.close()
+        return
+    # setup doesn't start from a fresh database, and version_control
+    # fails on one that is already under version control
+    is_controlled = engine.dialect.has_table(
+        conn, get_migrate_version_table(), schema=DBNAME)
+    print "running migration scripts"
+    db_url = "mysql://root@mysql/" + DBNAME
+    if not is_controlled:
+        # mark database as under version control
+        run_py("migrations/manage.py", "version_control", db_url,
+               cwd="/home/app/" + NAME)
+    # upgrade to latest version
+    run_py("migrations/manage.py", "upgrade", db_url,
+           cwd="/home/app/" + NAME)
+    conn.execute('REPLACE INTO sky_setup.migrations (db_name, fingerprint)'
+                 ' VALUES (%s, %s)', DBNAME, fingerprint)
+    conn.close()
+
+
+def migrate_cassandra():
+    import cdeploy.migrator
+    from cassandra.cluster import Cluster
+    wait_for('cassandra', 9042, 30)
+    cluster = Cluster(['cassandra'])
+    session = cluster.connect()
+    session.execute(
+        "CREATE KEYSPACE IF NOT EXISTS sky_setup WITH replication ="
+        " {'class': 'SimpleStrategy', 'replication_factor': 1}")
+    session.execute('CREATE TABLE IF NOT EXISTS sky_setup.migrations'
+                    ' (name text PRIMARY KEY, fingerprint text)')
+    fingerprint = fingerprint_tree(MIGRATIONS_PATH + '/cassandra')
+    rows = list(session.execute(
+        'SELECT fingerprint FROM sky_setup.migrations WHERE name = %s', [NAME]))
+    if rows and rows[0].fingerprint == fingerprint:
+        print "cassandra migrations unchanged, skipping"
+        cluster.shutdown()
+        return
+    print "running cassandra migrations"
+    argv_bak = sys.argv  # temporarily change sys.argv
+    sys.argv = [  # simulate a command-line call
+        'cdeploy', MIGRATIONS_PATH + '/cassandra']
+    try:
+        cdeploy.migrator.main()
+    finally:
+        sys.argv = argv_bak
+    session.execute(
+        'INSERT INTO sky_setup.migrations (name, fingerprint) VALUES (%s, %s)',
+        [NAME, fingerprint])
+    cluster.shutdown()
+
+
 try:  # TODO: is this still needed?
     os.makedirs('/home/app/' + NAME)
 except OSError:
@@ -129,54 +270,34 @@ except OSError:
 cmd = sys.argv[1]
 finished = True
 if cmd == 'SETUP':
-    if 'mysql' in DEPENDS_ON:
-        import sqlalchemy as sa
-        DBNAME = CONFIG['db_name']
-        print "connecting to mysql with user root"
-        wait_for('mysql', 3306, 30)
-        engine = sa.create_engine('mysql://root@mysql')
-        conn = engine.connect()
-        conn.execute('SELECT 1')
-        print "SELECT 1 works"
-        conn.execute('commit')
-        print "creating database", DBNAME
-        conn.execute('CREATE DATABASE IF NOT EXISTS ' + DBNAME)
-        conn.close()
-        print "running migration scripts"
-        db_url = "mysql://root@mysql/" + DBNAME
-        # mark database as under version control
-        run_py("migrations/manage.py", "version_control", db_url,
-               cwd="/home/app/" + NAME)
-        # upgrade to latest version
-        run_py("migrations/manage.py", "upgrade", db_url,
-               cwd="/home/app/" + NAME)
+    # the stages to run (sky setup skips unchanged ones), default all
+    stages = sys.argv[2:] or ['migrations', 'zookeeper']
+    if 'migrations' not in stages:
+        print "migrations unchanged, skipping"
     else:
-        print "no database dependency, skipping mysql"
-    if 'cassandra' in DEPENDS_ON:
-        import cdeploy.migrator
-        wait_for('cassandra', 9042, 30)
-        print "running cassandra migrations"
-        argv_bak = sys.argv  # temporarily change sys.argv
-        sys.argv = [  # simulate a command-line call
-            'cdeploy',
-            '/home/app/{}/migrations/cassandra'.format(NAME)]
-        cdeploy.migrator.main()
-        sys.argv = argv_bak
-    print "setting up zookeeper"
-    wait_for('zookeeper', 2181, 30)
+        tracks = []
+        if 'mysql' in DEPENDS_ON:
+            tracks.append(migrate_mysql)
+        else:
+            print "no database dependency, skipping mysql"
+        if 'cassandra' in DEPENDS_ON:
+            tracks.append(migrate_cassandra)
+        run_in_threads(*tracks)
+    if 'zookeeper' in stages:
+        print "setting up zookeeper"
+        wait_for('zookeeper', 2181, 30)
 
-    from kazoo.client import KazooClient
-
-    SERVICE_ENDPOINTS = CONFIG['host_ports']
-    print 'connecting to zookeeper'
-    zk = KazooClient(hosts='zookeeper:2181')
-    zk.start()
-    for service, paths in SERVICE_ENDPOINTS.items():
-        for path in paths:
-            full_path = '/services/cluster_local/' + service + '/' + path
-            if not zk.exists(full_path):
-                zk.create(full_path, makepath=True)
-    zk.stop()
+        from kazoo.client import KazooClient
+
+        SERVICE_ENDPOINTS = CONFIG['host_ports']
+        print 'connecting to zookeeper'
+        zk = KazooClient(hosts='zookeeper:2181')
+        zk.start()
+        created, present = seed_zookeeper(zk, [
+            '/services/cluster_local/' + service + '/' + path
+            for service, paths in SERVICE_ENDPOINTS.items() for path in paths])
+        print 'created', created, 'zookeeper nodes,', present, 'already present'
+        zk.stop()
     print 'setup complete'
 elif cmd == 'START':
     if 'mysql' in DEPENDS_ON:
@@ -186,7 +307,7 @@ elif cmd == 'START':
         wait_for('cassandra', 9042, 30)
     run_py('-m', NAME, '--nodaemon',
            '--flagfile=/home/app/development-flags')
-elif cmd == 'START_DEBUG':
+elif cmd in ('START_DEBUG', 'START_PROFILE'):
     # TODO: argparse/dedupe
     if 'mysql' in DEPENDS_ON:
         wait_for('mysql', 3306, 30)
@@ -194,16 +315,28 @@ elif cmd == 'START_DEBUG':
     if 'cassandra' in DEPENDS_ON:
         wait_for('cassandra', 9042, 30)
     env = dict(os.environ)
+    # the sitecustomize.py in the hook dir is loaded ahead of the app
+    if cmd == 'START_DEBUG':
+        hook_dir = '/home/app/debug'
+    else:
+        hook_dir = '/home/app/profile'
+        env['SKY_PROFILE_DIR'] = PROFILE_DATA_DIR
+        env['SKY_PROFILE_MODE'] = sys.argv[2] if len(sys.argv) > 2 else 'cpu'
     py_path = env.get('PYTHONPATH', '')
-    py_path = '/home/app/debug:' + py_path if py_path else '/home/app/debug'
+    py_path = hook_dir + ':' + py_path if py_path else hook_dir
     env['PYTHONPATH'] = py_path
     run_py('-m', NAME, '--nodaemon',
            '--flagfile=/home/app/development-flags',
            cwd='/home/app', env=env)
-elif cmd == 'TEST':
-    run_py('-m', 'pytest', '/home/app/' + NAME)
-elif cmd == 'TEST_PDB':
-    run_py('-m', 'pytest', '/home/app/' + NAME, '-s', '--pdb')
+elif cmd in ('TEST', 'TEST_PDB'):
+    # the rest of argv is pytest options followed by the paths to test;
+    # the cache is in a volume so --lf/--ff and durations carry over
+    pytest_args = sys.argv[2:] or ['/home/app/' + NAME]
+    if cmd == 'TEST_PDB':
+        pytest_args = ['-s', '--pdb'] + pytest_args
+    run_py(*(['-m', 'pytest', '-p', 'sky_pytest_plugin',
+              '-o', 'cache_dir=' + PYTEST_CACHE_DIR] + pytest_args),
+           cwd='/home/app')
 elif cmd == 'RUN_LIVE':
     env_type = os.environ.get('ENV_TYPE') or 'prod'
     if env_type == 'stage':
@@ -220,9 +353,11 @@ elif cmd == 'INT_TEST':
     endpoint = CONFIG['host_ports'][NAME][0].split(':')
     # TODO: better parsing of sub-args
     wait_for(endpoint[0], int(endpoint[1]), 60)
-    run_py(*(
-        ['-m', 'pytest'] + sys.argv[2:] +
-        ['/home/app/integration_test/']))
+    pytest_args = sys.argv[2:]
+    if not [arg for arg in pytest_args
+            if arg.startswith('/home/app/integration_test/')]:
+        pytest_args.append('/home/app/integration_test/')
+    run_py(*(['-m', 'pytest'] + pytest_args))
 elif cmd == 'REPL':
     run_py()
 elif cmd == 'POPULATE':
@@ -0,0 +1,196 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+'''
+Put on the PYTHONPATH by START_PROFILE ("sky start --profile" or
+"--memprofile"), so it is imported ahead of the service.
+
+In "cpu" SKY_PROFILE_MODE, samples the stacks of all threads on
+SIGPROF, which fires per SKY_PROFILE_INTERVAL seconds of process CPU
+time, so an idle service isn't sampled. Each stack starts with the
+name of its thread. Samples are written every
+SKY_PROFILE_DUMP_INTERVAL seconds and at exit in collapsed stack
+format ("outer;inner;innermost count" per line) to SKY_PROFILE_DIR,
+for "sky profile report".
+
+In "mem" mode, writes a snapshot of the top allocation sites and the
+RSS every SKY_PROFILE_DUMP_INTERVAL seconds and at exit, for "sky
+profile mem-report". Sites are source lines when tracemalloc is
+available; otherwise (python 2.7) they are the types of the objects
+tracked by the gc, which excludes e.g. str, but still finds leaked
+containers and instances.
+'''
+import os
+import gc
+import sys
+import json
+import time
+import atexit
+import signal
+import threading
+import traceback
+from collections import defaultdict
+
+MODE = os.getenv('SKY_PROFILE_MODE') or 'cpu'
+INTERVAL = float(os.getenv('SKY_PROFILE_INTERVAL') or 0.005)
+DUMP_INTERVAL = float(os.getenv('SKY_PROFILE_DUMP_INTERVAL') or
+                      (10 if MODE == 'cpu' else 60))
+TOP_SITES = 500  # per memory snapshot
+OUT_DIR = os.getenv('SKY_PROFILE_DIR') or '/home/app/profile-data'
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, code.co_filename, code.co_firstlineno)
+
+
+class Sampler(object):
+    def __init__(self, path):
+        self.path = path
+        self.counts = defaultdict(int)  # collapsed stack: sample count
+        self._dumper_ident = None
+
+    def start(self, interval, dump_interval):
+        signal.signal(signal.SIGPROF, self.sample)
+        signal.siginterrupt(signal.SIGPROF, False)  # restart syscalls
+        signal.setitimer(signal.ITIMER_PROF, interval, interval)
+        dumper = threading.Thread(
+            name='sky_profile_dump', target=self._dump_loop, args=(dump_interval,))
+        dumper.daemon = True
+        dumper.start()
+        self._dumper_ident = dumper.ident
+        atexit.register(self.stop)
+
+    def sample(self, signum, frame):
+        # signals are handled on the main thread, where *frame* is the
+        # interrupted one; _current_frames() would have this handler
+        frames = sys._current_frames()
+        main_ident = threading.current_thread().ident
+        frames[main_ident] = frame
+        # not enumerate(), its lock may be held by the interrupted frame
+        names = dict([(ident, t.name) for ident, t in threading._active.items()])
+        for ident, frame in frames.items():
+            if ident == self._dumper_ident:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            stack.append(names.get(ident, 'thread-%s' % ident))
+            self.counts[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        self.dump()
+
+    def dump(self):
+        counts = dict(self.counts)  # atomic under the GIL
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for stack, count in counts.items():
+                f.write('%s %d\n' % (stack, count))
+        os.rename(tmp_path, self.path)
+
+    def _dump_loop(self, dump_interval):
+        while True:
+            time.sleep(dump_interval)
+            self.dump()
+
+
+class MemorySnapshotter(object):
+    def __init__(self, out_dir):
+        self.path_tmpl = os.path.join(out_dir, 'mem-%d-%%04d.json' % os.getpid())
+        self.count = 0
+        self._lock = threading.Lock()
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        self.tracemalloc = tracemalloc
+
+    def start(self, dump_interval):
+        if self.tracemalloc:
+            self.tracemalloc.start()
+        self.snapshot()  # the baseline
+        snapshotter = threading.Thread(
+            name='sky_memprofile', target=self._snapshot_loop, args=(dump_interval,))
+        snapshotter.daemon = True
+        snapshotter.start()
+        atexit.register(self.snapshot)
+
+    def snapshot(self):
+        if self.tracemalloc:
+            method, sites = 'tracemalloc', self._get_tracemalloc_sites()
+        else:
+            method, sites = 'gc', _get_gc_sites()
+        sites.sort(key=lambda site: site['size'], reverse=True)
+        data = {'pid': os.getpid(), 'time': time.time(), 'method': method,
+                'rss': _get_rss(), 'sites': sites[:TOP_SITES]}
+        with self._lock:
+            path = self.path_tmpl % self.count
+            self.count += 1
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.rename(path + '.tmp', path)
+
+    def _get_tracemalloc_sites(self):
+        stats = self.tracemalloc.take_snapshot().statistics('lineno')
+        return [{'site': '%s:%s' % (stat.traceback[0].filename,
+                                    stat.traceback[0].lineno),
+                 'size': stat.size, 'count': stat.count} for stat in stats]
+
+    def _snapshot_loop(self, dump_interval):
+        while True:
+            time.sleep(dump_interval)
+            try:
+                self.snapshot()
+            except Exception:  # keep taking the later ones
+                sys.stderr.write('sky profile: memory snapshot failed\n')
+                traceback.print_exc()
+
+
+def _get_gc_sites():
+    'size and count of the objects tracked by the gc, by type'
+    sizes, counts = defaultdict(int), defaultdict(int)
+    for obj in gc.get_objects():
+        # type() of an old-style instance is just "instance"; __class__
+        # can raise anything, e.g. ReferenceError for a dead weakref.proxy
+        try:
+            obj_type = obj.__class__
+        except Exception:
+            obj_type = type(obj)
+        site = '%s.%s' % (getattr(obj_type, '__module__', '?'), obj_type.__name__)
+        sizes[site] += sys.getsizeof(obj, 0)
+        counts[site] += 1
+    return [{'site': site, 'size': size, 'count': counts[site]}
+            for site, size in sizes.items()]
+
+
+def _get_rss():
+    'resident set size in bytes, None if unknown'
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def _start():
+    if not os.path.isdir(OUT_DIR):
+        os.makedirs(OUT_DIR)
+    if MODE == 'mem':
+        snapshotter = MemorySnapshotter(OUT_DIR)
+        snapshotter.start(DUMP_INTERVAL)
+        sys.stderr.write('sky profile: memory snapshots every %gs (%s) to %s\n'
+                         % (DUMP_INTERVAL, 'tracemalloc' if snapshotter.tracemalloc
+                            else 'gc', OUT_DIR))
+        return
+    path = os.path.join(OUT_DIR, 'cpu-%s.collapsed' % os.getpid())
+    Sampler(path).start(INTERVAL, DUMP_INTERVAL)
+    sys.stderr.write('sky profile: sampling every %gs of cpu time to %s\n'
+                     % (INTERVAL, path))
+
+
+_start()
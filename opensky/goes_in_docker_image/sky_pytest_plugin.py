@@ -0,0 +1,43 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+'''
+pytest plugin loaded by "sky test". Records how long each test module
+takes in the pytest cache (persisted in a volume between runs), and
+runs the slowest modules first, so that with pytest-xdist a long
+module doesn't start last and hold up the whole run.
+'''
+from collections import defaultdict
+
+DURATIONS_KEY = 'sky/durations'
+
+
+def pytest_configure(config):
+    config.pluginmanager.register(DurationScheduler(config), 'sky_durations')
+
+
+class DurationScheduler(object):
+    def __init__(self, config):
+        self.config = config
+        self.durations = config.cache.get(DURATIONS_KEY, {})
+        self.run_durations = defaultdict(float)
+
+    def pytest_collection_modifyitems(self, session, config, items):
+        # the sort is stable and by module, to keep module and class
+        # fixtures together; new modules go first, they might be slow
+        items.sort(key=lambda item: -self.durations.get(
+            _module_id(item.nodeid), float('inf')))
+
+    def pytest_runtest_logreport(self, report):
+        # with xdist, the master gets the reports of every worker
+        self.run_durations[_module_id(report.nodeid)] += report.duration
+
+    def pytest_sessionfinish(self, session):
+        if hasattr(self.config, 'slaveinput'):
+            return  # xdist worker
+        durations = dict(self.durations)
+        durations.update(self.run_durations)
+        self.config.cache.set(DURATIONS_KEY, durations)
+
+
+def _module_id(nodeid):
+    return nodeid.split('::', 1)[0]
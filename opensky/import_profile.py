@@ -0,0 +1,87 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+'''
+Per-module import timing, for tracking the fixed startup latency every
+sky command pays. Enabled by setting SKY_IMPORT_TIMES in the
+environment (see opensky/__main__.py). The report is written to stderr
+at exit in the same format as python 3.7's "-X importtime", so the
+same tools can read both.
+
+"sky self bench-startup" runs sky with this enabled and summarizes
+the results.
+'''
+import sys
+import time
+import atexit
+import __builtin__
+
+_orig_import = None
+_child_times = []  # per active import, the time spent in nested imports
+_records = []  # (depth, name, self_us, cumulative_us), children first
+
+
+def install(out=None):
+    global _orig_import
+    if _orig_import is not None:
+        return
+    _orig_import = __builtin__.__import__
+    __builtin__.__import__ = _timed_import
+    atexit.register(dump, out or sys.stderr)
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    is_new = name not in sys.modules
+    module_count = len(sys.modules)
+    start = time.time()
+    _child_times.append(0.0)
+    try:
+        return _orig_import(name, globals, locals, fromlist, level)
+    finally:
+        cumulative = time.time() - start
+        child_time = _child_times.pop()
+        if _child_times:
+            _child_times[-1] += cumulative
+        if is_new and len(sys.modules) > module_count:
+            name = _resolve_name(name, globals, level)
+            _records.append((len(_child_times), name,
+                             int((cumulative - child_time) * 1e6),
+                             int(cumulative * 1e6)))
+
+
+def _resolve_name(name, globals, level):
+    # python 2 implicit relative imports: "import cmd" in opensky
+    # may have been opensky.cmd
+    if level == 0 or not globals:
+        return name
+    package = globals.get('__package__') or globals.get('__name__', '')
+    if '__path__' not in globals and not globals.get('__package__'):
+        package = package.rpartition('.')[0]
+    # (failed relative lookups leave None placeholders in sys.modules)
+    if package and sys.modules.get(package + '.' + name) is not None:
+        return package + '.' + name
+    return name
+
+
+def dump(out):
+    out.write('import time: self [us] | cumulative | imported package\n')
+    for depth, name, self_us, cumulative_us in _records:
+        out.write('import time: %10d | %10d | %s%s\n'
+                  % (self_us, cumulative_us, '  ' * depth, name))
+    out.flush()
+
+
+def parse_import_times(text):
+    '''
+    Parse "-X importtime" style output, as written by dump(), into a
+    list of dicts with name, depth, self_us and cumulative_us keys.
+    '''
+    ret = []
+    for line in text.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        ret.append({'name': name.strip(),
+                    'depth': (len(name) - len(name.lstrip()) - 1) // 2,
+                    'self_us': int(self_us),
+                    'cumulative_us': int(cumulative_us)})
+    return ret
@@ -4,6 +4,11 @@
 
 import os
 import sys
+import json
+import time
+import atexit
+import threading
+import collections
 
 from lithoxyl import (Logger,
                       StreamEmitter,
@@ -24,6 +29,9 @@ begin_fmt = ('{status_char}+{import_delta_s:.3f}'
 comment_fmt = ('{status_char} - {iso_begin} - {event_message}')
 
 
+# per-workspace action timings, written by JSONLinesSink
+EVENTS_FILE = 'events.jsonl'
+
 sky_log = Logger('sky')
 sky_log.log_file_path = None
 
@@ -41,12 +49,16 @@ def _on_import_log_setup():
                                filters=[stderr_filter])
     sky_log.add_sink(stderr_sink)
     sky_log.add_sink(DevDebugSink(post_mortem=bool(os.getenv('SKY_DEBUG'))))
+    if os.getenv('SKY_TRACE'):
+        sky_log.add_sink(ChromeTraceSink(os.path.abspath(os.getenv('SKY_TRACE'))))
     sky_log.debug('sky_log_initialization').success()
     return
 
 
-def build_file_enabled_logger(log_file):
+def build_file_enabled_logger(log_file, events_file=None):
     # TODO: make idempotent
+    if events_file is not None:
+        sky_log.add_sink(JSONLinesSink(events_file))
     file_emtr = StreamEmitter(log_file)
     file_fmtr = SensibleFormatter(fmt,
                                   comment=comment_fmt,
@@ -67,10 +79,199 @@ def build_file_enabled_logger(log_file):
     return sky_log
 
 
+class JSONLinesSink(object):
+    '''
+    Writes a JSON object per finished action to *stream*, one per
+    line, with the timing and data of the action. Read by "sky perf
+    report".
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self._lock = threading.Lock()
+
+    def on_end(self, end_event):
+        action = end_event.action
+        begin_event = action.begin_event or end_event
+        parent = action.parent_action
+        record = {'id': action.action_id,
+                  'parent_id': parent.action_id if parent else None,
+                  'name': action.name,
+                  'level': action.level.name,
+                  'status': end_event.status,
+                  'begin': begin_event.etime,
+                  'end': end_event.etime,
+                  'duration': end_event.etime - begin_event.etime,
+                  'thread': threading.current_thread().name,
+                  'data': action.data_map}
+        line = json.dumps(record, sort_keys=True, default=repr) + '\n'
+        with self._lock:
+            self.stream.write(line)
+            self.stream.flush()
+
+
+class ChromeTraceSink(object):
+    '''
+    Collects every action (including subprocess calls) as a Chrome
+    Trace Event Format "complete" event, on the thread that began it,
+    and writes them all to *path* as JSON at exit. Load the file in
+    chrome://tracing or a compatible viewer. Enabled with SKY_TRACE=path.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.events = []
+        self._threads = {}  # thread ident: thread name
+        self._begin_tids = {}  # action id: thread ident
+        self._lock = threading.Lock()
+        atexit.register(self.write)
+
+    def on_begin(self, begin_event):
+        thread = threading.current_thread()
+        with self._lock:
+            self._threads[thread.ident] = thread.name
+            self._begin_tids[begin_event.action.action_id] = thread.ident
+
+    def on_end(self, end_event):
+        action = end_event.action
+        begin_event = action.begin_event or end_event
+        thread = threading.current_thread()
+        with self._lock:
+            self._threads.setdefault(thread.ident, thread.name)
+            tid = self._begin_tids.pop(action.action_id, thread.ident)
+            args = dict([(k, repr(v)) for k, v in action.data_map.items()])
+            args['status'] = end_event.status
+            self.events.append({
+                'name': action.name, 'cat': action.level.name, 'ph': 'X',
+                'ts': begin_event.etime * 1e6,
+                'dur': (end_event.etime - begin_event.etime) * 1e6,
+                'pid': self.pid, 'tid': tid, 'args': args})
+
+    def write(self):
+        with self._lock:
+            thread_names = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid,
+                             'tid': tid, 'args': {'name': name}}
+                            for tid, name in self._threads.items()]
+            trace = {'traceEvents': thread_names + self.events,
+                     'displayTimeUnit': 'ms'}
+        with open(self.path, 'w') as f:
+            json.dump(trace, f)
+
+
+def tail_lines(path, count=20, block_size=8192):
+    '''
+    Return the last *count* lines of the file at *path*, reading
+    backwards from the end in *block_size* chunks, so the size of the
+    file doesn't matter.
+    '''
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        data = ''
+        # one extra newline, the last line may end with one
+        while pos > 0 and data.count('\n') <= count:
+            read_size = min(block_size, pos)
+            pos -= read_size
+            f.seek(pos)
+            data = f.read(read_size) + data
+    # not splitlines(), which also splits on the \r of progress bars
+    parts = data.split('\n')
+    lines = [part + '\n' for part in parts[:-1]]
+    if parts[-1]:
+        lines.append(parts[-1])
+    return lines[-count:] if count else []
+
+
+class ProgressRenderer(object):
+    '''
+    Renders one status line per in-progress task (e.g., concurrent
+    downloads) to stderr. Updates are coalesced so the lines are
+    redrawn at most *max_fps* times a second, no matter how often
+    update() is called. When stderr isn't a terminal, only a line at
+    the start and the end of each task is written.
+
+    Other output (e.g., log lines) can land below the drawn lines at
+    any time, so after note_write() the next draw starts below it
+    instead of moving the cursor back up over it.
+    '''
+    def __init__(self, max_fps=10, is_tty=None):
+        self.min_interval = 1.0 / max_fps
+        if is_tty is None:
+            is_tty = sys.stderr.isatty()
+        self.is_tty = is_tty
+        self._active = collections.OrderedDict()  # key: status text
+        self._finished = []
+        self._drawn_count = 0
+        self._last_draw = 0
+        self._writer = None  # the thread in _write()
+        self._lock = threading.Lock()
+
+    def update(self, key, text):
+        with self._lock:
+            is_new = key not in self._active
+            self._active[key] = text
+            if not self.is_tty:
+                if is_new:
+                    self._write(text + '\n')
+            elif time.time() - self._last_draw >= self.min_interval:
+                self._draw()
+
+    def finish(self, key, text=None):
+        'write the final status for *key*, and stop drawing it'
+        with self._lock:
+            text = text or self._active.get(key, '')
+            self._active.pop(key, None)
+            if not self.is_tty:
+                self._write(text + '\n')
+                return
+            self._finished.append(text)
+            self._draw()
+
+    def note_write(self):
+        'called by CompactFormatter for every write to stderr and stdout'
+        if self._writer is not threading.current_thread():
+            self._drawn_count = 0
+
+    def _draw(self):
+        out = []
+        if self._drawn_count:  # back to the top of the last drawn lines
+            out.append('\x1b[%dA' % self._drawn_count)
+        for text in self._finished + self._active.values():
+            out.append('\r' + text + '\x1b[K\n')
+        out.append('\x1b[J')  # clear lines of tasks since finished
+        self._write(''.join(out))
+        self._drawn_count = len(self._active)
+        self._finished = []
+        self._last_draw = time.time()
+
+    def _write(self, text):
+        # looked up each time, so output goes through CompactFormatter
+        self._writer = threading.current_thread()
+        try:
+            sys.stderr.write(text)
+            sys.stderr.flush()
+        finally:
+            self._writer = None
+
+
+_PROGRESS = []
+
+
+def get_progress_renderer():
+    'the ProgressRenderer shared by everything writing to stderr'
+    if not _PROGRESS:
+        _PROGRESS.append(ProgressRenderer())
+    return _PROGRESS[0]
+
+
 class CompactFormatter(object):
-    'overwrites begin logs with end logs; a singleton since it messes with stderr'
+    '''
+    overwrites begin logs with end logs; a singleton since it messes with
+    stderr. When stderr isn't a terminal, end logs always go on their
+    own line instead.
+    '''
     def __init__(self):
         self.sensible = SensibleFormatter(fmt, begin=begin_fmt, comment=comment_fmt)
+        self.is_tty = sys.stderr.isatty()
         self.on_blank_line = True
         self.last_print_was_begin = False
         self.last_begin_action_id = None
@@ -108,7 +309,7 @@ class CompactFormatter(object):
     def on_end(self, end_event):
         line = self.sensible.on_end(end_event)
         if not self.on_blank_line:
-            if (self.last_print_was_begin and
+            if (self.is_tty and self.last_print_was_begin and
                     end_event.action_id == self.last_begin_action_id):
                 line = '\r' + line
             else:
@@ -120,6 +321,8 @@ class CompactFormatter(object):
         return line
 
     def _stderr_write(self, msg):
+        for progress in _PROGRESS:
+            progress.note_write()
         if self.expecting_write:
             self.expecting_write = False
         else:
@@ -127,6 +330,8 @@ class CompactFormatter(object):
         self.stderr.write(msg)
 
     def _stdout_write(self, msg):
+        for progress in _PROGRESS:
+            progress.note_write()
         self._flush()
         self.stdout.write(msg)
 
@@ -0,0 +1,101 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+'''
+Commands for finding where sky spends its time, based on the action
+timings each command records to events.jsonl in its workspace.
+'''
+import os
+import json
+import argparse
+
+from opensky import plugins, workspace
+from opensky.log import EVENTS_FILE
+
+
+@plugins.register_command(
+    name='perf',
+    help='report on where time went in recent sky commands',
+    requires=('global_sky_path',))
+def perf_plugin(argv, reqs):
+    prs = argparse.ArgumentParser(prog='perf')
+    subprs = prs.add_subparsers(dest='cmd')
+    subprs.required = True
+
+    report_prs = subprs.add_parser(
+        'report', description='aggregate action timings across workspaces')
+    report_prs.add_argument('-n', '--workspaces', type=int, default=10,
+                            help='number of most recent workspaces to include')
+    report_prs.add_argument('--top', type=int, default=25)
+    report_prs.add_argument('--json', action='store_true')
+    report_prs.set_defaults(func=perf_report)
+
+    args = prs.parse_args(argv[1:])
+    return args.func(args, reqs)
+
+
+def perf_report(args, reqs):
+    workdir = reqs.global_sky_path + '/workspace'
+    ws_names = [fn for _, fn in workspace.list_workspaces(workdir)]
+    events_paths = [os.path.join(workdir, fn, EVENTS_FILE)
+                    for fn in ws_names[-args.workspaces:]]
+    events_paths = [path for path in events_paths if os.path.exists(path)]
+    stats = aggregate_events([load_events(path) for path in events_paths])
+    stats = stats[:args.top]
+    if args.json:
+        print json.dumps(stats, indent=2, sort_keys=True)
+        return
+    if not stats:
+        print 'no action timings found in the last %s workspaces' % args.workspaces
+        return
+    print 'action timings from %s workspaces:' % len(events_paths)
+    print
+    print '%8s %10s %10s %10s %8s  %s' % (
+        'count', 'total s', 'self s', 'max s', 'failed', 'action')
+    for stat in stats:
+        print '%8d %10.2f %10.2f %10.2f %8d  %s' % (
+            stat['count'], stat['total'], stat['self'], stat['max'],
+            stat['failed'], stat['name'])
+
+
+def load_events(path):
+    ret = []
+    with open(path) as f:
+        for line in f:
+            try:
+                ret.append(json.loads(line))
+            except ValueError:
+                continue  # partially written by a killed command
+    return ret
+
+
+def aggregate_events(event_lists):
+    '''
+    Aggregate the action events of several commands (one list of
+    events per command) by action name. Subprocess actions, which are
+    named after their command line, are grouped by the first two
+    words ("docker build", "git fetch"). Returns a list of stat dicts,
+    most total time first. "self" time excludes time spent in child
+    actions, so it isn't counted twice.
+    '''
+    by_name = {}
+    for events in event_lists:
+        child_time = {}
+        for event in events:
+            if event['parent_id'] is not None:
+                child_time[event['parent_id']] = (
+                    child_time.get(event['parent_id'], 0) + event['duration'])
+        for event in events:
+            name = ' '.join(event['name'].split()[:2])
+            stat = by_name.setdefault(name, {'name': name, 'count': 0,
+                                             'total': 0.0, 'self': 0.0,
+                                             'max': 0.0, 'failed': 0})
+            stat['count'] += 1
+            stat['total'] += event['duration']
+            # threads (e.g., parallel pulls) can make children add up
+            # to more than their parent
+            stat['self'] += max(
+                0.0, event['duration'] - child_time.get(event['id'], 0))
+            stat['max'] = max(stat['max'], event['duration'])
+            if event['status'] != 'success':
+                stat['failed'] += 1
+    return sorted(by_name.values(), key=lambda s: s['total'], reverse=True)
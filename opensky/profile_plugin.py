@@ -0,0 +1,235 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+'''
+Commands for inspecting the profiles written by "sky start --profile"
+and "sky start --memprofile" to the build/profile directory of the
+project.
+'''
+import cgi
+import glob
+import json
+import argparse
+from collections import defaultdict
+
+from opensky import plugins
+
+
+@plugins.register_command(
+    name='profile',
+    help='report on profiles recorded by "sky start --profile/--memprofile"',
+    maybe_requires=('project_dir',))
+def profile_plugin(argv, reqs):
+    prs = argparse.ArgumentParser(prog='profile')
+    subprs = prs.add_subparsers(dest='cmd')
+    subprs.required = True
+
+    report_prs = subprs.add_parser(
+        'report', description='top functions by cpu samples')
+    report_prs.add_argument('--dir', help='profile directory'
+                            ' (default: build/profile of the project)')
+    report_prs.add_argument('--top', type=int, default=25)
+    report_prs.add_argument('--flamegraph', metavar='SVG_PATH',
+                            help='also write a flame graph to this path')
+    report_prs.add_argument('--json', action='store_true')
+    report_prs.set_defaults(func=profile_report)
+
+    mem_prs = subprs.add_parser(
+        'mem-report', description='top changes in allocations between two'
+        ' memory snapshots of a process (by default its first and last)')
+    mem_prs.add_argument('--dir', help='profile directory'
+                         ' (default: build/profile of the project)')
+    mem_prs.add_argument('--pid', type=int,
+                         help='process to report on (default: the latest)')
+    mem_prs.add_argument('--from', dest='from_index', type=int, default=0,
+                         help='index of the earlier snapshot')
+    mem_prs.add_argument('--to', dest='to_index', type=int, default=-1,
+                         help='index of the later snapshot')
+    mem_prs.add_argument('--top', type=int, default=25)
+    mem_prs.add_argument('--json', action='store_true')
+    mem_prs.set_defaults(func=mem_report)
+
+    args = prs.parse_args(argv[1:])
+    return args.func(args, reqs)
+
+
+def profile_report(args, reqs):
+    profile_dir = args.dir or reqs.build_project_dir() + '/build/profile'
+    paths = sorted(glob.glob(profile_dir + '/cpu-*.collapsed'))
+    stacks = load_collapsed(paths)
+    stats = aggregate_stacks(stacks)[:args.top]
+    if args.flamegraph:
+        with open(args.flamegraph, 'w') as f:
+            f.write(render_flamegraph(stacks))
+    if args.json:
+        print json.dumps(stats, indent=2, sort_keys=True)
+        return
+    if not stacks:
+        print 'no samples found in %s, run "sky start --profile" first' % profile_dir
+        return
+    total = sum(stacks.values())
+    print '%s samples from %s processes:' % (total, len(paths))
+    print
+    print '%8s %7s %8s %7s  %s' % ('self', 'self%', 'total', 'total%', 'function')
+    for stat in stats:
+        print '%8d %6.1f%% %8d %6.1f%%  %s' % (
+            stat['self'], 100.0 * stat['self'] / total,
+            stat['total'], 100.0 * stat['total'] / total, stat['name'])
+    if args.flamegraph:
+        print
+        print 'flame graph written to', args.flamegraph
+
+
+def mem_report(args, reqs):
+    profile_dir = args.dir or reqs.build_project_dir() + '/build/profile'
+    snapshots = load_mem_snapshots(profile_dir)
+    if not snapshots:
+        print 'no memory snapshots found in %s, run "sky start --memprofile" first' % profile_dir
+        return
+    pid = args.pid or max(snapshots, key=lambda pid: snapshots[pid][-1]['time'])
+    if pid not in snapshots:
+        raise SystemExit('no memory snapshots for pid %s, found: %s'
+                         % (pid, ', '.join(map(str, sorted(snapshots)))))
+    count = len(snapshots[pid])
+    for index in (args.from_index, args.to_index):
+        if not -count <= index < count:
+            raise SystemExit('no snapshot %s for pid %s, it has %s (0 to %s)'
+                             % (index, pid, count, count - 1))
+    old, new = snapshots[pid][args.from_index], snapshots[pid][args.to_index]
+    diffs = diff_mem_snapshots(old, new)[:args.top]
+    if args.json:
+        print json.dumps(diffs, indent=2, sort_keys=True)
+        return
+    print 'pid %s, %s allocation sites, %.0fs between snapshots' % (
+        pid, new['method'], new['time'] - old['time'])
+    if old['rss'] is not None and new['rss'] is not None:
+        print 'rss %s -> %s (%s)' % (_fmt_size(old['rss']), _fmt_size(new['rss']),
+                                    _fmt_size(new['rss'] - old['rss'], sign=True))
+    print
+    print '%10s %10s %10s %10s  %s' % ('size', 'change', 'count', 'change', 'site')
+    for diff in diffs:
+        print '%10s %10s %10d %+10d  %s' % (
+            _fmt_size(diff['size']), _fmt_size(diff['size_diff'], sign=True),
+            diff['count'], diff['count_diff'], diff['site'])
+
+
+def load_mem_snapshots(profile_dir):
+    'the memory snapshots in *profile_dir* by pid, each list in order taken'
+    ret = defaultdict(list)
+    for path in sorted(glob.glob(profile_dir + '/mem-*.json')):
+        with open(path) as f:
+            snapshot = json.load(f)
+        ret[snapshot['pid']].append(snapshot)
+    return dict(ret)
+
+
+def diff_mem_snapshots(old, new):
+    '''
+    The change in size and count of each allocation site between two
+    snapshots, biggest change in size first. Sites are only in a
+    snapshot if they were among its top sites.
+    '''
+    old_sites = dict([(site['site'], site) for site in old['sites']])
+    new_sites = dict([(site['site'], site) for site in new['sites']])
+    empty = {'size': 0, 'count': 0}
+    ret = []
+    for name in set(old_sites) | set(new_sites):
+        old_site = old_sites.get(name, empty)
+        new_site = new_sites.get(name, empty)
+        ret.append({'site': name, 'size': new_site['size'],
+                    'count': new_site['count'],
+                    'size_diff': new_site['size'] - old_site['size'],
+                    'count_diff': new_site['count'] - old_site['count']})
+    return sorted(ret, key=lambda d: (abs(d['size_diff']), d['size']), reverse=True)
+
+
+def _fmt_size(size, sign=False):
+    prefix = ('+' if size >= 0 else '-') if sign else ''
+    size = abs(size)
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return '%s%d%s' % (prefix, size, unit)
+        size /= 1024.0
+    return '%s%.1fGiB' % (prefix, size)
+
+
+def load_collapsed(paths):
+    'sum the sample counts of each stack in the collapsed stack files at *paths*'
+    stacks = defaultdict(int)
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                if stack and count.isdigit():
+                    stacks[stack] += int(count)
+    return dict(stacks)
+
+
+def aggregate_stacks(stacks):
+    '''
+    Per-function sample counts from a {collapsed stack: count} dict.
+    "self" counts the samples in the function itself, "total" also
+    those in functions it called (recursion is counted once). Returns
+    a list of stat dicts, most self samples first.
+    '''
+    by_name = {}
+    for stack, count in stacks.items():
+        frames = stack.split(';')
+        for i, name in enumerate(frames):
+            stat = by_name.setdefault(name, {'name': name, 'self': 0, 'total': 0})
+            if name not in frames[i + 1:]:
+                stat['total'] += count
+        by_name[frames[-1]]['self'] += count
+    return sorted(by_name.values(), key=lambda s: (s['self'], s['total']),
+                  reverse=True)
+
+
+_FRAME_HEIGHT = 16
+_SVG_WIDTH = 1200
+_MIN_WIDTH = 0.5  # pixels, narrower frames aren't drawn
+
+
+def render_flamegraph(stacks, title='sky profile'):
+    'render a {collapsed stack: count} dict as a flame graph SVG document'
+    root = {'name': 'all', 'count': 0, 'children': {}}
+    for stack, count in stacks.items():
+        node = root
+        node['count'] += count
+        for name in stack.split(';'):
+            node = node['children'].setdefault(
+                name, {'name': name, 'count': 0, 'children': {}})
+            node['count'] += count
+    total = root['count'] or 1
+    rects = []
+
+    def layout(node, x, depth):
+        width = float(node['count']) / total * _SVG_WIDTH
+        if width < _MIN_WIDTH:
+            return
+        rects.append((node, x, depth, width))
+        for child in sorted(node['children'].values(), key=lambda n: n['name']):
+            layout(child, x, depth + 1)
+            x += float(child['count']) / total * _SVG_WIDTH
+
+    layout(root, 0.0, 0)
+    max_depth = max([depth for _, _, depth, _ in rects] or [0])
+    height = (max_depth + 3) * _FRAME_HEIGHT
+    out = ['<?xml version="1.0" standalone="no"?>',
+           '<svg version="1.1" width="%d" height="%d" font-family="monospace"'
+           ' font-size="11" xmlns="http://www.w3.org/2000/svg">' % (_SVG_WIDTH, height),
+           '<text x="%d" y="%d" text-anchor="middle" font-size="14">%s</text>'
+           % (_SVG_WIDTH / 2, _FRAME_HEIGHT, cgi.escape(title))]
+    for node, x, depth, width in rects:
+        y = height - (depth + 1) * _FRAME_HEIGHT  # root at the bottom
+        name = node['name']
+        label = name[:int(width / 7)] if width > 21 else ''  # ~7px per char
+        # warm colors, varied by name so neighbors are distinguishable
+        shade = hash(name) % 100
+        out.append(
+            '<g><title>%s (%d samples, %.1f%%)</title>'
+            '<rect x="%.1f" y="%d" width="%.1f" height="%d" fill="rgb(%d,%d,%d)"'
+            ' rx="2"/><text x="%.1f" y="%d">%s</text></g>' % (
+                cgi.escape(name), node['count'], 100.0 * node['count'] / total,
+                x, y, width, _FRAME_HEIGHT - 1, 205 + shade / 2, 100 + shade, 50,
+                x + 3, y + _FRAME_HEIGHT - 4, cgi.escape(label)))
+    out.append('</svg>')
+    return '\n'.join(out) + '\n'
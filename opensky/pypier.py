@@ -8,19 +8,28 @@ Python Package Index in a repo.
 import os
 import os.path
 import sys
+import re
 import json
 import shutil
 import argparse
 import datetime
 import getpass
 import socket
+import urllib
+import urlparse
+import posixpath
+import threading
+import contextlib
+import BaseHTTPServer
+import SimpleHTTPServer
 
 import ashes
 from boltons import fileutils
-import seashore
+from pkg_resources import parse_version
 
 from opensky import plugins
 from opensky.cmd import find_project_dir
+from opensky.cache import get_build_identity
 
 PIP_CMDS = ('install', 'download', 'list', 'search')
 # TODO: uninstall, unpublish (when a package is obsolete), and maybe
@@ -53,10 +62,10 @@ def pypier(args, reqs):
         setup_dir = find_project_dir(os.getcwd(), 'setup.py')
         pypier_read_write = cache.workon_project_git(
             'pypier', pypier_repo)
+        pkg_info = get_pkg_info(executor, setup_dir)
+        version = pkg_info['version']
         executor.python('setup.py', 'sdist').redirect(cwd=setup_dir)
         # TODO manylinux wheels?  OSX wheels?
-        version = executor.python(
-            'setup.py', version=None).batch()[0].strip()
         output = [fn for fn in os.listdir(setup_dir + '/dist/')
                   if version in fn]
         name = output[0].split('-', 1)[0]
@@ -72,23 +81,24 @@ def pypier(args, reqs):
         for result in output:
             shutil.copy(setup_dir + '/dist/' + result, dst)
         with fileutils.atomic_save(os.path.join(dst, 'pkg_info.json')) as f:
-            pkg_info = get_pkg_info(executor, setup_dir)
             pkg_info_json = json.dumps(pkg_info, indent=2, sort_keys=True)
             f.write(pkg_info_json + '\n')
-        update_index(pypier_read_write.path)
+        update_index(pypier_read_write.path, [name])
         source_metadata = get_source_metadata(executor, setup_dir)
         commit_msg = 'PyPIER publish: {}\n\n{}\n'.format(
             ', '.join(output),
             json.dumps(source_metadata, indent=2, sort_keys=True))
         pypier_read_write.push(commit_msg, dry_run=arg_vals.dry_run)
     elif cmd == 'pip-index':
-        pypier_read_only = cache.pull_project_git(
-            'pypier', pypier_repo_ro)
-        link_path = pypier_read_only + '/packages/index.html'
+        # the printed path outlives this process, so the release files
+        # have to be on disk; still only the tip of packages/, no history
+        pypier_read_only = cache.pull_sparse_git(
+            'pypier-packages', pypier_repo_ro, ['/packages/'])
+        link_path = pypier_read_only.path + '/packages/index.html'
         print link_path  # NOTE: this print command is the primary purpose
     elif cmd in PIP_CMDS:
-        pypier_read_only = cache.pull_project_git('pypier', pypier_repo_ro)
-        link_path = pypier_read_only + '/packages/index.html'
+        pypier_read_only = cache.pull_sparse_git(
+            'pypier', pypier_repo_ro, SPARSE_INDEX_PATHS)
         #env = dict(os.environ)
         #env['PIP_FIND_LINKS'] = ' '.join(
         #    [link_path] + env.get('PIP_FIND_LINKS', '').split())
@@ -96,14 +106,82 @@ def pypier(args, reqs):
         # TODO: remove ALL_PROXY='' once urllib3 + requests
         #       do a release and don't pre-emptively die
         #       on socks5h:// proxy
-        executor.patch_env(PIP_FIND_LINKS=link_path, ALL_PROXY='').command(
-            ['python', '-m', 'pip'] + args[1:]).redirect(
-                stdout=sys.stdout, stderr=sys.stderr)
+        with serve_pypier(pypier_read_only) as pypier_url:
+            pip_args = args[1:]
+            if cmd in ('install', 'download'):
+                pip_args = resolve_requirements(
+                    pypier_read_only.path, pip_args,
+                    packages_url=pypier_url + '/packages')
+            pip_env = get_pip_env(pypier_read_only.path, pypier_url)
+            executor.patch_env(ALL_PROXY='', **pip_env).command(
+                ['python', '-m', 'pip'] + pip_args).redirect(
+                    stdout=sys.stdout, stderr=sys.stderr)
     else:
         # argparse should catch this above
         raise ValueError('unrecognized sub-command %r' % cmd)
 
 
+def get_pip_env(pypier_path, pypier_url=None):
+    '''
+    Environment variables pointing pip at the PyPIER repo checked out
+    at *pypier_path*, or served at *pypier_url* if set. Uses the
+    per-package simple index where it has been generated, so pip only
+    reads the pages of the packages it looks up, otherwise falls back
+    to find-links on the full listing.
+    '''
+    ret = {}
+    base = pypier_url or ('file://' + pypier_path)
+    if pypier_url:
+        no_proxy = os.environ.get('no_proxy', os.environ.get('NO_PROXY'))
+        ret['no_proxy'] = ','.join(
+            [h for h in (no_proxy or '').split(',') if h] + ['127.0.0.1'])
+    if os.path.exists(pypier_path + '/simple/index.html'):
+        ret['PIP_EXTRA_INDEX_URL'] = base + '/simple/'
+    else:
+        ret['PIP_FIND_LINKS'] = base + '/packages/index.html'
+    return ret
+
+
+# the only files checked out for pip commands, release files are
+# fetched from git when pip asks for them
+SPARSE_INDEX_PATHS = ['/simple/', '/packages/index.json', '/packages/index.html']
+
+
+@contextlib.contextmanager
+def serve_pypier(sparse_repo):
+    '''
+    Serve the sparse PyPIER checkout *sparse_repo* over HTTP on
+    localhost for the duration of the block, yielding the base
+    URL. Release files under packages/ are read out of git the first
+    time they are requested.
+    '''
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), _PyPIERRequestHandler)
+    server.sparse_repo = sparse_repo
+    thread = threading.Thread(target=server.serve_forever, name='pypier_server')
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%s' % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+class _PyPIERRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    def translate_path(self, path):
+        rel_path = posixpath.normpath(
+            urllib.unquote(urlparse.urlsplit(path).path)).lstrip('/')
+        if rel_path.startswith('packages/'):
+            try:
+                return self.server.sparse_repo.materialize(rel_path)
+            except Exception:
+                pass  # not in the repo, falls through to a 404
+        return os.path.join(self.server.sparse_repo.path, rel_path)
+
+    def log_message(self, format, *args):
+        pass  # pip's output is on the terminal, keep it clean
+
+
 @plugins.register_site_config('pypier')
 def pypier_site_config():
     return {
@@ -113,32 +191,52 @@ def pypier_site_config():
 
 
 def get_pkg_info(executor, setup_dir):
-    ret = {}
-    fields = ['name', 'version', 'fullname', 'contact', 'contact-email',
-              'url', 'license', 'description', 'provides', 'requires']
+    '''
+    Get the metadata of the package at *setup_dir*. All fields are
+    dumped as JSON by a single python process which runs setup.py only
+    as far as building the Distribution and reading its config files,
+    for metadata declared in setup.cfg (no commands are run).
+    '''
     executor = executor.patch_env(TERM='xterm').chdir(setup_dir)
-    for field in fields:
-        value = executor.python('setup.py', **{field: None}).batch()[0]
-        ret[field.replace('-', '_')] = value.strip()
+    output = executor.python('-c', _PKG_INFO_SCRIPT).batch()[0]
+    # setup.py may print on its own, the JSON is always the last line
+    ret = json.loads(output.strip().splitlines()[-1])
     ret['info_updated'] = datetime.datetime.utcnow().isoformat()
     return ret
 
 
+PKG_INFO_FIELDS = ('name', 'version', 'fullname', 'contact', 'contact-email',
+                   'url', 'license', 'description', 'provides', 'requires')
+
+
+_PKG_INFO_SCRIPT = '''\
+import sys, json, distutils.core
+distutils.core._setup_stop_after = 'config'
+sys.argv = ['setup.py']
+sys.path.insert(0, '')
+execfile('setup.py', {'__file__': 'setup.py', '__name__': '__main__'})
+metadata = distutils.core._setup_distribution.metadata
+ret = {}
+for field in %r:
+    value = getattr(metadata, 'get_' + field.replace('-', '_'))()
+    if isinstance(value, (list, tuple)):
+        value = '\\n'.join(value)  # same as setup.py --provides, etc.
+    ret[field.replace('-', '_')] = (value or '').strip()
+sys.stdout.write('\\n' + json.dumps(ret) + '\\n')
+''' % (PKG_INFO_FIELDS,)
+
+
 def get_source_metadata(executor, source_path):
-    """TODO: other candidate info: active virtualenv, whether there are
-    modified files (might need to be an error)
+    """TODO: other candidate info: active virtualenv
     """
-    executor = executor.chdir(source_path)
-    git_rev_timestamp = executor.git.rev_list(
-        'HEAD', format=seashore.Eq('format:%ai'), max_count='1').batch()[0]
-    git_rev_timestamp = git_rev_timestamp.strip().splitlines()[-1]
+    build_identity = get_build_identity(executor, source_path)
     return {
-        'git_rev': executor.git.rev_parse('HEAD').batch()[0].strip(),
-        'git_rev_name': executor.git.rev_parse(
-            'HEAD', abbrev_ref=None).batch()[0].strip(),
-        'git_origin_url': executor.git.config(
+        'git_rev': build_identity.sha,
+        'git_rev_name': build_identity.branch,
+        'git_origin_url': executor.chdir(source_path).git.config(
             get='remote.origin.url').batch()[0].strip(),
-        'git_rev_timestamp': git_rev_timestamp,
+        'git_rev_timestamp': build_identity.iso_timestamp,
+        'git_dirty': build_identity.dirty,
         'user': _try_user(),
         'hostname': socket.gethostname(),
     }
@@ -154,54 +252,168 @@ def _try_user():
             return ''
 
 
-def update_index(pypier_path):
-    new_index_bytes, new_readme_bytes = generate_index(pypier_path)
-    index_path = pypier_path + '/packages/index.html'
-    readme_path = pypier_path + '/packages/README.md'
-    with fileutils.atomic_save(index_path) as f:
-        f.write(new_index_bytes)
-    with fileutils.atomic_save(readme_path) as f:
-        f.write(new_readme_bytes)
-    return
-
+def update_index(pypier_path, pkg_names=None):
+    '''
+    Update the index of the PyPIER repo at *pypier_path*.
 
-def generate_index(pypier_path):
-    packages = []
+    The per-package state is kept in packages/index.json, so only the
+    packages named in *pkg_names* are re-scanned and get their PEP 503
+    page (simple/<name>/index.html) re-rendered. If *pkg_names* is
+    None, or there is no index.json yet, every package is scanned.
 
+    packages/index.html and packages/README.md are rendered from the
+    index for find-links based clients.
+    '''
     pkgs_path = pypier_path + '/packages'
-
-    for pkg_name in os.listdir(pkgs_path):
-        cur_pkg_path = os.path.join(pkgs_path, pkg_name)
-        if not os.path.isdir(cur_pkg_path):
+    index = load_index(pypier_path)
+    if index is None or pkg_names is None:
+        index = {'packages': {}}
+        pkg_names = [fn for fn in os.listdir(pkgs_path)
+                     if os.path.isdir(os.path.join(pkgs_path, fn))]
+    for pkg_name in pkg_names:
+        index['packages'][pkg_name] = _scan_package(pkgs_path, pkg_name)
+    index['gen_date'] = datetime.datetime.utcnow().isoformat()
+
+    with fileutils.atomic_save(pypier_path + INDEX_JSON_PATH) as f:
+        f.write(json.dumps(index, indent=2, sort_keys=True) + '\n')
+
+    ae = _get_ashes_env()
+    fileutils.mkdir_p(pypier_path + '/simple')
+    for pkg_name in pkg_names:
+        pkg_dir = pypier_path + '/simple/' + _normalize_name(pkg_name)
+        fileutils.mkdir_p(pkg_dir)
+        with fileutils.atomic_save(pkg_dir + '/index.html') as f:
+            f.write(ae.render('simple_pkg', index['packages'][pkg_name]))
+    ctx = _get_render_ctx(index)
+    with fileutils.atomic_save(pypier_path + '/simple/index.html') as f:
+        f.write(ae.render('simple_root', ctx))
+    with fileutils.atomic_save(pkgs_path + '/index.html') as f:
+        f.write(ae.render('pkg_idx', ctx))
+    with fileutils.atomic_save(pkgs_path + '/README.md') as f:
+        f.write(ae.render('readme', ctx))
+    return index
+
+
+INDEX_JSON_PATH = '/packages/index.json'
+
+
+def load_index(pypier_path):
+    'load packages/index.json, or return None if it was never generated'
+    try:
+        with open(pypier_path + INDEX_JSON_PATH) as f:
+            return json.load(f)
+    except IOError:
+        return None
+
+
+def _scan_package(pkgs_path, pkg_name):
+    cur_pkg_path = os.path.join(pkgs_path, pkg_name)
+    cur_pkg = {'name': pkg_name}
+    pkg_info_path = os.path.join(cur_pkg_path, 'pkg_info.json')
+    pkg_info = json.load(open(pkg_info_path))
+    if pkg_info['name'] != pkg_name:
+        print 'warning: package name/info mismatch for %r: %r' % (pkg_name, pkg_info_path)
+    cur_pkg['info'] = pkg_info
+    versions = []
+    for release_fn in os.listdir(cur_pkg_path):
+        if release_fn.split('-')[0] != pkg_name:
             continue
-        cur_pkg = {'name': pkg_name}
-        pkg_info_path = os.path.join(cur_pkg_path, 'pkg_info.json')
-        pkg_info = json.load(open(pkg_info_path))
-        if pkg_info['name'] != pkg_name:
-            print 'warning: package name/info mismatch for %r: %r' % (pkg_name, pkg_info_path)
-        cur_pkg['info'] = pkg_info
-        versions = []
-        for release_fn in os.listdir(cur_pkg_path):
-            if release_fn.split('-')[0] != pkg_name:
-                continue
-            # splitext doesn't work because .tar.gz
-            # always the second item, even with wheels
-            version = _strip_pkg_ext(release_fn).split('-')[1]
-            versions.append({'path': os.path.join(pkg_name, release_fn),
-                             'version': version})
-        # TODO: do better than alphabetical sort
-        cur_pkg['versions'] = sorted(versions, key=lambda x: x['version'], reverse=True)
-        packages.append(cur_pkg)
+        # splitext doesn't work because .tar.gz
+        # always the second item, even with wheels
+        version = _strip_pkg_ext(release_fn).split('-')[1]
+        versions.append({'path': os.path.join(pkg_name, release_fn),
+                         'filename': release_fn,
+                         'version': version})
+    cur_pkg['versions'] = sorted(
+        versions, key=lambda x: parse_version(x['version']), reverse=True)
+    cur_pkg['latest'] = _get_latest_version(cur_pkg['versions'])
+    return cur_pkg
+
+
+def _get_latest_version(versions):
+    '''
+    Given *versions* sorted newest first, return the newest stable
+    version, falling back to the newest pre-release.
+    '''
+    for version in versions:
+        if not getattr(parse_version(version['version']), 'is_prerelease', False):
+            return version['version']
+    return versions[0]['version'] if versions else None
+
+
+def resolve_release(index, requirement):
+    '''
+    Look up the release file satisfying *requirement* ("name" for the
+    latest stable version, or "name==version") in a loaded
+    index. Returns the file's path relative to packages/, or None if
+    the requirement isn't a plain PyPIER package pin.
+    '''
+    match = re.match(r'^([A-Za-z0-9_.\-]+)(?:==([^=<>!~,;\s]+))?$', requirement)
+    if not match or not index:
+        return None
+    name, version = match.groups()
+    pkgs_by_name = dict([(_normalize_name(pkg_name), pkg)
+                         for pkg_name, pkg in index['packages'].items()])
+    pkg = pkgs_by_name.get(_normalize_name(name))
+    if not pkg:
+        return None
+    version = version or pkg.get('latest')
+    for release in pkg['versions']:
+        if release['version'] == version:
+            return release['path']
+    return None
+
+
+def resolve_requirements(pypier_path, requirements, packages_url=None):
+    '''
+    Replace each requirement that names a PyPIER package with the
+    path of its release file (or its URL under *packages_url*), using
+    packages/index.json instead of having pip crawl the HTML
+    index. Everything else (including arguments to options in a pip
+    command line) is passed through.
+    '''
+    index = load_index(pypier_path)
+    packages_base = packages_url or (pypier_path + '/packages')
+    ret = []
+    prev = None
+    for req in requirements:
+        rel_path = None
+        if not req.startswith('-') and prev not in _PIP_VALUE_OPTS:
+            rel_path = resolve_release(index, req)
+        if rel_path:
+            ret.append(packages_base + '/' + rel_path)
+        else:
+            ret.append(req)
+        prev = req
+    return ret
+
+
+# pip options which take a separate value argument
+_PIP_VALUE_OPTS = frozenset([
+    '-r', '--requirement', '-c', '--constraint', '-e', '--editable',
+    '-d', '--dest', '-t', '--target', '-i', '--index-url',
+    '--extra-index-url', '-f', '--find-links', '--src', '--prefix',
+    '--root', '--platform', '--python-version', '--implementation',
+    '--abi', '--no-binary', '--only-binary', '--upgrade-strategy',
+    '--log', '--proxy', '--timeout', '--retries', '--cache-dir',
+    '--trusted-host', '--install-option', '--global-option',
+    '-b', '--build', '-w', '--wheel-dir'])
 
+
+def _get_render_ctx(index):
+    packages = sorted(index['packages'].values(), key=lambda x: x['name'])
+    for pkg in packages:
+        pkg['normalized_name'] = _normalize_name(pkg['name'])
+    return {'packages': packages, 'gen_date': index['gen_date']}
+
+
+def _get_ashes_env():
     ae = ashes.AshesEnv()
     ae.register_source('pkg_idx', INDEX_TMPL)
     ae.register_source('readme', README_TMPL)
-
-    ctx = {'packages': sorted(packages, key=lambda x: x['name']),
-           'gen_date': datetime.datetime.utcnow().isoformat()}
-    index = ae.render('pkg_idx', ctx)
-    readme = ae.render('readme', ctx)
-    return index, readme
+    ae.register_source('simple_root', SIMPLE_ROOT_TMPL)
+    ae.register_source('simple_pkg', SIMPLE_PKG_TMPL)
+    return ae
 
 
 def _strip_pkg_ext(pkg_filename):
@@ -209,6 +421,11 @@ def _strip_pkg_ext(pkg_filename):
     return pkg_filename.replace('.tar.gz', '').replace('.zip', '').replace('.whl', '')
 
 
+def _normalize_name(pkg_name):
+    'PEP 503 project name normalization'
+    return re.sub(r'[-_.]+', '-', pkg_name).lower()
+
+
 _ctx = {'packages': [{'name': '', 'versions': [{'path': '', 'version': ''}]}]}
 
 
@@ -224,6 +441,7 @@ INDEX_TMPL = """\
     {#packages}
     <h3 id="{name}">{name}</h3>
     <p>Code repo: <a href="{info.url}">{info.url}</a>
+    <p>Latest: {latest}</p>
     <ul>
     {#versions}<li><a href="{path}">{version}</a></li>{/versions}
     </ul>
@@ -233,6 +451,35 @@ INDEX_TMPL = """\
 """
 
 
+SIMPLE_ROOT_TMPL = """\
+<!DOCTYPE html>
+<html>
+  <head>
+    <title>PyPIER Simple Index</title>
+  </head>
+  <body>
+    {#packages}<a href="{normalized_name}/">{name}</a><br/>
+    {/packages}
+  </body>
+</html>
+"""
+
+
+SIMPLE_PKG_TMPL = """\
+<!DOCTYPE html>
+<html>
+  <head>
+    <title>Links for {name}</title>
+  </head>
+  <body>
+    <h1>Links for {name}</h1>
+    {#versions}<a href="../../packages/{path}">{filename}</a><br/>
+    {/versions}
+  </body>
+</html>
+"""
+
+
 README_TMPL = """\
 Published Packages and Versions
 ===============================
@@ -240,7 +487,7 @@ Published Packages and Versions
 {#packages}
 [{name}](name)
 --------------
-*[View code]({info.url})*
+*[View code]({info.url})* (latest: {latest})
 
 {#versions}
 * [{version}](name/version)
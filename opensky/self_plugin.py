@@ -22,8 +22,15 @@ TODO: maybe something like reqs.exit_with_message() when an expected
 
 '''
 import os
+import re
 import sys
+import time
+import shutil
+import zipfile
+import compileall
 import fnmatch
+import hashlib
+import platform
 import argparse
 import datetime
 import pkg_resources
@@ -31,7 +38,7 @@ import pkg_resources
 import attr
 from boltons import strutils, ecoutils, fileutils
 
-from opensky import plugins
+from opensky import plugins, import_profile
 
 
 def get_sky_metadata():
@@ -115,6 +122,9 @@ def get_argparser():
     # TODO: --packages-requirements : allow the passing of a requirements.txt
     add_arg('--update', action="store_true")
     add_arg('--output-dir', type=str, default=None)
+    add_arg('--startup-mode', choices=STARTUP_MODES, default='zipped',
+            help='"unzipped" saves a pre-extracted, precompiled executable'
+            ' directory and a launcher script, for faster startup')
     # add_arg('--extra')  # TODO format for extra metadata
     build_prs.set_defaults(func=self_build)
 
@@ -139,6 +149,15 @@ def get_argparser():
                                    ' contained in the executable')
     lspkgs_prs.set_defaults(func=self_lspkgs)
 
+    bench_prs = subprs.add_parser('bench-startup',
+                                  description='time sky startup and report'
+                                  ' the slowest module imports')
+    bench_prs.add_argument('--sky', help='path of the sky executable to'
+                           ' benchmark (defaults to the current one)')
+    bench_prs.add_argument('--runs', type=int, default=5)
+    bench_prs.add_argument('--top', type=int, default=20)
+    bench_prs.set_defaults(func=self_bench_startup)
+
     shell_prs = subprs.add_parser('shell',
                                   description='start a python REPL with access to sky internals')
     shell_prs.set_defaults(func=self_shell)
@@ -230,15 +249,14 @@ def self_version(args, reqs):
 
 def self_build(args, reqs):
     # note that ^ this is parsed args, not argv
-    import virtualenv
-
     cur_info = _args2sky_metadata(args, reqs)
+    cache_dir = reqs.cache.cache_dir
     build_dir = args.output_dir or (reqs.sky_path + '/self-build/')
-    build_venv = build_dir + 'build-env'
     wheelhouse = build_dir + 'wheelhouse'
+    wheel_cache = get_wheel_cache_dir(cache_dir)
 
     fileutils.mkdir_p(build_dir)
-    virtualenv.create_environment(build_venv)
+    build_venv = ensure_build_venv(cache_dir + '/self-build', reqs.executor)
     in_virtualenv = reqs.executor.in_virtualenv(
         build_venv).patch_env(ALL_PROXY='')
 
@@ -246,14 +264,25 @@ def self_build(args, reqs):
         in_virtualenv.pip.wheel(
             *pkgs, wheel_dir=wheelhouse, **wheel_kwargs).interactive()
 
-    wheel_kwargs = {}
+    # previously built wheels satisfy unchanged requirements without
+    # a rebuild, pip prefers a wheel over an sdist of the same version
+    wheel_kwargs = {'find_links': [wheel_cache]}
+    build_pkgs = [cur_info.opensky_package] + list(cur_info.packages)
     if cur_info.pypier_repo:
+        from opensky import pypier
         pypier_dir = reqs.cache.pull_project_git('pypier', cur_info.pypier_repo)
-        wheel_kwargs['find_links'] = pypier_dir + '/packages/index.html'
+        wheel_kwargs['find_links'].append(pypier_dir + '/packages/index.html')
+        build_pkgs = pypier.resolve_requirements(pypier_dir, build_pkgs)
 
     # build all dependencies + opensky itself
-    build_wheels(cur_info.opensky_package, *cur_info.packages)
+    build_wheels(*build_pkgs)
     all_packages = fnmatch.filter(os.listdir(wheelhouse), '*.whl')
+    # wheels built from local source trees may change without a
+    # version bump, so only ones built from releases are cached
+    local_names = ['sky_metadata'] + [
+        _get_local_pkg_name(reqs.executor, pkg) for pkg in build_pkgs
+        if os.path.isdir(pkg)]
+    update_wheel_cache(wheel_cache, wheelhouse, all_packages, local_names)
     # create metadata package
     cur_info = attr.evolve(
         cur_info,
@@ -266,23 +295,165 @@ def self_build(args, reqs):
 
     top_level_pkgs = ['opensky', 'sky_metadata'] + list(cur_info.packages)
 
-    in_virtualenv.pip.install('pex').batch()
-
     artifact_path = build_dir + '/sky-' + cur_info.version
+    pex_args = []
+    if args.startup_mode == 'unzipped':
+        # dependencies are imported from PEX_ROOT instead of the zip
+        pex_args = ['--not-zip-safe', '--always-write-cache']
     in_virtualenv.command(
         ['pex', '--python-shebang=/usr/bin/env python2.7',
          '--repo', wheelhouse, '--no-index', '--pre',
          '--output-file=' + artifact_path,
-         '--disable-cache', '--entry-point', 'opensky'] + top_level_pkgs
+         '--disable-cache', '--entry-point', 'opensky'] + pex_args + top_level_pkgs
         ).redirect()
     sky_size = os.path.getsize(artifact_path)
     sky_human_size = strutils.bytes2human(sky_size, ndigits=2)
     message = ('sky %s (%s) executable successfully saved to: %s'
                % (cur_info.version, sky_human_size, artifact_path))
+    if args.startup_mode == 'unzipped':
+        extracted_path = unzip_pex(artifact_path)
+        message += ('\n(unzipped, ship %s alongside the launcher)'
+                    % extracted_path)
 
     return (0, message)
 
 
+# installed into the build virtualenv, changing these creates a new one
+BUILD_VENV_REQS = ('pex==1.2.4',)
+
+
+def ensure_build_venv(base_dir, executor):
+    '''
+    Return the path of a virtualenv with BUILD_VENV_REQS installed,
+    reusing the one from a previous build if the python, platform,
+    virtualenv version and requirements all match.
+    '''
+    import virtualenv
+
+    key = hashlib.sha1(repr(
+        (sys.version, sys.platform, virtualenv.__version__, BUILD_VENV_REQS)
+    )).hexdigest()[:12]
+    build_venv = base_dir + '/build-env-' + key
+    ready_marker = build_venv + '/.sky-ready'
+    if not os.path.exists(ready_marker):
+        if os.path.exists(build_venv):  # an interrupted setup
+            shutil.rmtree(build_venv)
+        fileutils.mkdir_p(base_dir)
+        virtualenv.create_environment(build_venv)
+        executor.in_virtualenv(build_venv).patch_env(ALL_PROXY='').pip.install(
+            *BUILD_VENV_REQS).batch()
+        with open(ready_marker, 'w'):
+            pass
+    return build_venv
+
+
+def get_wheel_cache_dir(cache_dir):
+    '''
+    The persistent wheel cache for the running platform and python. The
+    wheels in it are identified by their filenames (project, version
+    and compatibility tags).
+    '''
+    plat_key = '%s-%s-py%s.%s' % ((sys.platform, platform.machine())
+                                  + sys.version_info[:2])
+    ret = cache_dir + '/wheels/' + plat_key
+    fileutils.mkdir_p(ret)
+    return ret
+
+
+def update_wheel_cache(wheel_cache, wheelhouse, wheel_names, exclude_projects=()):
+    '''
+    Copy new wheels from the *wheelhouse* into the *wheel_cache*,
+    except for those of *exclude_projects*. Returns the names of the
+    wheels copied.
+    '''
+    exclude_projects = set([_normalize_project(name) for name in exclude_projects])
+    ret = []
+    for wheel_name in wheel_names:
+        if _normalize_project(wheel_name.split('-')[0]) in exclude_projects:
+            continue
+        if os.path.exists(os.path.join(wheel_cache, wheel_name)):
+            continue
+        with fileutils.atomic_save(os.path.join(wheel_cache, wheel_name)) as f:
+            with open(os.path.join(wheelhouse, wheel_name), 'rb') as src:
+                shutil.copyfileobj(src, f)
+        ret.append(wheel_name)
+    return ret
+
+
+def _normalize_project(name):
+    return re.sub(r'[-_.]+', '_', name).lower()
+
+
+def _get_local_pkg_name(executor, path):
+    from opensky import pypier
+    return pypier.get_pkg_info(executor, path)['name']
+
+
+STARTUP_MODES = ('zipped', 'unzipped')
+
+
+def unzip_pex(pex_path):
+    '''
+    Extract the pex at *pex_path* into a "<pex_path>.d" directory,
+    precompile its bytecode, and replace the pex with a launcher
+    script that runs the directory. This skips zipimport and
+    compilation on every run, and the launcher defaults PEX_ROOT to a
+    stable location so the not-zip-safe dependencies pex installs
+    there on first run are reused. Returns the directory path.
+    '''
+    extracted_path = pex_path + '.d'
+    if os.path.exists(extracted_path):
+        shutil.rmtree(extracted_path)
+    with zipfile.ZipFile(pex_path) as pex_zip:
+        pex_zip.extractall(extracted_path)
+    compileall.compile_dir(extracted_path, quiet=1)
+    with fileutils.atomic_save(pex_path) as f:
+        f.write(_LAUNCHER_TMPL.format(dirname=os.path.basename(extracted_path)))
+    os.chmod(pex_path, 0755)
+    return extracted_path
+
+
+_LAUNCHER_TMPL = '''\
+#!/bin/sh
+# generated by "sky self build --startup-mode unzipped"
+export PEX_ROOT="${{PEX_ROOT:-$HOME/.sky/pex}}"
+exec /usr/bin/env python2.7 "$(dirname "$0")/{dirname}" "$@"
+'''
+
+
+def self_bench_startup(args, reqs):
+    if args.sky:
+        sky_cmd = [args.sky]
+    elif sys.argv[0].endswith('.py') or sys.argv[0].endswith('.pyc'):
+        sky_cmd = [sys.executable, '-m', 'opensky']  # development
+    else:
+        sky_cmd = [sys.argv[0]]
+    sky_cmd.append('--help')  # imports everything, runs nothing
+
+    durations = []
+    for _ in range(args.runs):
+        start = time.time()
+        reqs.executor.command(sky_cmd).batch()
+        durations.append(time.time() - start)
+    durations.sort()
+    print('sky startup: %s runs, best %dms, median %dms'
+          % (args.runs, durations[0] * 1000, durations[len(durations) // 2] * 1000))
+
+    _, err = reqs.executor.patch_env(SKY_IMPORT_TIMES='1').command(
+        sky_cmd).batch()
+    imports = import_profile.parse_import_times(err)
+    if not imports:
+        print('no import times reported (sky executable predates bench-startup?)')
+        return
+    total_us = sum([imp['self_us'] for imp in imports])
+    print('%s modules imported in %dms, slowest:' % (len(imports), total_us / 1000))
+    print('%10s %10s  %s' % ('self ms', 'cumul. ms', 'module'))
+    imports.sort(key=lambda imp: imp['self_us'], reverse=True)
+    for imp in imports[:args.top]:
+        print('%10.1f %10.1f  %s' % (imp['self_us'] / 1000.0,
+                                     imp['cumulative_us'] / 1000.0, imp['name']))
+
+
 def _args2sky_metadata(args, reqs):
     # TODO: externalize these exits more nicely
     if args.update:
@@ -14,13 +14,17 @@ import collections
 import pkg_resources
 import json
 import glob
+import hashlib
+from xml.etree import ElementTree
 
 import attr
 import colorama
+from boltons import fileutils
 from boltons.fileutils import mkdir_p
 from boltons import iterutils
 
 from . import config, docker, log
+from .fingerprint import fingerprint_tree
 
 CUR_PATH = os.path.dirname(os.path.abspath(__file__))
 
@@ -28,7 +32,8 @@ CUR_PATH = os.path.dirname(os.path.abspath(__file__))
 # TODO: virtual env for these to avoid mixing with application dependencies?
 META_REQUIREMENTS = {
     'pip': [config.PipPkg.parse(_pkg) for _pkg in
-        ['ncolony==17.9.0', 'pytest==3.0.6', 'python-cloudfiles==1.7.11']],
+        ['ncolony==17.9.0', 'pytest==3.2.5', 'pytest-xdist==1.20.1',
+         'python-cloudfiles==1.7.11']],
     'conda': [config.CondaPkg.parse(_pkg) for _pkg in
         ['anaconda/gcc==4.8.5']],
 }
@@ -65,27 +70,81 @@ class Service(object):
         self.sky_deps_dir = self.project_dir + '/build/sky-deps/'
         mkdir_p(self.sky_deps_dir)
         self.last_setup_path = self.project_dir + '/build/last-setup.sky.yaml'
+        self.setup_stages_path = self.project_dir + '/build/setup-stages.json'
 
-    def setup(self):
+    def setup(self, force=False):
+        '''
+        Fetch sky dependencies, build the local dev image, then run the
+        database migrations and seed zookeeper. Each stage is skipped
+        when its inputs are unchanged since the last setup, unless
+        *force* is set. (Code and sky dependencies are mounted as
+        volumes for local dev, so they aren't inputs to the image.)
+        '''
         if self.use_docker_machine:
             uid = 1000  # hope this is right
         else:
             uid = os.stat(self.config_path).st_uid
+        stages = SetupStages.load(self.setup_stages_path, force=force)
 
-        depends_on = []
-        if self.zookeeper:
-            depends_on.append('zookeeper')
-        if self.db_name:
-            depends_on.append('mysql')
-        if self.cassandra:
-            depends_on.append('cassandra')
+        skydep_paths = self._fetch_skydeps(stages)
 
-        self.clean()
-        self.build(uid=uid)
-        self._run_cmd(['SETUP'], depends_on)
+        image_spec = self._get_imagespec(skydep_paths, uid)
+        image_inputs = attr.asdict(image_spec)
+        tag = self._cur_image()
+        image_id = self.docker_runner.get_image_id(tag)
+        if image_id and stages.is_current('image', [image_inputs, image_id]):
+            self.logger.comment('image {0} unchanged, skipping build'.format(tag))
+        else:
+            self.docker_runner.build_imagespec(image_spec, tag=tag)
+            image_id = self.docker_runner.get_image_id(tag)
+            stages.record('image', [image_inputs, image_id])
+
+        # no clean(): containers whose image and config are unchanged
+        # (e.g., databases) are reused by run_composition()
+        setup_stages = collections.OrderedDict()
+        if self.db_name or self.cassandra:
+            deps = [name for name, enabled in (('mysql', self.db_name),
+                                               ('cassandra', self.cassandra))
+                    if enabled]
+            setup_stages['migrations'] = (deps, [
+                self.db_name, self.cassandra,
+                fingerprint_tree(self.code_path + '/migrations')])
+        if self.zookeeper:
+            setup_stages['zookeeper'] = (['zookeeper'], [HOST_PORTS])
+        main_py = pkg_resources.resource_string(
+            'opensky', 'goes_in_docker_image/main.py')
+        to_run, depends_on = [], []
+        for stage, (deps, inputs) in setup_stages.items():
+            inputs = [main_py, inputs, self._get_dep_container_state(deps)]
+            setup_stages[stage] = (deps, inputs)
+            if stages.is_current(stage, inputs):
+                self.logger.comment('{0} unchanged, skipping'.format(stage))
+                continue
+            to_run.append(stage)
+            depends_on.extend(deps)
+        if to_run:
+            self._run_cmd(['SETUP'] + to_run, depends_on)
+            for stage in to_run:  # container ids are known after the run
+                deps, inputs = setup_stages[stage]
+                inputs[-1] = self._get_dep_container_state(deps)
+                stages.record(stage, inputs)
 
         shutil.copy(self.config_path, self.last_setup_path)
 
+    def _get_dep_container_state(self, depends_on):
+        '''
+        The compose fingerprint and container id of each dependency
+        service; if either changes, the service's state (e.g., a database)
+        has been lost and setup needs to run again.
+        '''
+        composition = docker.Dockercompose(
+            self.name, [docker.BUILT_INS[name] for name in depends_on])
+        fingerprints = self.docker_runner.get_service_fingerprints(composition)
+        project = self.name.replace('_', '').replace('-', '').lower()
+        return [(name, fingerprints[name], self.docker_runner.get_container_id(
+                    '{0}_{1}_1'.format(project, name), all=True))
+                for name in depends_on]
+
     def populate(self):
         self._run_cmd(['POPULATE'], ['mysql'])
 
@@ -102,15 +161,35 @@ class Service(object):
             tag, '/home/app/main.py', 'TEST',
             entrypoint='/home/app/miniconda2/bin/python').redirect()
 
-    def test(self, pdb_on_error):
+    def test(self, pdb_on_error, pytest_args=(), changed=False):
+        '''
+        Run the unit tests, passing *pytest_args* on to pytest. With
+        *changed*, only the test modules affected by files modified
+        since the last setup are run; otherwise, all of the tests of
+        the project, unless *pytest_args* has test paths of its own.
+        '''
         self._check_setup()
+        test_paths = ['/home/app/' + self.name]
+        if any([is_test_path(arg, self.project_dir) for arg in pytest_args]):
+            test_paths = []
+        if changed:
+            if not os.path.exists(self.last_setup_path):
+                self.logger.comment('setup never run, running all tests')
+            else:
+                rel_paths = find_changed_tests(
+                    self.code_path, os.path.getmtime(self.last_setup_path))
+                if not rel_paths:
+                    self.logger.comment('no tests affected by changes since last setup')
+                    return
+                test_paths = ['/home/app/{0}/{1}'.format(self.name, rel_path)
+                              for rel_path in rel_paths]
         if pdb_on_error:
             cmd = ['TEST_PDB']
         else:
             cmd  = ['TEST']
-        self._run_cmd(cmd, [])
+        self._run_cmd(cmd + list(pytest_args) + test_paths, [])
 
-    def integration_test(self, pytest_args):
+    def integration_test(self, pytest_args, shards=1):
         server_image = self._local_dev_image_service(
             self.name,
             entrypoint=_main_script_entrypoint(['START']))
@@ -118,9 +197,95 @@ class Service(object):
         del server_image_dict['ports']
         server_image = docker.ImageService(
             ports=map(str, self.ports), **server_image_dict)
+        if shards > 1:
+            return self._sharded_integration_test(pytest_args, shards, server_image)
         self._run_cmd(['INT_TEST'] + pytest_args, self.start_depends_on,
             extra_services=[server_image])
 
+    def _sharded_integration_test(self, pytest_args, shard_count, server_image):
+        '''
+        Split the integration test modules across *shard_count*
+        compositions, each a separate compose project with its own
+        databases (set up first), and run them concurrently. Output
+        of each shard goes to build/int-test/shard<N>.log, and the
+        JUnit reports are merged into build/int-test/junit.xml, which
+        provides the durations to split the next run by.
+        '''
+        results_dir = self.project_dir + '/build/int-test'
+        mkdir_p(results_dir)
+        report_path = results_dir + '/junit.xml'
+        # left by an interrupted run, they'd be merged into this one's
+        for stale_path in glob.glob(results_dir + '/shard*.*'):
+            os.remove(stale_path)
+        modules = find_test_modules(self.project_dir + '/integration_test')
+        shards = split_by_duration(
+            modules, load_junit_durations(report_path), shard_count)
+        setup_cmd = ['SETUP'] + [
+            stage for stage, enabled in (
+                ('migrations', self.db_name or self.cassandra),
+                ('zookeeper', self.zookeeper)) if enabled]
+        setup_depends_on = [name for name in self.start_depends_on
+                            if name in ('mysql', 'cassandra', 'zookeeper')]
+        results_volume = results_dir + ':' + INT_TEST_RESULTS_DIR
+
+        failed = []
+        def run_shard(index, rel_paths):
+            compose_name = '{0}_shard{1}'.format(self.name, index)
+            log_path = '{0}/shard{1}.log'.format(results_dir, index)
+            test_paths = ['/home/app/integration_test/' + rel_path
+                          for rel_path in rel_paths]
+            junit_arg = '--junitxml={0}/shard{1}.xml'.format(
+                INT_TEST_RESULTS_DIR, index)
+            with open(log_path, 'w') as output, self.logger.info(
+                    'int_test_shard', shard=index, modules=len(rel_paths),
+                    log_path=log_path) as act:
+                try:
+                    if len(setup_cmd) > 1:
+                        self._run_cmd(setup_cmd, setup_depends_on,
+                                      compose_name=compose_name, output=output,
+                                      publish_ports=False)
+                    self._run_cmd(
+                        ['INT_TEST', junit_arg] + pytest_args + test_paths,
+                        self.start_depends_on, extra_services=[server_image],
+                        compose_name=compose_name, output=output,
+                        publish_ports=False, extra_volumes=[results_volume])
+                except Exception as e:
+                    failed.append(index)
+                    act.failure('shard {0} failed: {1!r}', index, e)
+
+        threads = []
+        for index, rel_paths in enumerate(shards):
+            if not rel_paths:
+                continue
+            thread = threading.Thread(name='int_test_shard{0}'.format(index),
+                                      target=run_shard, args=(index, rel_paths))
+            thread.start()
+            threads.append(thread)
+        try:
+            for thread in threads:
+                while thread.is_alive():
+                    thread.join(1)  # a join() without timeout ignores Ctrl-C
+        except KeyboardInterrupt:
+            # the shards' docker-compose ups abort once their server exits
+            with self.logger.info('stop_int_test_shards', count=len(threads)):
+                for index, rel_paths in enumerate(shards):
+                    container = self._container_name(
+                        '{0}_shard{1}'.format(self.name, index))
+                    if rel_paths and self.docker_runner.get_container_id(container):
+                        self.docker_runner.stop(container)
+            raise
+
+        shard_reports = glob.glob(results_dir + '/shard*.xml')
+        totals = merge_junit_reports(shard_reports, report_path)
+        for shard_report in shard_reports:
+            os.remove(shard_report)
+        self.logger.comment(
+            '{0} tests, {1} failures, {2} errors; report at {3}'.format(
+                totals['tests'], totals['failures'], totals['errors'], report_path))
+        if failed:
+            raise SystemExit('integration test shards failed: {0}, see {1}'.format(
+                ', '.join(map(str, sorted(failed))), results_dir))
+
     def start(self):
         self._prepare_start()
         self._run_cmd(['START'], self.start_depends_on)
@@ -129,6 +294,22 @@ class Service(object):
         self._check_setup()
         self._run_cmd(['START_DEBUG'], self.start_depends_on)
 
+    def start_profile(self, mode='cpu'):
+        '''
+        Start the service with a profiler, which writes to build/profile.
+        In "cpu" *mode*, a sampling profiler writes collapsed stacks
+        for "sky profile report"; in "mem" *mode*, allocation snapshots
+        are taken periodically for "sky profile mem-report".
+        '''
+        self._prepare_start()
+        profile_dir = self.project_dir + '/build/profile'
+        mkdir_p(profile_dir)
+        stale_pattern = '/cpu-*.collapsed' if mode == 'cpu' else '/mem-*.json'
+        for path in glob.glob(profile_dir + stale_pattern):
+            os.remove(path)  # from an earlier run
+        self._run_cmd(['START_PROFILE', mode], self.start_depends_on,
+                      extra_volumes=[profile_dir + ':' + PROFILE_DATA_DIR])
+
     def _prepare_start(self):
         'DRY between start() and shell_start()'
         self._check_setup()
@@ -189,7 +370,10 @@ class Service(object):
         self.docker_runner.clean_composition(composition, compose_name)
 
     def build(self, tag=None, uid=501):
-        skydep_paths = self._fetch_skydeps()
+        image_spec = self._get_imagespec(self._fetch_skydeps(), uid)
+        self.docker_runner.build_imagespec(image_spec, tag=tag or self._cur_image())
+
+    def _get_imagespec(self, skydep_paths, uid):
         lib_deps = self._collect_lib_deps(skydep_paths)
 
         yum_pkgs = [
@@ -207,6 +391,8 @@ class Service(object):
             'useradd -u {} -ms /bin/bash app'.format(uid),
             'yum --setopt=obsoletes=0 install -y ' + ' '.join(["'%s'" % yp for yp in yum_pkgs]),
             'mkdir -p /var/log/services',
+            # mount point of the pytest cache volume, owned by app
+            'mkdir -p ' + PYTEST_CACHE_VOLUME.split(':')[1],
             'chmod 777 /var/log/services',
             'yum clean all',
             # chown -R everything takes 5-10 minutes;
@@ -253,6 +439,11 @@ class Service(object):
 
         sitecustomize_bytes = pkg_resources.resource_string(
             'opensky', 'goes_in_docker_image/debug/sitecustomize.py')
+        profile_sitecustomize_bytes = pkg_resources.resource_string(
+            'opensky', 'goes_in_docker_image/profile/sitecustomize.py')
+        pytest_plugin_bytes = pkg_resources.resource_string(
+            'opensky', 'goes_in_docker_image/sky_pytest_plugin.py')
+        fingerprint_bytes = pkg_resources.resource_string('opensky', 'fingerprint.py')
 
         if os.path.exists(self.config_path):
             sky_yaml_bytes = open(self.config_path, 'rb').read()
@@ -269,6 +460,9 @@ class Service(object):
                 }),
             'sky.yaml': sky_yaml_bytes,
             'debug/sitecustomize.py': sitecustomize_bytes,
+            'profile/sitecustomize.py': profile_sitecustomize_bytes,
+            'sky_pytest_plugin.py': pytest_plugin_bytes,
+            'sky_fingerprint.py': fingerprint_bytes,
             'ncolony.json': json.dumps({'env_inherit': ['ENV_TYPE']}),
             '.dockerignore': '.git',
         }
@@ -302,25 +496,27 @@ class Service(object):
             envvars.append(('PYTHONPATH', pythonpath))
 
         base_build_image = self.site_config['services']['default_base_build']['docker_image']
-        self.docker_runner.build_imagespec(
-            docker.ImageSpec(
-                self.name, base_build_image, context_paths, small_files,
-                commands, entrypoint, env=envvars),
-            tag=tag or self._cur_image())
+        return docker.ImageSpec(
+            self.name, base_build_image, context_paths, small_files,
+            commands, entrypoint, env=envvars)
 
-    def _run_cmd(self, cmd, depends_on, extra_services=None, root=False):
+    def _run_cmd(self, cmd, depends_on, extra_services=None, root=False, **kw):
         '''
         Run main.py inside the image and pass it cmd.
         depends_on is the set of additional background images to run.
         '''
         self._run_entrypoint(cmd[0], _main_script_entrypoint(cmd),
-                             depends_on, extra_services, root)
+                             depends_on, extra_services, root, **kw)
 
     def _run_entrypoint(self, compose_name_suffix, entrypoint, depends_on,
-        extra_services=None, root=False):
+        extra_services=None, root=False, compose_name=None, output=None,
+        publish_ports=True, extra_volumes=()):
         '''
         run the local image created by setup with a given entrypoint
         in the "foreground" of sky so that REPL/PDB/etc work as expected.
+        *compose_name* is the compose project (default the service
+        name), and with an *output* file, the entrypoint is run without
+        a terminal, writing to it instead.
         '''
         service = self._local_dev_image_service(
             self.name + '_server',
@@ -330,13 +526,17 @@ class Service(object):
                 'import signal, time, sys; '
                 'signal.signal(15, lambda s, f: sys.exit(0)); '
                 '[time.sleep(2**20) for i in xrange(2**20)]')))
+        if not publish_ports or extra_volumes:
+            service = attr.evolve(
+                service, ports=service.ports if publish_ports else [],
+                volumes=service.volumes + tuple(extra_volumes))
 
         services = [docker.BUILT_INS[name] for name in depends_on]
         services += extra_services or []
         # NOTE: names need to stay boring and consistent
         # so that state that lives in MySQL &etc type
         # containers isn't lost between SETUP and START
-        compose_name = self.name  # + '-' + compose_name_suffix
+        compose_name = compose_name or self.name  # + '-' + compose_name_suffix
         composition = docker.Dockercompose(compose_name, [service] + services)
 
         trace = []
@@ -350,7 +550,7 @@ class Service(object):
                 raise
 
         compose_thread = threading.Thread(
-            target=catch_trace,
+            name='compose_' + compose_name, target=catch_trace,
             args=(self.docker_runner.run_composition,
                   (composition, compose_name)))
         compose_thread.daemon = True
@@ -368,7 +568,8 @@ class Service(object):
             self._wait_for_container(container, sleep)
             # since the container is just running sleep infinity,
             # it is ready to go
-            self.docker_runner.interact(container, entrypoint, root=root)
+            self.docker_runner.interact(container, entrypoint, root=root,
+                                        output=output)
         finally:
             if self.docker_runner.get_container_id(container):
                 self.docker_runner.stop(container)
@@ -412,7 +613,8 @@ class Service(object):
                     skydep.path, skydep.name)
         volumes = (
             self.code_path + ':/home/app/' + self.name,
-            '/private/var/log/services:/var/log/services'
+            '/private/var/log/services:/var/log/services',
+            PYTEST_CACHE_VOLUME,
             ) + tuple(cached.values())
         if os.path.exists(self.project_dir + '/integration_test'):
             volumes += (
@@ -420,18 +622,37 @@ class Service(object):
                 '/home/app/integration_test',)
         return volumes
 
-    def _fetch_skydeps(self):
+    def _fetch_skydeps(self, stages=None):
         '''
-        Fetch all of the sky dependencies to local paths.
+        Fetch all of the sky dependencies to local paths. With *stages*,
+        the fetch is skipped if the same dependencies were fetched by
+        the last setup, and their refspecs still resolve to the same
+        commits on the remotes.
         '''
+        skydeps = self.config['library_deps']['sky']
+        inputs, fetched = [], True
+        for skydep in skydeps if stages else ():
+            sha = None
+            if not skydep.is_local:
+                sha = self.cache.get_remote_sha(skydep.repo, skydep.refspec)
+                fetched = (fetched and sha is not None and
+                           os.path.isdir(self.sky_deps_dir + '/' + skydep.name))
+            inputs.append([attr.asdict(skydep), sha])
+        is_current = fetched and stages and stages.is_current('skydeps', inputs)
+        if is_current and skydeps:
+            self.logger.comment('sky dependencies unchanged, skipping fetch')
         skydep_paths = {}
-        for skydep in self.config['library_deps']['sky']:
+        for skydep in skydeps:
             if skydep.is_local:
                 skydep_paths[skydep.name] = skydep.path
+            elif is_current:
+                skydep_paths[skydep.name] = self.sky_deps_dir + '/' + skydep.name
             else:
                 skydep_paths[skydep.name] = self.cache.pull_git_to(
                     self.sky_deps_dir + '/' + skydep.name,
                     skydep.repo, skydep.refspec)
+        if stages and not is_current:
+            stages.record('skydeps', inputs)
         return skydep_paths
 
     def _collect_lib_deps(self, sky_dep_paths):
@@ -510,6 +731,41 @@ class Service(object):
         sys.stderr.write(''.join(colorized) + '\n')
 
 
+@attr.s
+class SetupStages(object):
+    '''
+    Fingerprints of the inputs of each stage of the last setup, saved
+    to *path* as each stage finishes so that the stages with unchanged
+    inputs can be skipped by the next setup. With *force*, no stage
+    is current.
+    '''
+    path = attr.ib()
+    force = attr.ib(default=False)
+    fingerprints = attr.ib(default=attr.Factory(dict))
+
+    @classmethod
+    def load(cls, path, force=False):
+        try:
+            with open(path) as stages_file:
+                fingerprints = json.load(stages_file)
+        except (IOError, ValueError):
+            fingerprints = {}
+        return cls(path, force, fingerprints)
+
+    def is_current(self, stage, inputs):
+        return not self.force and self.fingerprints.get(stage) == _fingerprint(inputs)
+
+    def record(self, stage, inputs):
+        self.fingerprints[stage] = _fingerprint(inputs)
+        with fileutils.atomic_save(self.path) as stages_file:
+            json.dump(self.fingerprints, stages_file, indent=2, sort_keys=True)
+
+
+def _fingerprint(inputs):
+    'hash of json-serializable *inputs*'
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True)).hexdigest()
+
+
 def _fmt_pip_cmd(pkgs, find_links_urls, extra_index_urls):
     if not pkgs:
         return ":  # no-op pip install"
@@ -560,6 +816,135 @@ def _ensure(pkg, cls):
     return cls.parse(pkg)
 
 
+def is_test_path(arg, project_dir):
+    '''
+    Whether pytest argument *arg* is a test path, in the container
+    (/home/app/...) or relative to *project_dir*, rather than an
+    option or its value.
+    '''
+    path = arg.split('::', 1)[0]
+    if path.startswith('/home/app/'):
+        return True
+    return not arg.startswith('-') and os.path.exists(
+        os.path.join(project_dir, path))
+
+
+def find_changed_tests(code_path, since):
+    '''
+    Relative paths of the test modules under *code_path* affected by
+    files modified after the *since* timestamp: the changed test
+    modules, and the test modules named after changed modules
+    (test_foo.py and foo_test.py for foo.py).
+    '''
+    changed, tests = set(), {}
+    for dirpath, dirnames, filenames in os.walk(code_path):
+        dirnames[:] = [dirname for dirname in dirnames
+                       if not dirname.startswith('.')]
+        for filename in filenames:
+            if not filename.endswith('.py'):
+                continue
+            path = os.path.join(dirpath, filename)
+            module = filename[:-3]
+            if module.startswith('test_'):
+                tests[os.path.relpath(path, code_path)] = (module, module[5:])
+            elif module.endswith('_test'):
+                tests[os.path.relpath(path, code_path)] = (module, module[:-5])
+            if os.path.getmtime(path) > since:
+                changed.add(module)
+    return [rel_path for rel_path, names in sorted(tests.items())
+            if changed.intersection(names)]
+
+
+def find_test_modules(test_dir):
+    'relative paths of the pytest modules under *test_dir*'
+    ret = []
+    for dirpath, dirnames, filenames in os.walk(test_dir):
+        dirnames[:] = sorted([dirname for dirname in dirnames
+                              if not dirname.startswith('.')])
+        for filename in sorted(filenames):
+            if filename.endswith('.py') and (
+                    filename.startswith('test_') or filename.endswith('_test.py')):
+                ret.append(os.path.relpath(os.path.join(dirpath, filename), test_dir))
+    return sorted(ret)
+
+
+def load_junit_durations(report_path):
+    '''
+    Total time of the tests of each module (by file name) in the JUnit
+    report at *report_path*, or an empty dict if there is no report.
+    '''
+    if not os.path.exists(report_path):
+        return {}
+    durations = collections.defaultdict(float)
+    for case in ElementTree.parse(report_path).getroot().iter('testcase'):
+        if case.get('file'):
+            filename = os.path.basename(case.get('file'))
+        else:  # e.g., "integration_test.test_foo.TestFoo"
+            modules = [part for part in case.get('classname', '').split('.')
+                       if part.startswith('test_') or part.endswith('_test')]
+            if not modules:
+                continue
+            filename = modules[0] + '.py'
+        durations[filename] += float(case.get('time') or 0)
+    return dict(durations)
+
+
+def split_by_duration(paths, durations, count):
+    '''
+    Split *paths* into *count* lists of about equal total duration (by
+    file name in *durations*), assigning the longest first to the
+    least loaded list. Paths without a duration count as the average.
+    '''
+    known = [durations[os.path.basename(path)] for path in paths
+             if os.path.basename(path) in durations]
+    default = sum(known) / len(known) if known else 1.0
+    by_duration = sorted(
+        paths, key=lambda path: -durations.get(os.path.basename(path), default))
+    shards = [[] for i in range(count)]
+    loads = [0.0] * count
+    for path in by_duration:
+        index = loads.index(min(loads))
+        shards[index].append(path)
+        loads[index] += durations.get(os.path.basename(path), default)
+    return [sorted(shard) for shard in shards]
+
+
+def merge_junit_reports(report_paths, dest_path):
+    '''
+    Merge the testsuites of the JUnit reports at *report_paths* into a
+    single testsuite written to *dest_path*. Returns the totals.
+    '''
+    merged = ElementTree.Element('testsuite', name='integration_test')
+    totals = collections.Counter(tests=0, errors=0, failures=0, skips=0)
+    for report_path in sorted(report_paths):
+        root = ElementTree.parse(report_path).getroot()
+        suites = [root] if root.tag == 'testsuite' else root.findall('testsuite')
+        for suite in suites:
+            for key in ('tests', 'errors', 'failures', 'skips'):
+                totals[key] += int(suite.get(key) or 0)
+            totals['time'] += float(suite.get('time') or 0)
+            merged.extend(suite.findall('testcase'))
+    for key, value in totals.items():
+        merged.set(key, str(value))
+    ElementTree.ElementTree(merged).write(
+        dest_path, encoding='utf-8', xml_declaration=True)
+    return totals
+
+
+# where sharded int_test runs put their JUnit reports, mounted
+# from build/int-test
+INT_TEST_RESULTS_DIR = '/home/app/int-test-results'
+
+
+# where START_PROFILE writes profiles, mounted from build/profile
+PROFILE_DATA_DIR = '/home/app/profile-data'
+
+
+# named volume (per compose project) so that the pytest cache
+# outlives the container, see PYTEST_CACHE_DIR in main.py
+PYTEST_CACHE_VOLUME = 'pytest_cache:/home/app/.pytest_cache'
+
+
 #TODO: where should these really come from?
 HOST_PORTS = {
   'partners':          ['partners:9022'],
@@ -2,6 +2,9 @@
 # See LICENSE for details.
 import sys
 import json
+import time
+import errno
+import select
 import socket
 import argparse
 
@@ -18,6 +21,9 @@ class InvalidPort(ValueError):
     pass
 
 
+CONNECT_TIMEOUT = 1.0  # seconds, for all ports together
+
+
 def json_dumps(obj, pretty=True):
     if pretty:
         return json.dumps(obj, indent=2, sort_keys=True)
@@ -63,6 +69,11 @@ def get_argparser():
     check_prs = subprs.add_parser('check', description=desc)
     add_arg = check_prs.add_argument
     add_arg('--json', action='store_true', help='output structured json')
+    add_arg('--watch', action='store_true',
+            help='keep checking, updating the output as statuses change')
+    add_arg('--interval', type=float, metavar='SECONDS',
+            help='seconds between checks with --watch (default 2),'
+            ' implies --watch')
     add_arg('services', nargs='*',
             help='one or more service_names or aliases to start')
     check_prs.set_defaults(func=check_services)
@@ -88,27 +99,11 @@ def check_services(args, reqs):
     # TODO: support args for filtering by services
     site_config = reqs.site_config
     service_map = site_config['services']
-    res = {}
     images, _ = _resolve_images(site_config, service_map.keys())
-    for image in images:
-        ports = [int(p.partition(':')[0]) for p in image.ports]
-        ext_port_map = dict([(int(p.partition(':')[0]), int(p.partition(':')[2]))
-                             for p in image.ports])
-        res[image.name] = {'ports':{}, 'container_id': None, 'status': 'down'}
-        if not ports:
-            continue
-        for port in ports:
-            res[image.name]['ports'][port] = _is_port_open(port)
-        primary_port = ports[0]
-        is_up = res[image.name]['ports'][primary_port]
-        if is_up:
-            res[image.name]['status'] = 'up'
-            try:
-                cid = reqs.docker_runner.get_port_container_id(ext_port_map[primary_port])
-            except shell.ShellSubprocessError:
-                # TODO: remove this once we safely depend on docker 17.06+
-                cid = None
-            res[image.name]['container_id'] = cid
+    if args.watch or args.interval is not None:
+        interval = 2.0 if args.interval is None else args.interval
+        return watch_services(images, reqs.docker_runner, interval, args.json)
+    res = get_service_status(images, reqs.docker_runner)
 
     if args.json:
         print json_dumps(res)
@@ -117,6 +112,102 @@ def check_services(args, reqs):
     return
 
 
+def watch_services(images, docker_runner, interval, as_json=False):
+    '''
+    Re-check *images* every *interval* seconds until interrupted. The
+    table is redrawn in place, only rewriting the rows that changed
+    (or printed again on change, if stdout isn't a terminal). With
+    *as_json*, each service whose status changed is written as a JSON
+    line instead.
+    '''
+    port_cache = {}
+    prev_res, prev_lines = {}, None
+    is_tty = sys.stdout.isatty()
+    try:
+        while True:
+            start = time.time()
+            res = get_service_status(images, docker_runner, port_cache=port_cache)
+            if as_json:
+                for name, status in sorted(res.items()):
+                    if prev_res.get(name) != status:
+                        delta = dict(status, service=name, time=start)
+                        sys.stdout.write(json_dumps(delta, pretty=False) + '\n')
+            else:
+                lines = table_dumps(res).splitlines()
+                if not is_tty:
+                    if lines != prev_lines:
+                        sys.stdout.write('\n'.join(lines) + '\n\n')
+                else:
+                    sys.stdout.write(_redraw_lines(prev_lines, lines))
+                prev_lines = lines
+            sys.stdout.flush()
+            prev_res = res
+            time.sleep(max(0, interval - (time.time() - start)))
+    except KeyboardInterrupt:
+        pass
+    return
+
+
+def _redraw_lines(prev_lines, lines):
+    '''
+    The terminal output to turn *prev_lines*, already printed above the
+    cursor, into *lines*, rewriting only the lines that differ.
+    '''
+    if prev_lines is None:
+        return '\n'.join(lines) + '\n'
+    if len(prev_lines) != len(lines):
+        return ('\x1b[%dA\r\x1b[J' % len(prev_lines)) + '\n'.join(lines) + '\n'
+    out = []
+    for i, (prev_line, line) in enumerate(zip(prev_lines, lines)):
+        if prev_line != line:
+            offset = len(lines) - i
+            out.append('\x1b[%dA\r%s\x1b[K\x1b[%dB\r' % (offset, line, offset))
+    return ''.join(out)
+
+
+def get_service_status(images, docker_runner, timeout=CONNECT_TIMEOUT,
+                       port_cache=None):
+    '''
+    Check the ports of all *images* at once, then look up the
+    containers of the ones that are up with a single docker call.
+
+    If a *port_cache* dict is passed, it is used and kept updated with
+    the published port map, so docker is only called when a service
+    that wasn't up before comes up.
+    '''
+    all_ports = sum([_get_host_ports(image) for image in images], [])
+    open_ports = _check_ports(all_ports, timeout=timeout)
+    res = {}
+    for image in images:
+        ports = _get_host_ports(image)
+        res[image.name] = {'ports': dict([(p, open_ports[p]) for p in ports]),
+                           'container_id': None, 'status': 'down'}
+        if ports and open_ports[ports[0]]:
+            res[image.name]['status'] = 'up'
+
+    if port_cache is None:
+        port_cache = {}
+    up_ports = [_get_host_ports(image)[0] for image in images
+                if res[image.name]['status'] == 'up']
+    if [port for port in up_ports if port not in port_cache]:
+        port_cache.clear()
+        try:
+            port_cache.update(docker_runner.get_published_ports())
+        except shell.ShellSubprocessError:
+            pass
+    for image in images:
+        ports = _get_host_ports(image)
+        if res[image.name]['status'] == 'up':
+            res[image.name]['container_id'] = port_cache.get(ports[0])
+        elif ports:  # may come back up in a different container
+            port_cache.pop(ports[0], None)
+    return res
+
+
+def _get_host_ports(image):
+    return [int(p.partition(':')[0]) for p in image.ports]
+
+
 def table_dumps(res):
     tab = Table(headers=['   name   ', ' port ', 'status', 'container'])
     rows = []
@@ -128,12 +219,36 @@ def table_dumps(res):
     return tab.to_text()
 
 
-def _is_port_open(port, host='127.0.0.1'):
-    port = int(port)
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    res = sock.connect_ex((host, port))
-    sock.close()
-    return res == 0
+def _check_ports(ports, host='127.0.0.1', timeout=CONNECT_TIMEOUT):
+    '''
+    Try connecting to all *ports* on *host* concurrently, with
+    non-blocking sockets. Returns a dict mapping each port to whether
+    it accepted a connection within *timeout* seconds.
+    '''
+    ret, pending = {}, {}
+    for port in set([int(p) for p in ports]):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        err = sock.connect_ex((host, port))
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            pending[sock] = port
+        else:
+            ret[port] = err == 0
+            sock.close()
+    deadline = time.time() + timeout
+    while pending:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        _, connected, _ = select.select([], pending.keys(), [], remaining)
+        for sock in connected:
+            port = pending.pop(sock)
+            ret[port] = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+            sock.close()
+    for sock, port in pending.items():  # timed out
+        ret[port] = False
+        sock.close()
+    return ret
 
 
 def _resolve_images(site_config, image_names):
@@ -5,10 +5,14 @@ Provides API for executing commands against the shell.
 '''
 import os
 import os.path
+import shutil
 
 import attr
 from seashore import ProcessError
 
+# big enough for any config or Dockerfile sky generates
+LOG_FILE_MAX_SIZE = 1024 * 1024
+
 
 class ShellSubprocessError(Exception):
     """This exception type exists for raising when a subprocess call
@@ -110,9 +114,28 @@ class Shell(object):
                 raise ShellSubprocessError(pe.returncode, command, cwd=cwd, env=None)
         assert False  # should never get here
 
-    def log_file(self, path):
+    def log_file(self, path, max_size=LOG_FILE_MAX_SIZE):
+        '''
+        Copy the file at *path* into the log, streaming it and stopping
+        after *max_size* bytes (None for no limit).
+        '''
         if os.path.exists(path):
-            lines = list(open(path))
-            self._log_file.write('### file {0} ({1} lines):\n'.format(path, len(lines)))
-            self._log_file.write(''.join(lines))
+            size = os.path.getsize(path)
+            self._log_file.write('### file {0} ({1} bytes):\n'.format(path, size))
+            with open(path, 'rb') as f:
+                if max_size is None or size <= max_size:
+                    shutil.copyfileobj(f, self._log_file)
+                else:
+                    _copy_head(f, self._log_file, max_size)
+                    self._log_file.write('\n### truncated after {0} bytes\n'.format(
+                        max_size))
             self._log_file.write('### end file {0}\n'.format(path))
+
+
+def _copy_head(src, dst, size, chunk_size=64 * 1024):
+    while size > 0:
+        chunk = src.read(min(chunk_size, size))
+        if not chunk:
+            break
+        dst.write(chunk)
+        size -= len(chunk)
@@ -0,0 +1,167 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+'''
+Rotation of the per-command working directories in ~/.sky/workspace.
+
+Deleting old workspaces can mean deleting gigabytes (docker contexts
+with copied installers, etc.), so command startup only renames
+expired workspaces into a trash directory. A detached reaper process
+empties the trash and enforces a limit on the total size of the
+workspaces.
+
+Workspaces in use are never removed: a command holds a shared lock
+on the log file of its workspace for as long as it runs (see
+open_log()), and a workspace whose log was written to in the last
+ACTIVE_TIME seconds is skipped too, in case its lock can't be checked.
+
+The reaper runs in a plain "python -c", without sky's dependencies,
+so this module only uses the standard library.
+'''
+import os
+import sys
+import time
+import fcntl
+import errno
+import shutil
+import binascii
+import subprocess
+
+NUM_TO_KEEP = 50
+MAX_TOTAL_SIZE = 10 * 1024 ** 3
+MIN_TO_KEEP = 5  # the newest workspaces are never removed for size
+SIZE_CHECK_INTERVAL = 10  # runs between size checks, when the trash is empty
+ACTIVE_TIME = 10 * 60
+LOG_FILE = 'log.txt'
+
+
+def list_workspaces(workdir):
+    'returns a sorted list of (index, dirname) for workspaces in *workdir*'
+    ret = []
+    for fn in os.listdir(workdir):
+        if not os.path.isdir(os.path.join(workdir, fn)):
+            continue
+        try:
+            ret.append((int(fn[:4]), fn))
+        except ValueError:
+            continue
+    return sorted(ret)
+
+
+def rotate(workdir, trash_dir, num_to_keep=NUM_TO_KEEP):
+    '''
+    Move workspaces more than *num_to_keep* runs old into
+    *trash_dir*. Returns the index of the newest workspace, 0 if there
+    are none.
+    '''
+    workspaces = list_workspaces(workdir)
+    last = workspaces[-1][0] if workspaces else 0
+    for index, fn in workspaces:
+        path = os.path.join(workdir, fn)
+        if index < last - num_to_keep and not is_in_use(path):
+            move_to_trash(path, trash_dir)
+    return last
+
+
+def open_log(workspace_path):
+    '''
+    Open the log file of the workspace at *workspace_path* for
+    appending, locked (shared) until it is closed, so the workspace
+    isn't removed while the command using it runs.
+    '''
+    log_file = open(os.path.join(workspace_path, LOG_FILE), 'ab')
+    fcntl.flock(log_file, fcntl.LOCK_SH)
+    return log_file
+
+
+def is_in_use(path, active_time=ACTIVE_TIME):
+    'whether a command may still be using the workspace at *path*'
+    log_path = os.path.join(path, LOG_FILE)
+    try:
+        if time.time() - os.path.getmtime(log_path) < active_time:
+            return True
+        with open(log_path, 'rb') as log_file:
+            fcntl.flock(log_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as ioe:
+        if ioe.errno in (errno.EAGAIN, errno.EACCES):
+            return True
+        if ioe.errno != errno.ENOENT:
+            raise
+    except OSError as ose:
+        if ose.errno != errno.ENOENT:
+            raise
+    return False
+
+
+def move_to_trash(path, trash_dir):
+    # suffixed, as index wraparound can reuse names
+    dest = '%s/%s-%s' % (trash_dir, os.path.basename(path),
+                         binascii.hexlify(os.urandom(4)))
+    os.rename(path, dest)
+
+
+def needs_reaping(trash_dir, last):
+    return bool(os.listdir(trash_dir)) or not (last + 1) % SIZE_CHECK_INTERVAL
+
+
+def spawn_reaper(workdir, trash_dir,
+                 max_size=MAX_TOTAL_SIZE, min_to_keep=MIN_TO_KEEP):
+    'start reap() in a detached process, without waiting for it'
+    import_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    script = ('import sys; sys.path.insert(0, %r); from opensky import workspace;'
+              ' workspace.reap(%r, %r, %r, %r)'
+              % (import_path, workdir, trash_dir, max_size, min_to_keep))
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen([sys.executable, '-c', script], cwd='/', close_fds=True,
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         preexec_fn=os.setsid)
+
+
+def reap(workdir, trash_dir, max_size=MAX_TOTAL_SIZE, min_to_keep=MIN_TO_KEEP):
+    '''
+    Empty *trash_dir*, then trash the oldest workspaces in *workdir*
+    until they total no more than *max_size* bytes, keeping at least
+    the newest *min_to_keep* and any in use. Returns without doing
+    anything if another reaper is running.
+    '''
+    lock_file = open(trash_dir + '.lock', 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as ioe:
+        if ioe.errno in (errno.EAGAIN, errno.EACCES):
+            return
+        raise
+    try:
+        _empty_trash(trash_dir)
+        if not max_size:
+            return
+        workspaces = list_workspaces(workdir)
+        sizes = [(fn, _get_size(os.path.join(workdir, fn)))
+                 for _, fn in workspaces]
+        total_size = sum([size for _, size in sizes])
+        for fn, size in sizes[:-min_to_keep or None]:
+            if total_size <= max_size:
+                break
+            path = os.path.join(workdir, fn)
+            if is_in_use(path):
+                continue
+            move_to_trash(path, trash_dir)
+            total_size -= size
+        _empty_trash(trash_dir)
+    finally:
+        lock_file.close()
+
+
+def _empty_trash(trash_dir):
+    for fn in os.listdir(trash_dir):
+        shutil.rmtree(os.path.join(trash_dir, fn), ignore_errors=True)
+
+
+def _get_size(path):
+    ret = 0
+    for dirpath, _, filenames in os.walk(path):
+        for fn in filenames:
+            try:
+                ret += os.lstat(os.path.join(dirpath, fn)).st_size
+            except OSError:
+                pass
+    return ret
@@ -70,7 +70,8 @@ class SdistCommand(SdistCommandBase):
 GOES_IN_DOCKER_IMAGE = [
   'goes_in_docker_image/' + fname for fname in
   os.listdir(CUR_PATH + '/opensky/goes_in_docker_image/')]
-GOES_IN_DOCKER_IMAGE += ['goes_in_docker_image/debug/sitecustomize.py']
+GOES_IN_DOCKER_IMAGE += ['goes_in_docker_image/debug/sitecustomize.py',
+                         'goes_in_docker_image/profile/sitecustomize.py']
 
 
 if __name__ == '__main__':
@@ -72,6 +72,7 @@ def _build_test_injectables(tmpdir):
         global_sky_path=mktempd('global-sky-path'),
         cache=FakeCache(tmpdir),
         executor=seashore.Executor(FakeShell()),
+        docker_api=None,
         config={
             'name': test_app,
             'repo': 'http://company-gitlab.com/org/test_app.git',
@@ -0,0 +1,162 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+import os
+import distutils.spawn
+
+import lithoxyl
+import seashore
+
+from opensky import cache, shell
+
+
+def test_parse_build_identity():
+    output = ('4d413fd4a0c8b9e1f2d3c4b5a6978877665544332\n'
+              '1492203572\n'
+              '2017-04-14 20:59:32 +0000\n'
+              'HEAD -> feature/x, origin/master, tag: v1\n')
+    ident = cache.parse_build_identity(output, '/tmp/proj')
+    assert ident.sha.startswith('4d413fd4')
+    assert ident.timestamp == 1492203572
+    assert ident.iso_timestamp == '2017-04-14 20:59:32 +0000'
+    assert ident.branch == 'feature/x'
+    assert ident.build_tag == '17.04.14_1492203572_4d413fd4'
+
+    detached = cache.parse_build_identity(
+        '\n'.join(output.splitlines()[:3]) + '\nHEAD, origin/master\n',
+        '/tmp/proj')
+    assert detached.branch == 'HEAD'
+
+
+def test_get_build_identity_memoized(tmpdir):
+    executor = seashore.Executor(seashore.Shell()).chdir(str(tmpdir))
+    git = executor.git
+    git.init().batch()
+    tmpdir.join('README').write('hi')
+    git.add('README').batch()
+    executor.patch_env(
+        GIT_AUTHOR_NAME='t', GIT_AUTHOR_EMAIL='t@t',
+        GIT_COMMITTER_NAME='t', GIT_COMMITTER_EMAIL='t@t').git.commit(
+            message='init').batch()
+
+    ident = cache.get_build_identity(executor, str(tmpdir))
+    assert ident.sha == git.rev_parse('HEAD').batch()[0].strip()
+    assert ident.dirty is False
+    assert cache.get_build_identity(executor, str(tmpdir)) is ident
+
+
+def test_pull_sparse_git(tmpdir):
+    origin = tmpdir.ensure('origin', dir=True)
+    git = seashore.Executor(seashore.Shell()).chdir(str(origin)).patch_env(
+        GIT_AUTHOR_NAME='t', GIT_AUTHOR_EMAIL='t@t',
+        GIT_COMMITTER_NAME='t', GIT_COMMITTER_EMAIL='t@t').git
+    git.init().batch()
+    origin.ensure('packages/index.json').write('{}')
+    origin.ensure('packages/foo/foo-1.0.tar.gz').write('release')
+    git.add('.').batch()
+    git.commit(message='publish').batch()
+
+    logger = lithoxyl.Logger('test')
+    log_file = tmpdir.join('log').open('w')
+    executor = seashore.Executor(
+        shell.Shell(seashore.Shell(), logger, log_file))
+    dep_cache = cache.DependencyCache(
+        executor, logger, str(tmpdir.join('cache')), str(tmpdir.join('proj')))
+    remote = 'file://' + str(origin)
+    repo = dep_cache.pull_sparse_git('pypier', remote, ['/packages/index.json'])
+    assert os.path.exists(repo.path + '/packages/index.json')
+    assert not os.path.exists(repo.path + '/packages/foo')
+    with open(repo.materialize('packages/foo/foo-1.0.tar.gz')) as f:
+        assert f.read() == 'release'
+
+    # updates in place
+    origin.join('packages/index.json').write('{"packages": {}}')
+    git.commit('packages/index.json', message='reindex').batch()
+    repo = dep_cache.pull_sparse_git('pypier', remote, ['/packages/index.json'])
+    with open(repo.path + '/packages/index.json') as f:
+        assert f.read() == '{"packages": {}}'
+
+    # other sparse paths get another checkout, and leave this one alone
+    full = dep_cache.pull_sparse_git('pypier-packages', remote, ['/packages/'])
+    assert full.path != repo.path
+    assert os.path.exists(full.path + '/packages/foo/foo-1.0.tar.gz')
+    dep_cache.pull_sparse_git('pypier', remote, ['/packages/index.json'])
+    assert os.path.exists(full.path + '/packages/foo/foo-1.0.tar.gz')
+
+    # another remote under the same name doesn't reuse the checkout
+    other = tmpdir.ensure('other', dir=True)
+    other_git = seashore.Executor(seashore.Shell()).chdir(str(other)).patch_env(
+        GIT_AUTHOR_NAME='t', GIT_AUTHOR_EMAIL='t@t',
+        GIT_COMMITTER_NAME='t', GIT_COMMITTER_EMAIL='t@t').git
+    other_git.init().batch()
+    other.ensure('packages/index.json').write('{"other": true}')
+    other_git.add('.').batch()
+    other_git.commit(message='publish').batch()
+    other_repo = dep_cache.pull_sparse_git(
+        'pypier', 'file://' + str(other), ['/packages/index.json'])
+    assert other_repo.path != repo.path
+    with open(other_repo.path + '/packages/index.json') as f:
+        assert f.read() == '{"other": true}'
+
+
+def test_pull_sparse_git_without_partial_clone(tmpdir):
+    origin = tmpdir.ensure('origin', dir=True)
+    git = seashore.Executor(seashore.Shell()).chdir(str(origin)).patch_env(
+        GIT_AUTHOR_NAME='t', GIT_AUTHOR_EMAIL='t@t',
+        GIT_COMMITTER_NAME='t', GIT_COMMITTER_EMAIL='t@t').git
+    git.init().batch()
+    origin.ensure('packages/index.json').write('{}')
+    git.add('.').batch()
+    git.commit(message='publish').batch()
+
+    # a git that fails like one without --filter, before creating dest
+    real_git = distutils.spawn.find_executable('git')
+    fake_git = tmpdir.ensure('bin/git')
+    fake_git.write('#!/bin/sh\n'
+                   'case "$*" in *--filter=*) exit 129;; esac\n'
+                   'exec %s "$@"\n' % real_git)
+    fake_git.chmod(0o755)
+    logger = lithoxyl.Logger('test')
+    log_file = tmpdir.join('log').open('w')
+    executor = seashore.Executor(
+        shell.Shell(seashore.Shell(), logger, log_file)).patch_env(
+            PATH=str(fake_git.dirpath()) + os.pathsep + os.environ['PATH'])
+    dep_cache = cache.DependencyCache(
+        executor, logger, str(tmpdir.join('cache')), str(tmpdir.join('proj')))
+    repo = dep_cache.pull_sparse_git(
+        'pypier', 'file://' + str(origin), ['/packages/index.json'])
+    with open(repo.path + '/packages/index.json') as f:
+        assert f.read() == '{}'
+
+
+def test_get_remote_sha(tmpdir):
+    origin = tmpdir.ensure('origin', dir=True)
+    executor = seashore.Executor(seashore.Shell()).chdir(str(origin)).patch_env(
+        GIT_AUTHOR_NAME='t', GIT_AUTHOR_EMAIL='t@t',
+        GIT_COMMITTER_NAME='t', GIT_COMMITTER_EMAIL='t@t')
+    executor.git.init().batch()
+    origin.join('README').write('hi')
+    executor.git.add('README').batch()
+    executor.git.commit(message='init').batch()
+    executor.git.branch('release').batch()
+
+    logger = lithoxyl.Logger('test')
+    log_file = tmpdir.join('log').open('w')
+    dep_cache = cache.DependencyCache(
+        seashore.Executor(shell.Shell(seashore.Shell(), logger, log_file)),
+        logger, str(tmpdir.join('cache')), str(tmpdir.join('proj')))
+    remote = 'file://' + str(origin)
+    head = executor.git.rev_parse('HEAD').batch()[0].strip()
+    assert dep_cache.get_remote_sha(remote, 'release') == head
+
+    origin.join('README').write('bye')
+    executor.git.commit('README', message='update').batch()
+    executor.git.branch('release', force=None).batch()
+    new_head = executor.git.rev_parse('HEAD').batch()[0].strip()
+    assert dep_cache.get_remote_sha(remote, 'release') == new_head != head
+    # only exact refs, not others ending in the name (sorted first)
+    executor.git.branch('old/release', head).batch()
+    assert dep_cache.get_remote_sha(remote, 'release') == new_head
+    executor.git.tag('v1', head, annotate=None, message='v1').batch()
+    assert dep_cache.get_remote_sha(remote, 'v1') == head  # the commit
+    assert dep_cache.get_remote_sha(remote, head) == head  # not a ref
+    assert dep_cache.get_remote_sha('file://' + str(tmpdir.join('gone')), 'release') is None
@@ -0,0 +1,96 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+import json
+import threading
+import urlparse
+import SocketServer
+import BaseHTTPServer
+
+import lithoxyl
+import seashore
+
+from opensky import docker, docker_api
+
+
+CONTAINERS = [
+    {'Id': 'a1b2c3d4e5f6' + '0' * 52, 'Names': ['/app_mysql_1'],
+     'Ports': [{'PrivatePort': 3306, 'PublicPort': 3306, 'Type': 'tcp'},
+               {'PrivatePort': 33060, 'Type': 'tcp'}]}]
+
+
+class StubDockerServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path):
+        SocketServer.UnixStreamServer.__init__(self, path, StubDockerHandler)
+        self.requests, self.connections = [], 0
+
+
+class StubDockerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def _respond(self, status, body=None):
+        body = '' if body is None else json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self):
+        url = urlparse.urlsplit(self.path)
+        query = urlparse.parse_qs(url.query)
+        self.server.requests.append((self.command, url.path, query))
+        if url.path == '/v1.25/containers/json':
+            filters = json.loads(query.get('filters', ['{}'])[0])
+            names = filters.get('name', [''])
+            self._respond(200, [c for c in CONTAINERS
+                                if names[0] in c['Names'][0]])
+        elif url.path == '/v1.25/containers/missing/stop':
+            self._respond(404, {'message': 'No such container: missing'})
+        elif self.command in ('POST', 'DELETE'):
+            self._respond(204)
+        else:
+            self._respond(404, {'message': 'page not found'})
+
+    do_GET = do_POST = do_DELETE = _handle
+
+    def log_message(self, *a):
+        pass
+
+
+def test_runner_docker_api(tmpdir):
+    socket_path = str(tmpdir.join('docker.sock'))
+    server = StubDockerServer(socket_path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    client = docker_api.DockerAPIClient.from_env(
+        False, {'DOCKER_HOST': 'unix://' + socket_path})
+    assert docker_api.DockerAPIClient.from_env(True) is None
+    assert docker_api.DockerAPIClient.from_env(
+        False, {'DOCKER_HOST': 'tcp://192.168.99.100:2376'}) is None
+
+    runner = docker.Runner(seashore.Executor(seashore.Shell()), None,
+                           lithoxyl.Logger('test'), str(tmpdir.join('docker')),
+                           docker_api=client)
+    try:
+        assert runner.get_container_id('app_mysql') == 'a1b2c3d4e5f6'
+        assert runner.get_container_id('nope') is None
+        assert runner.get_published_ports() == {3306: 'a1b2c3d4e5f6'}
+        runner.kill('app_mysql_1')
+        assert server.requests[-2:] == [
+            ('POST', '/v1.25/containers/app_mysql_1/kill', {}),
+            ('DELETE', '/v1.25/containers/app_mysql_1', {})]
+        # API errors fall back to the CLI, the CLI is missing here
+        assert runner._try_api('stop', 'missing') is docker._NO_API
+        assert server.connections == 1
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
@@ -1,9 +1,13 @@
 # Copyright (c) Shopkick 2017
 # See LICENSE for details.
+import os
+
+import pytest
 import seashore
 import attr
+import lithoxyl
 
-from opensky import docker
+from opensky import docker, shell
 
 
 def test_in_ensured_docker_machine():
@@ -78,3 +82,138 @@ SET DOCKER_MACHINE_NAME=test
 REM Run this command to configure your shell: 
 REM     @FOR /f "tokens=*" %i IN ('docker-machine env --shell cmd test') DO @%i
 '''
+
+
+def test_build_step_index(tmpdir):
+    log_file = tmpdir.join('log.txt').open('w')
+    executor = seashore.Executor(
+        shell.Shell(seashore.Shell(), lithoxyl.Logger('test'), log_file))
+    runner = docker.Runner(executor, None, None, str(tmpdir.join('docker')),
+                           log_file=log_file)
+    build_output = ('Step 1/2 : FROM centos\\n ---> 3fa822599e10\\n'
+                    'Step 2/2 : RUN false\\n ---> Running in 8f1a2b3c4d5e\\n')
+    recorder = docker.BuildStepRecorder('app', 'app:latest')
+    runner._stream_output(runner.executor.command(
+        ['printf', build_output]), recorder.feed)
+    assert recorder.last_image_id == '3fa822599e10'
+    assert recorder.last_step == 'Step 2/2 : RUN false'
+    log_file.close()
+    assert tmpdir.join('log.txt').read().endswith(build_output.replace('\\n', '\n'))
+
+    recorder.failed = True
+    recorder.save(runner.docker_path + '/' + docker.BUILD_STEPS_FILE)
+    newer = docker.BuildStepRecorder('app', 'app:latest', last_image_id='0123456789ab')
+    newer.save(str(tmpdir.ensure('newer', dir=True).join(docker.BUILD_STEPS_FILE)))
+
+    build = docker.find_last_build([str(tmpdir.join('newer')), runner.docker_path])
+    assert build['last_image_id'] == '3fa822599e10'
+    assert docker.find_last_build([str(tmpdir.join('newer'))])['name'] == 'app'
+    assert docker.find_last_build([str(tmpdir.join('missing'))]) is None
+
+
+@attr.s
+class RecordingShell(object):
+    calls = attr.ib(default=attr.Factory(list))
+    running = attr.ib(default=None)
+    image_ids = attr.ib(default=attr.Factory(dict))
+    interrupt_on = attr.ib(default=None)
+
+    def _do_cmd(self, cmd, **kw):
+        self.calls.append(cmd)
+        if self.interrupt_on is not None and self.interrupt_on in cmd:
+            raise KeyboardInterrupt()
+        if cmd[:2] == ['docker', 'inspect']:
+            if self.running is None:
+                raise shell.ShellSubprocessError(1, cmd, None, None)
+            return self.running + '\n', ''
+        if cmd[:2] == ['docker', 'images']:
+            return self.image_ids.get(cmd[-1], '') + '\n', ''
+        return '', ''
+
+    batch = redirect = interactive = _do_cmd
+
+    def clone(self):
+        return self
+
+    def setenv(self, key, val):
+        pass
+
+    def chdir(self, path):
+        pass
+
+
+def _compose_args(calls):
+    'the docker-compose arguments of each docker exec in *calls*'
+    return [c[c.index('--file') + 2:] for c in calls
+            if c[:2] == ['docker', 'exec'] and '--file' in c]
+
+
+def test_compose_helper_reuse(tmpdir):
+    sh = RecordingShell()
+    runner = docker.Runner(seashore.Executor(sh), shell.Shell(None, None, open(os.devnull, 'w')),
+                           lithoxyl.Logger('test'), str(tmpdir.join('docker')),
+                           use_docker_machine=True, global_sky_path=str(tmpdir))
+    composition = docker.Dockercompose(
+        'app', [docker.ImageService(name='redis', image='redis')])
+    runner.clean_composition(composition, 'app')
+    compose_file, = tmpdir.join('compose/app').listdir('docker-compose-*.yml')
+    mtime = compose_file.mtime()
+    assert sh.calls[1][:3] == ['docker', 'run', '--detach']
+    assert sh.calls[2][:2] == ['docker', 'exec']
+    assert sh.calls[2][-3:] == [str(compose_file), 'down', '--remove-orphans']
+
+    sh.running, sh.calls[:] = 'true', []
+    os.utime(str(compose_file), (0, 0))
+    runner.clean_composition(composition, 'app')
+    assert [c[:2] for c in sh.calls] == [['docker', 'inspect'], ['docker', 'exec']]
+    assert compose_file.mtime() == 0  # unchanged, not rewritten
+    assert mtime != 0
+
+
+def test_service_fingerprints(tmpdir):
+    sh = RecordingShell(running='true', image_ids={'mysql': 'aaa', 'app:dev': 'bbb'})
+    runner = docker.Runner(seashore.Executor(sh), shell.Shell(None, None, open(os.devnull, 'w')),
+                           lithoxyl.Logger('test'), str(tmpdir.join('docker')),
+                           use_docker_machine=True, global_sky_path=str(tmpdir))
+    mysql = docker.ImageService(name='mysql', image='mysql')
+    composition = docker.Dockercompose(
+        'app', [mysql, docker.ImageService(name='app_server', image='app:dev')])
+    fingerprints = runner.get_service_fingerprints(composition)
+
+    sh.image_ids['app:dev'] = 'ccc'  # rebuilt
+    rebuilt = runner.get_service_fingerprints(composition)
+    assert rebuilt['mysql'] == fingerprints['mysql']
+    assert rebuilt['app_server'] != fingerprints['app_server']
+    # independent of the rest of the composition
+    alone = runner.get_service_fingerprints(docker.Dockercompose('app', [mysql]))
+    assert alone == {'mysql': fingerprints['mysql']}
+
+    # a smaller composition (e.g., for TEST) doesn't remove the others
+    sh.calls[:] = []
+    runner.run_composition(composition, 'app')
+    assert _compose_args(sh.calls) == [['up', '--abort-on-container-exit']]
+
+
+def test_compose_exec_interrupted(tmpdir):
+    sh = RecordingShell(running='true', interrupt_on='up')
+    runner = docker.Runner(seashore.Executor(sh), shell.Shell(None, None, open(os.devnull, 'w')),
+                           lithoxyl.Logger('test'), str(tmpdir.join('docker')),
+                           use_docker_machine=True, global_sky_path=str(tmpdir))
+    redis = docker.ImageService(name='redis', image='redis')
+    with pytest.raises(KeyboardInterrupt):
+        runner.run_composition(docker.Dockercompose('app', [redis]), 'app')
+    up_cmd, stop_cmd = sh.calls[-2:]
+    pid_path = up_cmd[up_cmd.index('-c') + 2]
+    assert stop_cmd[:3] == ['docker', 'exec', up_cmd[4]]
+    assert 'kill -TERM' in stop_cmd[-2] and stop_cmd[-1] == pid_path
+    assert not os.path.exists(pid_path)
+
+    # a different composition in the same namespace gets its own file,
+    # and the files of others are removed once they're old enough
+    first, = tmpdir.join('compose/app').listdir('docker-compose-*.yml')
+    runner.clean_composition(docker.Dockercompose('app', [attr.assoc(redis, image='redis:4')]), 'app')
+    assert len(tmpdir.join('compose/app').listdir('docker-compose-*.yml')) == 2
+    os.utime(str(first), (0, 0))
+    runner.clean_composition(docker.Dockercompose('app', [attr.assoc(redis, image='redis:5')]), 'app')
+    files = tmpdir.join('compose/app').listdir('docker-compose-*.yml')
+    assert len(files) == 2 and first not in files
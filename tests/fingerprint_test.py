@@ -0,0 +1,24 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+from opensky import fingerprint
+
+
+def test_fingerprint_tree(tmpdir):
+    tmpdir.ensure('mysql/001_init.py').write('create')
+    tmpdir.ensure('cassandra/001_init.cql').write('create')
+    first = fingerprint.fingerprint_tree(str(tmpdir))
+    # a fixed vector: a change of algorithm re-runs every migrations stage
+    assert first == FIRST_FINGERPRINT
+    tmpdir.ensure('mysql/001_init.pyc').write('bytecode')
+    assert fingerprint.fingerprint_tree(str(tmpdir)) == first
+    tmpdir.ensure('mysql/002_add.py').write('alter')
+    assert fingerprint.fingerprint_tree(str(tmpdir)) != first
+
+    mysql_only = fingerprint.fingerprint_tree(
+        str(tmpdir), exclude=[str(tmpdir.join('cassandra'))])
+    tmpdir.ensure('cassandra/002_add.cql').write('alter')
+    assert fingerprint.fingerprint_tree(
+        str(tmpdir), exclude=[str(tmpdir.join('cassandra'))]) == mysql_only
+
+
+FIRST_FINGERPRINT = 'f453fce9d4d4cf5b8ac072b08efa41ba359dc38f'
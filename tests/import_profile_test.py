@@ -0,0 +1,17 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+from opensky import import_profile
+
+
+def test_parse_import_times():
+    output = '\n'.join([
+        'sky is your gateway to service development',
+        'import time: self [us] | cumulative | imported package',
+        'import time:        365 |        570 |     gather.venusian',
+        'import time:       1448 |       2018 |   gather',
+        'import time:       1322 |       3340 | opensky.plugins'])
+    imports = import_profile.parse_import_times(output)
+    assert [(imp['name'], imp['depth']) for imp in imports] == [
+        ('gather.venusian', 2), ('gather', 1), ('opensky.plugins', 0)]
+    assert imports[1]['self_us'] == 1448
+    assert imports[2]['cumulative_us'] == 3340
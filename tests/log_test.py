@@ -0,0 +1,115 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+import sys
+import json
+import threading
+import StringIO
+
+import lithoxyl
+import seashore
+
+from opensky import log, shell, perf_plugin
+
+
+def test_tail_lines(tmpdir):
+    path = tmpdir.join('log.txt')
+    lines = ['line %s\n' % i for i in range(1000)]
+    path.write(''.join(lines))
+    assert log.tail_lines(str(path), 20, block_size=64) == lines[-20:]
+    assert log.tail_lines(str(path), 2000) == lines
+    path.write('no newline\nat the end')
+    assert log.tail_lines(str(path), 1, block_size=4) == ['at the end']
+    path.write('pulling\n10%\r50%\r100%\ndone\n')  # progress bars
+    assert log.tail_lines(str(path), 2) == ['10%\r50%\r100%\n', 'done\n']
+    path.write('')
+    assert log.tail_lines(str(path)) == []
+
+
+def test_shell_log_file_cap(tmpdir):
+    log_file = tmpdir.join('log.txt').open('w')
+    sh = shell.Shell(seashore.Shell(), lithoxyl.Logger('test'), log_file)
+    big_file = tmpdir.join('big.txt')
+    big_file.write('x' * 100)
+    sh.log_file(str(big_file), max_size=10)
+    sh.log_file(str(big_file))
+    log_file.close()
+    logged = tmpdir.join('log.txt').read()
+    assert '(100 bytes)' in logged
+    assert 'x' * 10 + '\n### truncated after 10 bytes' in logged
+    assert 'x' * 100 in logged
+
+
+def test_json_lines_sink_and_perf_report(tmpdir):
+    events_file = tmpdir.join(log.EVENTS_FILE).open('w')
+    logger = lithoxyl.Logger('test', sinks=[log.JSONLinesSink(events_file)])
+    with logger.info('setup'):
+        with logger.info('git_mirror_{name}', name='foo'):
+            pass
+        with logger.info('docker build /tmp/ctx --tag x'):
+            pass
+    events_file.close()
+
+    events = perf_plugin.load_events(str(tmpdir.join(log.EVENTS_FILE)))
+    assert [e['name'] for e in events] == [
+        'git_mirror_{name}', 'docker build /tmp/ctx --tag x', 'setup']
+    assert events[0]['parent_id'] == events[2]['id']
+    assert events[0]['data'] == {'name': 'foo'}
+    assert events[2]['end'] - events[2]['begin'] == events[2]['duration']
+
+    stats = perf_plugin.aggregate_events([events, events])
+    by_name = dict([(s['name'], s) for s in stats])
+    assert stats[0]['name'] == 'setup'
+    assert by_name['docker build']['count'] == 2
+    assert by_name['setup']['self'] <= by_name['setup']['total']
+
+
+def test_chrome_trace_sink(tmpdir):
+    trace_path = str(tmpdir.join('trace.json'))
+    sink = log.ChromeTraceSink(trace_path)
+    logger = lithoxyl.Logger('test', sinks=[sink])
+
+    def in_thread():
+        with logger.info('in_thread'):
+            pass
+
+    with logger.info('outer', name='x'):
+        thread = threading.Thread(target=in_thread, name='worker')
+        thread.start()
+        thread.join()
+    sink.write()
+
+    with open(trace_path) as f:
+        trace = json.load(f)['traceEvents']
+    events = dict([(e['name'], e) for e in trace if e['ph'] == 'X'])
+    thread_names = dict([(e['tid'], e['args']['name'])
+                         for e in trace if e['ph'] == 'M'])
+    assert thread_names[events['in_thread']['tid']] == 'worker'
+    assert thread_names[events['outer']['tid']] == 'MainThread'
+    assert events['outer']['args'] == {'name': "'x'", 'status': 'success'}
+    assert events['outer']['dur'] >= events['in_thread']['dur']
+
+
+def test_progress_renderer(monkeypatch):
+    out = StringIO.StringIO()
+    monkeypatch.setattr(sys, 'stderr', out)
+    progress = log.ProgressRenderer(max_fps=0.001, is_tty=True)
+    for i in range(100):
+        progress.update('a', 'a: %s' % i)
+        progress.update('b', 'b: %s' % i)
+    assert out.getvalue() == '\ra: 0\x1b[K\n\x1b[J'  # coalesced
+    progress.finish('a', 'a: done')
+    assert out.getvalue().endswith(
+        '\x1b[1A\ra: done\x1b[K\n\rb: 99\x1b[K\n\x1b[J')
+
+    # after other output, redraws below it instead of over it
+    out.write('log line\n')
+    progress.note_write()
+    progress.finish('b', 'b: done')
+    assert out.getvalue().endswith('log line\n\rb: done\x1b[K\n\x1b[J')
+
+    out.truncate(0)
+    progress = log.ProgressRenderer(is_tty=False)
+    for i in range(100):
+        progress.update('a', 'a: %s' % i)
+    progress.finish('a')
+    assert out.getvalue() == 'a: 0\na: 99\n'
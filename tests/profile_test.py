@@ -0,0 +1,62 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+import json
+import argparse
+from xml.etree import ElementTree
+
+import pytest
+
+from opensky import profile_plugin
+
+
+def test_aggregate_collapsed(tmpdir):
+    tmpdir.join('cpu-1.collapsed').write('main;serve;query 6\nmain;serve 2\n')
+    tmpdir.join('cpu-2.collapsed').write('main;fib;fib;fib 2\nmain;serve;query 1\n')
+    stacks = profile_plugin.load_collapsed(
+        [str(tmpdir.join('cpu-1.collapsed')), str(tmpdir.join('cpu-2.collapsed'))])
+    assert stacks['main;serve;query'] == 7
+    stats = profile_plugin.aggregate_stacks(stacks)
+    by_name = dict([(s['name'], s) for s in stats])
+    assert stats[0]['name'] == 'query'
+    assert by_name['serve'] == {'name': 'serve', 'self': 2, 'total': 9}
+    assert by_name['fib'] == {'name': 'fib', 'self': 2, 'total': 2}
+    assert by_name['main'] == {'name': 'main', 'self': 0, 'total': 11}
+
+    svg = ElementTree.fromstring(profile_plugin.render_flamegraph(stacks))
+    titles = [el.text for el in svg.iter('{http://www.w3.org/2000/svg}title')]
+    assert 'all (11 samples, 100.0%)' in titles
+    assert 'query (7 samples, 63.6%)' in titles
+
+
+def test_diff_mem_snapshots(tmpdir):
+    def snapshot(pid, t, sites):
+        return {'pid': pid, 'time': t, 'method': 'gc', 'rss': 1024 * t,
+                'sites': [{'site': s, 'size': size, 'count': count}
+                          for s, size, count in sites]}
+    tmpdir.join('mem-7-0000.json').write(json.dumps(snapshot(
+        7, 1, [('dict', 1000, 10), ('app.Session', 200, 2), ('list', 50, 1)])))
+    tmpdir.join('mem-7-0001.json').write(json.dumps(snapshot(
+        7, 2, [('dict', 900, 9), ('app.Session', 5000, 50), ('tuple', 80, 2)])))
+    tmpdir.join('mem-8-0000.json').write(json.dumps(snapshot(8, 3, [])))
+    snapshots = profile_plugin.load_mem_snapshots(str(tmpdir))
+    assert sorted(snapshots) == [7, 8]
+    assert [s['time'] for s in snapshots[7]] == [1, 2]
+
+    diffs = profile_plugin.diff_mem_snapshots(*snapshots[7])
+    assert [d['site'] for d in diffs] == ['app.Session', 'dict', 'tuple', 'list']
+    assert diffs[0]['size_diff'] == 4800 and diffs[0]['count_diff'] == 48
+    assert diffs[3] == {'site': 'list', 'size': 0, 'count': 0,
+                        'size_diff': -50, 'count_diff': -1}
+    assert profile_plugin._fmt_size(-2048, sign=True) == '-2KiB'
+
+    def mem_report(**kw):
+        args = dict(dir=str(tmpdir), pid=7, from_index=0, to_index=-1,
+                    top=25, json=True)
+        args.update(kw)
+        return profile_plugin.mem_report(argparse.Namespace(**args), None)
+    mem_report(from_index=-2, to_index=1)
+    with pytest.raises(SystemExit) as exc_info:
+        mem_report(to_index=2)
+    assert 'no snapshot 2 for pid 7' in str(exc_info.value)
+    with pytest.raises(SystemExit):
+        mem_report(from_index=-3)
@@ -0,0 +1,105 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+import os
+import sys
+import json
+import urllib2
+
+import pytest
+import seashore
+
+from opensky import pypier
+
+
+def _publish(pypier_dir, name, version):
+    pkg_dir = pypier_dir.ensure('packages/' + name, dir=True)
+    pkg_dir.join('%s-%s.tar.gz' % (name, version)).write('')
+    pkg_dir.join('pkg_info.json').write(json.dumps(
+        {'name': name, 'version': version, 'url': 'http://example.com'}))
+
+
+def test_update_index(tmpdir):
+    _publish(tmpdir, 'foo_lib', '1.0')
+    _publish(tmpdir, 'bar', '0.1')
+    index = pypier.update_index(str(tmpdir))
+    assert sorted(index['packages']) == ['bar', 'foo_lib']
+
+    simple_page = tmpdir.join('simple/foo-lib/index.html').read()
+    assert '../../packages/foo_lib/foo_lib-1.0.tar.gz' in simple_page
+    assert 'foo-lib/' in tmpdir.join('simple/index.html').read()
+    assert 'foo_lib-1.0.tar.gz' in tmpdir.join('packages/index.html').read()
+
+    # only the named package is rescanned
+    _publish(tmpdir, 'foo_lib', '1.1')
+    tmpdir.join('packages/bar/bar-0.2.tar.gz').write('')
+    index = pypier.update_index(str(tmpdir), ['foo_lib'])
+    assert [v['version'] for v in index['packages']['bar']['versions']] == ['0.1']
+    assert len(index['packages']['foo_lib']['versions']) == 2
+    assert pypier.load_index(str(tmpdir)) == json.loads(
+        tmpdir.join('packages/index.json').read())
+
+
+def test_version_order_and_resolve(tmpdir):
+    for version in ('1.9', '1.10', '1.11rc1'):
+        _publish(tmpdir, 'foo', version)
+    index = pypier.update_index(str(tmpdir))
+    foo = index['packages']['foo']
+    assert [v['version'] for v in foo['versions']] == ['1.11rc1', '1.10', '1.9']
+    assert foo['latest'] == '1.10'
+
+    assert pypier.resolve_release(index, 'foo') == 'foo/foo-1.10.tar.gz'
+    assert pypier.resolve_release(index, 'foo==1.9') == 'foo/foo-1.9.tar.gz'
+    assert pypier.resolve_release(index, 'foo==2.0') is None
+    assert pypier.resolve_release(index, 'foo>=1.0') is None
+    assert pypier.resolve_release(index, 'requests') is None
+
+    resolved = pypier.resolve_requirements(
+        str(tmpdir), ['-d', 'foo', 'foo==1.9', 'requests'])
+    assert resolved == ['-d', 'foo',
+                        str(tmpdir) + '/packages/foo/foo-1.9.tar.gz',
+                        'requests']
+
+
+class _FakeSparseRepo(object):
+    def __init__(self, path, blobs):
+        self.path, self.blobs = path, blobs
+
+    def materialize(self, rel_path):
+        local_path = os.path.join(self.path, rel_path)
+        with open(local_path, 'w') as f:
+            f.write(self.blobs[rel_path])
+        return local_path
+
+
+def test_serve_pypier(tmpdir):
+    _publish(tmpdir, 'foo', '1.0')
+    pypier.update_index(str(tmpdir))
+    tmpdir.join('packages/foo/foo-1.0.tar.gz').remove()
+    repo = _FakeSparseRepo(str(tmpdir), {'packages/foo/foo-1.0.tar.gz': 'sdist'})
+    with pypier.serve_pypier(repo) as url:
+        assert 'foo-1.0.tar.gz' in urllib2.urlopen(url + '/simple/foo/').read()
+        release_url = url + '/packages/foo/foo-1.0.tar.gz'
+        assert urllib2.urlopen(release_url).read() == 'sdist'
+        with pytest.raises(urllib2.HTTPError):
+            urllib2.urlopen(url + '/packages/bar/bar-1.0.tar.gz')
+    env = pypier.get_pip_env(str(tmpdir), url)
+    assert env['PIP_EXTRA_INDEX_URL'] == url + '/simple/'
+
+
+def test_get_pkg_info_setup_cfg(tmpdir):
+    tmpdir.join('setup.py').write(
+        'from setuptools import setup\n'
+        'print("noise from setup.py")\n'
+        'setup()\n')
+    tmpdir.join('setup.cfg').write(
+        '[metadata]\n'
+        'name = foo_lib\n'
+        'version = 1.2\n'
+        'url = http://example.com/foo\n')
+    # the python running the tests, setup.py is run with "python"
+    executor = seashore.Executor(seashore.Shell(), commands=['python']).patch_env(
+        PATH=os.path.dirname(sys.executable) + os.pathsep + os.environ['PATH'])
+    info = pypier.get_pkg_info(executor, str(tmpdir))
+    assert info['name'] == 'foo_lib'
+    assert info['version'] == '1.2'
+    assert info['url'] == 'http://example.com/foo'
@@ -0,0 +1,20 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+from opensky import self_plugin
+
+
+def test_update_wheel_cache(tmpdir):
+    wheelhouse = tmpdir.ensure('wheelhouse', dir=True)
+    wheel_cache = self_plugin.get_wheel_cache_dir(str(tmpdir.join('cache')))
+    wheel_names = ['requests-2.18.1-py2.py3-none-any.whl',
+                   'sky_metadata-17.6.5-py2-none-any.whl',
+                   'my_plugin-0.1-py2-none-any.whl']
+    for wheel_name in wheel_names:
+        wheelhouse.join(wheel_name).write(wheel_name)
+
+    copied = self_plugin.update_wheel_cache(
+        wheel_cache, str(wheelhouse), wheel_names,
+        ['sky_metadata', 'my-plugin'])
+    assert copied == ['requests-2.18.1-py2.py3-none-any.whl']
+    assert self_plugin.update_wheel_cache(
+        wheel_cache, str(wheelhouse), wheel_names[:1]) == []
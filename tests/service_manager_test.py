@@ -0,0 +1,81 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+from opensky import service_manager
+
+
+def test_setup_stages(tmpdir):
+    path = str(tmpdir.join('setup-stages.json'))
+    stages = service_manager.SetupStages.load(path)
+    assert not stages.is_current('image', ['spec', 'id1'])
+    stages.record('image', ['spec', 'id1'])
+
+    stages = service_manager.SetupStages.load(path)
+    assert stages.is_current('image', ['spec', 'id1'])
+    assert not stages.is_current('image', ['spec', 'id2'])
+    assert not stages.is_current('zookeeper', ['spec', 'id1'])
+    forced = service_manager.SetupStages.load(path, force=True)
+    assert not forced.is_current('image', ['spec', 'id1'])
+
+
+def test_find_changed_tests(tmpdir):
+    for path in ('app/foo.py', 'app/bar.py', 'app/tests/test_foo.py',
+                 'app/tests/bar_test.py', 'app/tests/test_baz.py'):
+        tmpdir.ensure(path).setmtime(1000)
+    assert service_manager.find_changed_tests(str(tmpdir), 2000) == []
+
+    tmpdir.join('app/foo.py').setmtime(3000)
+    tmpdir.join('app/tests/test_baz.py').setmtime(3000)
+    assert service_manager.find_changed_tests(str(tmpdir), 2000) == [
+        'app/tests/test_baz.py', 'app/tests/test_foo.py']
+
+
+def test_is_test_path(tmpdir):
+    tmpdir.ensure('app/tests/test_foo.py')
+    project_dir = str(tmpdir)
+    assert service_manager.is_test_path('/home/app/app/tests', project_dir)
+    assert service_manager.is_test_path('app/tests/test_foo.py::test_x', project_dir)
+    assert not service_manager.is_test_path('-x', project_dir)
+    assert not service_manager.is_test_path('foo and not bar', project_dir)  # -k value
+
+
+def _junit(cases):
+    return ('<testsuite errors="0" failures="1" skips="0" tests="%d" time="%s">%s'
+            '</testsuite>' % (len(cases), sum([t for _, _, t in cases]), ''.join([
+                '<testcase classname="%s" file="%s" name="t" time="%s"/>' % case
+                for case in cases])))
+
+
+def test_split_by_duration(tmpdir):
+    tmpdir.ensure('test_a.py')
+    tmpdir.ensure('sub/b_test.py')
+    tmpdir.ensure('test_c.py')
+    tmpdir.ensure('test_new.py')
+    tmpdir.ensure('conftest.py')
+    modules = service_manager.find_test_modules(str(tmpdir))
+    assert modules == ['sub/b_test.py', 'test_a.py', 'test_c.py', 'test_new.py']
+
+    report = tmpdir.join('junit.xml')
+    assert service_manager.load_junit_durations(str(report)) == {}
+    report.write(_junit([('test_a', 'test_a.py', 5.0), ('test_a', 'test_a.py', 4.0),
+                         ('sub.b_test', 'sub/b_test.py', 6.0),
+                         ('test_c', 'test_c.py', 3.0)]))
+    durations = service_manager.load_junit_durations(str(report))
+    assert durations == {'test_a.py': 9.0, 'b_test.py': 6.0, 'test_c.py': 3.0}
+
+    shards = service_manager.split_by_duration(modules, durations, 2)
+    assert shards == [['test_a.py', 'test_c.py'], ['sub/b_test.py', 'test_new.py']]
+    assert service_manager.split_by_duration(modules, {}, 4) == [[m] for m in modules]
+
+
+def test_merge_junit_reports(tmpdir):
+    tmpdir.join('shard0.xml').write(_junit([('test_a', 'test_a.py', 1.5)]))
+    tmpdir.join('shard1.xml').write(
+        '<testsuites>%s</testsuites>' % _junit([('test_b', 'test_b.py', 2.0),
+                                                ('test_b', 'test_b.py', 1.0)]))
+    dest = str(tmpdir.join('junit.xml'))
+    totals = service_manager.merge_junit_reports(
+        [str(tmpdir.join('shard0.xml')), str(tmpdir.join('shard1.xml'))], dest)
+    assert totals['tests'] == 3 and totals['failures'] == 2
+    assert totals['time'] == 4.5
+    assert service_manager.load_junit_durations(dest) == {
+        'test_a.py': 1.5, 'test_b.py': 3.0}
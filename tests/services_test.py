@@ -0,0 +1,93 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+import socket
+
+import attr
+
+from opensky import docker, services_plugin
+
+
+def test_parse_ps_ports():
+    output = '\n'.join([
+        'a1b2c3d4e5f6\t0.0.0.0:3306->3306/tcp, :::3306->3306/tcp',
+        'f6e5d4c3b2a1\t127.0.0.1:8000-8001->80-81/tcp, 9000/tcp',
+        '0123456789ab\t'])
+    assert docker.parse_ps_ports(output) == {
+        3306: 'a1b2c3d4e5f6', 8000: 'f6e5d4c3b2a1', 8001: 'f6e5d4c3b2a1'}
+
+
+def _listen():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(16)
+    return sock, sock.getsockname()[1]
+
+
+def _closed_port():
+    sock, port = _listen()
+    sock.close()
+    return port
+
+
+@attr.s
+class FakeRunner(object):
+    published = attr.ib()
+    calls = attr.ib(default=0)
+
+    def get_published_ports(self):
+        self.calls += 1
+        return self.published
+
+
+def test_get_service_status():
+    listener, open_port = _listen()
+    closed_port = _closed_port()
+    try:
+        assert services_plugin._check_ports([open_port, closed_port]) == {
+            open_port: True, closed_port: False}
+
+        images = [docker.ImageService(name='up', image='mysql',
+                                      ports=['%s:3306' % open_port]),
+                  docker.ImageService(name='down', image='redis',
+                                      ports=['%s:6379' % closed_port])]
+        runner = FakeRunner({open_port: 'a1b2c3d4e5f6'})
+        res = services_plugin.get_service_status(images, runner)
+    finally:
+        listener.close()
+    assert res['up'] == {'ports': {open_port: True}, 'status': 'up',
+                         'container_id': 'a1b2c3d4e5f6'}
+    assert res['down']['status'] == 'down'
+    assert runner.calls == 1
+
+
+def test_port_cache_and_redraw():
+    listener, open_port = _listen()
+    try:
+        images = [docker.ImageService(name='up', image='mysql',
+                                      ports=['%s:3306' % open_port])]
+        runner = FakeRunner({open_port: 'a1b2c3d4e5f6'})
+        port_cache = {}
+        for _ in range(3):
+            res = services_plugin.get_service_status(
+                images, runner, port_cache=port_cache)
+    finally:
+        listener.close()
+    assert res['up']['container_id'] == 'a1b2c3d4e5f6'
+    assert runner.calls == 1
+
+    res = services_plugin.get_service_status(images, runner, port_cache=port_cache)
+    assert res['up']['status'] == 'down'
+    assert port_cache == {}
+
+    redraw = services_plugin._redraw_lines
+    assert redraw(None, ['a', 'b']) == 'a\nb\n'
+    assert redraw(['a', 'b', 'c'], ['a', 'B', 'c']) == '\x1b[2A\rB\x1b[K\x1b[2B\r'
+    assert redraw(['a', 'b'], ['a']) == '\x1b[2A\r\x1b[Ja\n'
+
+
+def test_check_watch_args():
+    prs = services_plugin.get_argparser()
+    args = prs.parse_args(['check', '--watch', 'redis'])
+    assert args.watch and args.interval is None and args.services == ['redis']
+    args = prs.parse_args(['check', '--interval', '0.5'])
+    assert not args.watch and args.interval == 0.5
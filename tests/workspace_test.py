@@ -0,0 +1,57 @@
+# Copyright (c) Shopkick 2017
+# See LICENSE for details.
+import os
+import time
+
+from opensky import workspace
+
+
+def _make_workspaces(workdir, count, size=0):
+    for i in range(1, count + 1):
+        log = workdir.ensure('%04d-proj-test/log.txt' % i)
+        log.write('x' * size)
+        log.setmtime(1000)  # not active
+
+
+def test_rotate(tmpdir):
+    workdir, trash = tmpdir.ensure('workspace', dir=True), tmpdir.ensure('trash', dir=True)
+    _make_workspaces(workdir, 8)
+    workdir.ensure('not-a-workspace', dir=True)
+    workdir.ensure('0009-a-file')  # only directories count
+
+    assert workspace.rotate(str(workdir), str(trash), num_to_keep=5) == 8
+    assert [fn for _, fn in workspace.list_workspaces(str(workdir))][0] == '0003-proj-test'
+    assert len(trash.listdir()) == 2
+    assert workspace.needs_reaping(str(trash), 8)
+
+    workspace.reap(str(workdir), str(trash), max_size=0)
+    assert trash.listdir() == []
+
+
+def test_reap_size_limit(tmpdir):
+    workdir, trash = tmpdir.ensure('workspace', dir=True), tmpdir.ensure('trash', dir=True)
+    _make_workspaces(workdir, 6, size=100)
+
+    workspace.reap(str(workdir), str(trash), max_size=350, min_to_keep=2)
+    assert sorted(os.listdir(str(workdir))) == [
+        '0004-proj-test', '0005-proj-test', '0006-proj-test']
+
+    workspace.reap(str(workdir), str(trash), max_size=1, min_to_keep=2)
+    assert sorted(os.listdir(str(workdir))) == ['0005-proj-test', '0006-proj-test']
+    assert trash.listdir() == []
+
+
+def test_skip_in_use(tmpdir):
+    workdir, trash = tmpdir.ensure('workspace', dir=True), tmpdir.ensure('trash', dir=True)
+    _make_workspaces(workdir, 4, size=100)
+    workdir.join('0001-proj-test/log.txt').setmtime(time.time())  # active
+    log_file = workspace.open_log(str(workdir.join('0002-proj-test')))
+    try:
+        assert workspace.is_in_use(str(workdir.join('0002-proj-test')))
+        workspace.rotate(str(workdir), str(trash), num_to_keep=0)
+        workspace.reap(str(workdir), str(trash), max_size=1, min_to_keep=1)
+        assert sorted(os.listdir(str(workdir))) == [
+            '0001-proj-test', '0002-proj-test', '0004-proj-test']
+    finally:
+        log_file.close()
+    assert not workspace.is_in_use(str(workdir.join('0002-proj-test')))